@@ -0,0 +1,124 @@
+"""
+Static Audio Origin
+Serves audio files over HTTP with configurable latency and error rate, as a
+stand-in for the storage/CDN URLs python-worker downloads from
+
+Always serves a synthetic track at /audio/track.wav; --dir adds every file in
+a directory under its own name.
+
+Usage:
+    python audio_origin.py --port 9100 --latency-ms 150 --jitter-ms 50 --error-rate 0.02
+    curl -o /dev/null http://localhost:9100/audio/track.wav
+"""
+
+import argparse
+import asyncio
+import io
+import mimetypes
+import os
+import random
+from typing import Dict
+
+import numpy as np
+import soundfile as sf
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response
+
+
+def synth_track(seconds: float, sample_rate: int = 44100, seed: int = 0) -> bytes:
+    """
+    Stereo 16-bit WAV with a beat, a bassline and a chord pad, so the
+    analysis stages (tempo, key, onsets, loudness) do realistic work
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    beat = 0.5  # 120 BPM
+
+    drums = np.zeros_like(t)
+    for onset in np.arange(0, seconds, beat):
+        idx = int(onset * sample_rate)
+        n = min(len(t) - idx, int(0.15 * sample_rate))
+        env = np.exp(-np.arange(n) / (0.03 * sample_rate))
+        drums[idx:idx + n] += (0.4 * rng.standard_normal(n) + 0.6 * np.sin(2 * np.pi * 60 * np.arange(n) / sample_rate)) * env
+
+    roots = np.array([110.0, 87.3, 98.0, 73.4])
+    bass = 0.25 * np.sin(2 * np.pi * roots[(t // (4 * beat)).astype(int) % len(roots)] * t)
+    pad = sum(0.08 * np.sin(2 * np.pi * f * t) for f in (261.6, 329.6, 392.0))
+
+    left = drums + bass + 0.8 * pad
+    right = drums + bass + 1.2 * pad
+    audio = np.stack([left, right], axis=1)
+    audio *= 0.8 / (np.max(np.abs(audio)) + 1e-9)
+
+    buffer = io.BytesIO()
+    sf.write(buffer, audio.astype(np.float32), sample_rate, format="WAV", subtype="PCM_16")
+    return buffer.getvalue()
+
+
+def create_app(
+    tracks: Dict[str, bytes],
+    latency_ms: float = 0.0,
+    jitter_ms: float = 0.0,
+    error_rate: float = 0.0,
+    error_status: int = 503,
+) -> FastAPI:
+    app = FastAPI(title="Load Test Audio Origin")
+    counters = {"served": 0, "failed": 0, "not_found": 0}
+
+    @app.get("/audio/{name}")
+    async def audio(name: str):
+        delay = max(0.0, random.gauss(latency_ms, jitter_ms)) / 1000
+        if delay:
+            await asyncio.sleep(delay)
+
+        if random.random() < error_rate:
+            counters["failed"] += 1
+            raise HTTPException(status_code=error_status, detail="Injected origin error")
+
+        if name not in tracks:
+            counters["not_found"] += 1
+            raise HTTPException(status_code=404, detail="Track not found")
+
+        counters["served"] += 1
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        return Response(tracks[name], media_type=media_type)
+
+    @app.get("/stats")
+    async def stats():
+        return {"tracks": sorted(tracks), **counters}
+
+    return app
+
+
+def load_tracks(track_seconds: float, directory: str = None) -> Dict[str, bytes]:
+    tracks = {"track.wav": synth_track(track_seconds)}
+    if directory:
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    tracks[name] = f.read()
+    return tracks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve audio with injected latency and errors")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="mean delay before each response")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="standard deviation of the delay")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--track-seconds", type=float, default=180.0, help="length of /audio/track.wav")
+    parser.add_argument("--dir", help="also serve every file in this directory")
+    args = parser.parse_args()
+
+    tracks = load_tracks(args.track_seconds, args.dir)
+    print(f"[ORIGIN] Serving {len(tracks)} tracks on http://{args.host}:{args.port}/audio/")
+    app = create_app(tracks, args.latency_ms, args.jitter_ms, args.error_rate, args.error_status)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Batch Split Benchmark
+Separates the same set of tracks three ways through python-worker's split
+service and reports tracks per hour for each:
+
+    sequential  one POST /split at a time (the catalog import baseline)
+    concurrent  every track as its own /split at once (batching window)
+    batch       one POST /split/batch with every track
+
+Usage:
+    python loadtest/batch_split.py --tracks 12 --track-seconds 180 --upload-format mp3
+    python loadtest/batch_split.py --separator-mode cpu --separator-seconds-per-minute 3
+    python loadtest/batch_split.py --tracks 4 --track-seconds 60 --modes batch --memory-budget-mb 1000
+    python loadtest/batch_split.py --real-separators --audio-dir ~/catalog --format flac
+"""
+
+import argparse
+import http.client
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import soundfile as sf
+
+from audio_origin import synth_track
+from run import ROOT, LOADTEST_DIR, start_process, stop_process, wait_ready
+
+MODES = ["sequential", "concurrent", "batch"]
+
+MEDIA_TYPES = {".wav": "audio/wav", ".mp3": "audio/mpeg", ".flac": "audio/flac", ".ogg": "audio/ogg"}
+
+
+def multipart_files(field: str, files: List[Tuple[str, bytes]]) -> Tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    parts = []
+    for filename, content in files:
+        media_type = MEDIA_TYPES.get(os.path.splitext(filename)[1], "application/octet-stream")
+        parts.append((
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f"Content-Type: {media_type}\r\n\r\n"
+        ).encode() + content + b"\r\n")
+    return b"".join(parts) + f"--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+
+def post(base_url: str, path: str, body: bytes, content_type: str, timeout: float) -> Tuple[int, Dict[str, Any]]:
+    parsed = urlparse(base_url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=timeout)
+    try:
+        conn.request("POST", path, body=body, headers={"Content-Type": content_type})
+        response = conn.getresponse()
+        payload = response.read()
+        try:
+            return response.status, json.loads(payload)
+        except ValueError:
+            return response.status, {}
+    finally:
+        conn.close()
+
+
+def cleanup(base_url: str, results: List[Dict[str, Any]]):
+    for result in results:
+        if result.get("job_id"):
+            post(base_url, f"/cleanup/{result['job_id']}", b"", "text/plain", 30)
+
+
+def make_tracks(count: int, seconds: float, upload_format: str, audio_dir: Optional[str]) -> List[Tuple[str, bytes]]:
+    if audio_dir:
+        names = sorted(name for name in os.listdir(audio_dir) if os.path.splitext(name)[1] in MEDIA_TYPES)
+        tracks = []
+        for name in names[:count]:
+            with open(os.path.join(audio_dir, name), "rb") as f:
+                tracks.append((name, f.read()))
+        return tracks
+
+    tracks = []
+    for seed in range(count):
+        wav = synth_track(seconds, seed=seed)
+        if upload_format == "wav":
+            tracks.append((f"track{seed:03d}.wav", wav))
+            continue
+        audio, sample_rate = sf.read(io.BytesIO(wav), dtype="float32")
+        buffer = io.BytesIO()
+        sf.write(buffer, audio, sample_rate, format=upload_format.upper())
+        tracks.append((f"track{seed:03d}.{upload_format}", buffer.getvalue()))
+    return tracks
+
+
+def run_mode(mode: str, base_url: str, tracks: List[Tuple[str, bytes]], query: str, timeout: float) -> Dict[str, Any]:
+    started = time.perf_counter()
+
+    if mode == "batch":
+        body, content_type = multipart_files("files", tracks)
+        status, payload = post(base_url, f"/split/batch?{query}", body, content_type, timeout)
+        results = payload.get("results", []) if status == 200 else []
+    else:
+        def split(track: Tuple[str, bytes]) -> Dict[str, Any]:
+            body, content_type = multipart_files("file", [track])
+            status, payload = post(base_url, f"/split?{query}", body, content_type, timeout)
+            return payload if status == 200 else {"success": False, "status": status}
+
+        workers = 1 if mode == "sequential" else len(tracks)
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(split, tracks))
+
+    elapsed = time.perf_counter() - started
+    ok = sum(1 for result in results if result.get("success"))
+    failures: Dict[str, int] = {}
+    for result in results:
+        if not result.get("success"):
+            status = str(result.get("status", "?"))
+            failures[status] = failures.get(status, 0) + 1
+    cleanup(base_url, results)
+    return {
+        "mode": mode,
+        "tracks": len(tracks),
+        "ok": ok,
+        "failed_by_status": failures,
+        "seconds": round(elapsed, 2),
+        "tracks_per_hour": round(ok * 3600 / elapsed, 1),
+    }
+
+
+def get_json(base_url: str, path: str) -> Tuple[int, Dict[str, Any]]:
+    parsed = urlparse(base_url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=10)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sequential, concurrent and batched Spleeter splits")
+    parser.add_argument("--tracks", type=int, default=12)
+    parser.add_argument("--track-seconds", type=float, default=180.0)
+    parser.add_argument("--upload-format", choices=["wav", "mp3", "flac", "ogg"], default="mp3")
+    parser.add_argument("--audio-dir", help="upload the files in this directory instead of synthetic tracks")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--stems", type=int, choices=[2, 4, 5], default=4)
+    parser.add_argument("--format", default="wav", help="stem format (wav, flac, opus)")
+    parser.add_argument("--timeout", type=float, default=3600.0)
+    parser.add_argument("--json", help="also write the results to this file")
+
+    worker = parser.add_argument_group("split service")
+    worker.add_argument("--url", help="use an already running split service instead of starting one")
+    worker.add_argument("--port", type=int, default=8001)
+    worker.add_argument("--real-separators", action="store_true", help="use Spleeter instead of the fake")
+    worker.add_argument("--separator-seconds-per-minute", type=float, default=5.0)
+    worker.add_argument("--separator-mode", choices=["sleep", "cpu"], default="sleep")
+    worker.add_argument("--batch-window-ms", type=float, default=50.0)
+    worker.add_argument("--batch-max", type=int, default=8)
+    worker.add_argument("--memory-budget-mb", type=float, help="MEMORY_BUDGET_MB for the service, e.g. one job's worth")
+    args = parser.parse_args()
+
+    modes = args.modes.split(",")
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(unknown)}")
+
+    tracks = make_tracks(args.tracks, args.track_seconds, args.upload_format, args.audio_dir)
+    upload_mb = sum(len(content) for _, content in tracks) / 1e6
+    print(f"[LOADTEST] {len(tracks)} tracks, {upload_mb:.1f} MB of uploads")
+
+    run_dir = tempfile.mkdtemp(prefix="loadtest-batch-")
+    worker_dir = os.path.join(ROOT, "python-worker")
+    process = None
+    try:
+        if args.url:
+            base_url = args.url.rstrip("/")
+        else:
+            env = dict(
+                os.environ,
+                PYTHONPATH=os.pathsep.join([worker_dir, LOADTEST_DIR, os.environ.get("PYTHONPATH", "")]),
+                STORAGE_ROOT=os.path.join(run_dir, "storage"),
+                FAKE_SEPARATOR_SECONDS_PER_MINUTE=str(args.separator_seconds_per_minute),
+                FAKE_SEPARATOR_MODE=args.separator_mode,
+                SPLIT_BATCH_WINDOW_MS=str(args.batch_window_ms),
+                SPLIT_BATCH_MAX=str(args.batch_max),
+            )
+            if args.memory_budget_mb:
+                env["MEMORY_BUDGET_MB"] = str(args.memory_budget_mb)
+            os.makedirs(env["STORAGE_ROOT"])
+            if not args.real_separators:
+                env["SEPARATOR_CLASS"] = "fake_separators:FakeSpleeterSeparator"
+                env["AUDIO_ADAPTER_CLASS"] = "fake_separators:FakeAudioAdapter"
+            base_url = f"http://127.0.0.1:{args.port}"
+            process = start_process("split", [
+                sys.executable, "-m", "uvicorn", "split_service:app",
+                "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning",
+            ], worker_dir, env, run_dir)
+            wait_ready(base_url + "/", process, timeout=300)
+
+        query = f"stems={args.stems}&format={args.format}"
+        rows = []
+        for mode in modes:
+            print(f"[LOADTEST] {mode}...")
+            rows.append(run_mode(mode, base_url, tracks, query, args.timeout))
+
+        baseline = next((row for row in rows if row["mode"] == "sequential"), None)
+        print(f"\n{'mode':<12}{'ok':>8}{'seconds':>10}{'tracks/h':>12}{'speedup':>10}")
+        for row in rows:
+            speedup = ""
+            if baseline and baseline["tracks_per_hour"]:
+                row["speedup"] = round(row["tracks_per_hour"] / baseline["tracks_per_hour"], 2)
+                speedup = f"{row['speedup']:.2f}x"
+            print(f"{row['mode']:<12}{row['ok']:>5}/{row['tracks']:<2}{row['seconds']:>10.1f}{row['tracks_per_hour']:>12.0f}{speedup:>10}")
+        for row in rows:
+            if row["failed_by_status"]:
+                print(f"{row['mode']} failures by status: {row['failed_by_status']}")
+
+        status, stats = get_json(base_url, "/scheduler")
+        if status == 200 and "batching" in stats:
+            batching = stats["batching"]
+            print(
+                f"\nStage time: decode {batching['decode_seconds']:.1f}s, inference {batching['inference_seconds']:.1f}s, "
+                f"write {batching['write_seconds']:.1f}s over {batching['batches']} batches "
+                f"(largest {batching['largest_batch']})"
+            )
+
+        status, memory = get_json(base_url, "/memory")
+        if status == 200:
+            admission = memory["admission"]
+            print(
+                f"Memory: budget {memory['budget_bytes'] / 2 ** 20:.0f} MB, {admission['queued']} jobs queued for it "
+                f"({memory['queue_wait_seconds']:.1f}s in total), {admission['busy']} turned away (503)"
+            )
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"tracks": len(tracks), "modes": rows, "scheduler": stats, "memory": memory}, f, indent=2)
+            print(f"\nResults written to {args.json}")
+
+    finally:
+        if process is not None:
+            stop_process(process)
+        shutil.rmtree(os.path.join(run_dir, "storage"), ignore_errors=True)
+        print(f"[LOADTEST] Logs kept in {run_dir}")
+
+
+if __name__ == "__main__":
+    main()
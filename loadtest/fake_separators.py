@@ -0,0 +1,122 @@
+"""
+Fake Separators
+Stand-ins for Spleeter and Demucs for throughput-only load tests: each job
+costs a configurable amount of time (or CPU) per minute of audio and writes
+correctly named stems, so the HTTP, queueing, storage and encoding paths run
+for real without TensorFlow or PyTorch
+
+Spleeter (in-process, python-worker/split_service.py):
+    SEPARATOR_CLASS=fake_separators:FakeSpleeterSeparator
+    AUDIO_ADAPTER_CLASS=fake_separators:FakeAudioAdapter
+Demucs (child process, python-worker-enhanced), with the worker directory on
+PYTHONPATH:
+    SEPARATION_ENTRYPOINT=/path/to/loadtest/fake_separators.py
+
+Settings:
+    FAKE_SEPARATOR_SECONDS_PER_MINUTE  work per minute of input audio (default 5)
+    FAKE_SEPARATOR_MODE                sleep (default) or cpu, a busy BLAS loop
+                                       on OMP_NUM_THREADS threads
+"""
+
+import argparse
+import os
+import time
+from typing import List
+
+import numpy as np
+import soundfile as sf
+
+SECONDS_PER_MINUTE = float(os.environ.get("FAKE_SEPARATOR_SECONDS_PER_MINUTE", "5"))
+MODE = os.environ.get("FAKE_SEPARATOR_MODE", "sleep")
+
+SPLEETER_STEMS = {
+    "spleeter:2stems": ["vocals", "accompaniment"],
+    "spleeter:4stems": ["vocals", "drums", "bass", "other"],
+    "spleeter:5stems": ["vocals", "drums", "bass", "piano", "other"],
+}
+
+DEMUCS_STEMS = ["drums", "bass", "other", "vocals"]
+
+
+def simulate_work(audio_seconds: float):
+    seconds = audio_seconds / 60.0 * SECONDS_PER_MINUTE
+    if MODE != "cpu":
+        time.sleep(seconds)
+        return
+
+    a = np.random.default_rng(0).standard_normal((512, 512)).astype(np.float32)
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        np.dot(a, a)
+
+
+def fake_separate(input_path: str, stems_dir: str, stem_names: List[str]):
+    """Decode, spend the configured work, then write each stem as a scaled copy"""
+    audio, sample_rate = sf.read(input_path, dtype="float32", always_2d=True)
+    simulate_work(audio.shape[0] / sample_rate)
+
+    os.makedirs(stems_dir, exist_ok=True)
+    for name in stem_names:
+        sf.write(os.path.join(stems_dir, f"{name}.wav"), audio / len(stem_names), sample_rate)
+
+
+class FakeAudioAdapter:
+    """
+    Same load()/save() interface as spleeter.audio.adapter.AudioAdapter, via
+    libsndfile instead of ffmpeg (decodes WAV, FLAC, OGG and MP3 for real,
+    but never resamples)
+    """
+
+    @classmethod
+    def default(cls) -> "FakeAudioAdapter":
+        return cls()
+
+    def load(self, path: str, offset: float = None, duration: float = None, sample_rate: int = None, dtype=np.float32):
+        with sf.SoundFile(path) as f:
+            start = int((offset or 0) * f.samplerate)
+            frames = int(duration * f.samplerate) if duration is not None else -1
+            f.seek(min(start, f.frames))
+            audio = f.read(frames, dtype="float32", always_2d=True)
+            source_rate = f.samplerate
+        if audio.shape[1] == 1:
+            audio = np.repeat(audio, 2, axis=1)
+        return audio.astype(dtype), source_rate
+
+    def save(self, path: str, data: np.ndarray, sample_rate: int, codec: str = None, bitrate: str = None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        sf.write(path, data, sample_rate)
+
+
+class FakeSpleeterSeparator:
+    """
+    Same constructor, separate() and separate_to_file() layout as
+    spleeter.separator.Separator
+    """
+
+    def __init__(self, params_descriptor: str, **kwargs):
+        self.stem_names = SPLEETER_STEMS[params_descriptor]
+
+    def separate(self, waveform: np.ndarray, audio_descriptor: str = "") -> dict:
+        simulate_work(waveform.shape[0] / 44100)
+        return {name: waveform / len(self.stem_names) for name in self.stem_names}
+
+    def separate_to_file(self, audio_descriptor: str, destination: str, **kwargs):
+        base_name = os.path.splitext(os.path.basename(audio_descriptor))[0]
+        fake_separate(audio_descriptor, os.path.join(destination, base_name), self.stem_names)
+
+
+def main():
+    # Same arguments and output layout as python-worker-enhanced/separation.py
+    from separation import SEPARATION_PROFILES, stems_dir_for
+
+    parser = argparse.ArgumentParser(description="Fake Demucs separation job")
+    parser.add_argument("--input", required=True)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--profile", choices=list(SEPARATION_PROFILES), default="balanced")
+    args = parser.parse_args()
+
+    fake_separate(args.input, stems_dir_for(args.output, args.input, args.profile), DEMUCS_STEMS)
+
+
+if __name__ == "__main__":
+    main()
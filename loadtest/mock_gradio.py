@@ -0,0 +1,71 @@
+"""
+Mock Gradio Space
+Stands in for Mansuba/AI-Powered-Music-Analysis: same /process_audio API and
+five outputs, with configurable processing time, error rate and queue
+concurrency (a free Space runs one job at a time)
+
+Usage:
+    python mock_gradio.py --port 7860 --latency-ms 4000 --error-rate 0.05 --concurrency 1
+    MANSUBA_SPACE=http://localhost:7860/ uvicorn main:app --port 8000
+
+Requires gradio (pip install gradio).
+"""
+
+import argparse
+import os
+import random
+import time
+
+
+def build_demo(latency_ms: float, jitter_ms: float, error_rate: float):
+    import gradio as gr
+
+    def process_audio(audio_path, llm_provider):
+        time.sleep(max(0.0, random.gauss(latency_ms, jitter_ms)) / 1000)
+        if random.random() < error_rate:
+            raise gr.Error("Injected upstream failure")
+
+        size_kb = os.path.getsize(audio_path) // 1024 if audio_path else 0
+        return (
+            "Piano: 0.95\nDrums: 0.87\nBass: 0.82\nVocals: 0.64",
+            None,
+            f"Mock summary of a {size_kb} KB upload",
+            f"Mock insight from {llm_provider}",
+            None,
+        )
+
+    return gr.Interface(
+        fn=process_audio,
+        inputs=[
+            gr.Audio(type="filepath", label="Audio"),
+            gr.Dropdown(["groq", "openai"], value="groq", label="LLM provider"),
+        ],
+        outputs=[
+            gr.Textbox(label="Instruments"),
+            gr.Image(label="Instrument plot"),
+            gr.Textbox(label="Audio summary"),
+            gr.Textbox(label="AI insight"),
+            gr.Image(label="Virality plot"),
+        ],
+        api_name="process_audio",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock of the Mansuba Gradio Space")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--latency-ms", type=float, default=3000.0, help="mean processing time per job")
+    parser.add_argument("--jitter-ms", type=float, default=500.0, help="standard deviation of the processing time")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of jobs that fail")
+    parser.add_argument("--concurrency", type=int, default=1, help="jobs the queue runs at once")
+    args = parser.parse_args()
+
+    demo = build_demo(args.latency_ms, args.jitter_ms, args.error_rate)
+    demo.queue(default_concurrency_limit=args.concurrency, max_size=None)
+    print(f"[GRADIO] Mock Space on http://{args.host}:{args.port}/ ({args.concurrency} concurrent jobs)")
+    demo.launch(server_name=args.host, server_port=args.port, share=False, show_error=True, quiet=True)
+
+
+if __name__ == "__main__":
+    main()
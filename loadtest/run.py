@@ -0,0 +1,510 @@
+"""
+Load Test Driver
+Starts a worker against local upstream stand-ins, drives it with concurrency
+or arrival-rate profiles, and reports latency percentiles, throughput, error
+rate and peak RSS per endpoint
+
+Targets:
+    analysis  python-worker/main.py           POST /analyze (audio origin + mock Gradio Space)
+    split     python-worker/split_service.py  POST /split (fake Spleeter)
+    enhanced  python-worker-enhanced/main.py  analyze, stream, separate, analyze_separate (fake Demucs)
+
+Profiles (one stage per endpoint and level):
+    concurrency:1,4,16  closed loop, N clients sending back to back
+    rate:0.5,1,2        open loop, N arrivals per second (--arrival constant|poisson)
+
+Usage:
+    python loadtest/run.py analysis --profile concurrency:1,4,16 --duration 60 --gradio-latency-ms 4000
+    python loadtest/run.py split --profile rate:0.2,0.5,1 --arrival poisson --duration 120
+    python loadtest/run.py enhanced --endpoints analyze,stream --profile concurrency:2,8 --json results.json
+    python loadtest/run.py enhanced --url http://localhost:8001 --pid 4242   # worker already running
+"""
+
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from audio_origin import synth_track
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(LOADTEST_DIR)
+
+# endpoint name -> (path, body kind, whether the response holds a job_id to clean up)
+TARGETS: Dict[str, Dict[str, Any]] = {
+    "analysis": {
+        "dir": os.path.join(ROOT, "python-worker"),
+        "app": "main:app",
+        "port": 8000,
+        "health": "/health",
+        "endpoints": {
+            "analyze": ("/analyze", "json_url", False),
+        },
+    },
+    "split": {
+        "dir": os.path.join(ROOT, "python-worker"),
+        "app": "split_service:app",
+        "port": 8001,
+        "health": "/",
+        "endpoints": {
+            "split": ("/split?stems=4&format=wav", "upload", True),
+        },
+    },
+    "enhanced": {
+        "dir": os.path.join(ROOT, "python-worker-enhanced"),
+        "app": "main:app",
+        "port": 8002,
+        "health": "/health",
+        "endpoints": {
+            "analyze": ("/analyze/enhanced", "upload", False),
+            "stream": ("/analyze/enhanced/stream", "upload", False),
+            "separate": ("/separate/stems?profile=fast", "upload", True),
+            "analyze_separate": ("/analyze/separate?profile=fast", "upload", True),
+        },
+    },
+}
+
+
+# ----------------------------------------------------------------------
+# Processes
+
+
+def start_process(name: str, args: List[str], cwd: str, env: Dict[str, str], log_dir: str) -> subprocess.Popen:
+    log_path = os.path.join(log_dir, f"{name}.log")
+    print(f"[LOADTEST] Starting {name} (log: {log_path})")
+    log = open(log_path, "wb")
+    return subprocess.Popen(args, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_ready(url: str, process: Optional[subprocess.Popen], timeout: float = 120.0):
+    parsed = urlparse(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode} before becoming ready")
+        try:
+            conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=2)
+            conn.request("GET", parsed.path or "/")
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.25)
+    raise RuntimeError(f"{url} not ready after {timeout:.0f}s")
+
+
+def stop_process(process: subprocess.Popen):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def process_tree_rss(pid: int) -> int:
+    """Resident bytes of a process and all its descendants (Linux /proc)"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+    return total
+
+
+class RssSampler:
+    """Tracks the peak RSS of a process tree on a background thread"""
+
+    def __init__(self, pid: Optional[int], interval: float = 0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.pid is not None and os.path.exists("/proc"):
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            self._stop.wait(self.interval)
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    @property
+    def peak_mb(self) -> Optional[float]:
+        return self.peak / (1024 * 1024) if self.peak else None
+
+
+# ----------------------------------------------------------------------
+# Requests
+
+
+def multipart_body(filename: str, content: bytes, content_type: str) -> Tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    return head + content + tail, f"multipart/form-data; boundary={boundary}"
+
+
+class Endpoint:
+    def __init__(self, name: str, path: str, body_kind: str, cleanup: bool, upload: bytes, audio_url: str, query: str):
+        self.name = name
+        self.path = path
+        if query:
+            self.path += ("&" if "?" in path else "?") + query
+        self.body_kind = body_kind
+        self.cleanup = cleanup
+        self.audio_url = audio_url
+        if body_kind == "upload":
+            self.upload_body, self.upload_type = multipart_body("track.wav", upload, "audio/wav")
+
+    def request(self) -> Tuple[bytes, Dict[str, str]]:
+        if self.body_kind == "json_url":
+            body = json.dumps({"audioUrl": self.audio_url, "assetId": f"load-{uuid.uuid4().hex[:8]}"}).encode()
+            return body, {"Content-Type": "application/json"}
+        return self.upload_body, {"Content-Type": self.upload_type}
+
+
+def send(base_url: str, endpoint: Endpoint, timeout: float) -> Tuple[int, float, Optional[str]]:
+    """
+    One request; returns (status, seconds, error)
+
+    SSE responses are read to the end and count as failed if they carry an
+    error event.
+    """
+    parsed = urlparse(base_url)
+    body, headers = endpoint.request()
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=timeout)
+    try:
+        conn.request("POST", endpoint.path, body=body, headers=headers)
+        response = conn.getresponse()
+        payload = response.read()
+        elapsed = time.perf_counter() - started
+        status = response.status
+
+        if status >= 400:
+            return status, elapsed, f"HTTP {status}"
+        if response.getheader("content-type", "").startswith("text/event-stream") and b"event: error" in payload:
+            return status, elapsed, "SSE error event"
+
+        if endpoint.cleanup:
+            job_id = json.loads(payload).get("job_id")
+            if job_id:
+                conn.request("POST", f"/cleanup/{job_id}")
+                conn.getresponse().read()
+        return status, elapsed, None
+    except Exception as e:
+        return 0, time.perf_counter() - started, type(e).__name__
+    finally:
+        conn.close()
+
+
+# ----------------------------------------------------------------------
+# Stages
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    # Nearest rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100.0 * len(ordered)) - 1)]
+
+
+def run_stage(
+    base_url: str,
+    endpoint: Endpoint,
+    kind: str,
+    level: float,
+    duration: float,
+    max_requests: Optional[int],
+    arrival: str,
+    timeout: float,
+    pid: Optional[int],
+) -> Dict[str, Any]:
+    results: List[Tuple[int, float, Optional[str]]] = []
+    lock = threading.Lock()
+    sent = [0]
+
+    def claim() -> bool:
+        with lock:
+            if max_requests is not None and sent[0] >= max_requests:
+                return False
+            sent[0] += 1
+            return True
+
+    def record(result):
+        with lock:
+            results.append(result)
+
+    with RssSampler(pid) as rss:
+        started = time.perf_counter()
+        stop_at = started + duration
+
+        if kind == "concurrency":
+            def client():
+                while time.perf_counter() < stop_at and claim():
+                    record(send(base_url, endpoint, timeout))
+
+            threads = [threading.Thread(target=client) for _ in range(int(level))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            # Open loop: latency is measured from the scheduled arrival, so
+            # time spent waiting for a free client thread counts against the
+            # service instead of hiding queueing (coordinated omission)
+            def timed(scheduled: float):
+                status, _, error = send(base_url, endpoint, timeout)
+                record((status, time.perf_counter() - scheduled, error))
+
+            with ThreadPoolExecutor(max_workers=256) as pool:
+                next_arrival = started
+                while next_arrival < stop_at and claim():
+                    delay = next_arrival - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    pool.submit(timed, next_arrival)
+                    gap = random.expovariate(level) if arrival == "poisson" else 1.0 / level
+                    next_arrival += gap
+
+        elapsed = time.perf_counter() - started
+
+    ok = [seconds for _, seconds, error in results if error is None]
+    errors: Dict[str, int] = {}
+    for _, _, error in results:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+
+    return {
+        "endpoint": endpoint.name,
+        "profile": f"{kind}={level:g}" + ("/s" if kind == "rate" else ""),
+        "requests": len(results),
+        "ok": len(ok),
+        "error_rate": (len(results) - len(ok)) / len(results) if results else 0.0,
+        "errors": errors,
+        "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+        "p50_ms": _ms(percentile(ok, 50)),
+        "p95_ms": _ms(percentile(ok, 95)),
+        "p99_ms": _ms(percentile(ok, 99)),
+        "peak_rss_mb": rss.peak_mb,
+        "seconds": elapsed,
+    }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return seconds * 1000 if seconds is not None else None
+
+
+def print_report(rows: List[Dict[str, Any]]):
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else "-"
+
+    print()
+    print(f"{'endpoint':<18}{'profile':<16}{'reqs':>6}{'ok':>6}{'err%':>7}{'req/s':>8}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak RSS':>10}")
+    for r in rows:
+        print(
+            f"{r['endpoint']:<18}{r['profile']:<16}{r['requests']:>6}{r['ok']:>6}"
+            f"{r['error_rate'] * 100:>6.1f}%{r['throughput_rps']:>8.2f}"
+            f"{fmt(r['p50_ms'], '.0f'):>10}{fmt(r['p95_ms'], '.0f'):>10}{fmt(r['p99_ms'], '.0f'):>10}"
+            f"{fmt(r['peak_rss_mb'], '.0f') + ' MB' if r['peak_rss_mb'] else '-':>10}"
+        )
+        if r["errors"]:
+            print("    errors: " + ", ".join(f"{k} x{v}" for k, v in sorted(r["errors"].items())))
+
+
+# ----------------------------------------------------------------------
+# Main
+
+
+def parse_profile(spec: str) -> Tuple[str, List[float]]:
+    kind, _, levels = spec.partition(":")
+    if kind not in ("concurrency", "rate") or not levels:
+        raise argparse.ArgumentTypeError("profile must look like concurrency:1,4,16 or rate:0.5,1,2")
+    return kind, [float(level) for level in levels.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Python workers")
+    parser.add_argument("target", choices=list(TARGETS))
+    parser.add_argument("--endpoints", help="comma-separated subset of the target's endpoints")
+    parser.add_argument("--profile", type=parse_profile, default=parse_profile("concurrency:1,4"))
+    parser.add_argument("--arrival", choices=["constant", "poisson"], default="constant")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per stage")
+    parser.add_argument("--requests", type=int, help="cap on requests per stage")
+    parser.add_argument("--timeout", type=float, default=600.0, help="per-request timeout")
+    parser.add_argument("--query", default="", help="extra query string for every request, e.g. format=flac")
+    parser.add_argument("--json", help="also write the results to this file")
+
+    audio = parser.add_argument_group("audio")
+    audio.add_argument("--audio", help="upload this file instead of a synthetic track")
+    audio.add_argument("--track-seconds", type=float, default=180.0)
+
+    worker = parser.add_argument_group("worker under test")
+    worker.add_argument("--url", help="use an already running worker instead of starting one")
+    worker.add_argument("--pid", type=int, help="pid of that worker, for peak RSS")
+    worker.add_argument("--port", type=int, help="port for the started worker")
+    worker.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    worker.add_argument("--real-separators", action="store_true", help="use Spleeter/Demucs instead of fakes")
+    worker.add_argument("--separator-seconds-per-minute", type=float, default=5.0)
+    worker.add_argument("--separator-mode", choices=["sleep", "cpu"], default="sleep")
+    worker.add_argument("--dedup", action="store_true", help="keep fingerprint reuse on (measures the cache)")
+
+    upstreams = parser.add_argument_group("upstream stand-ins")
+    upstreams.add_argument("--origin-port", type=int, default=9100)
+    upstreams.add_argument("--origin-latency-ms", type=float, default=0.0)
+    upstreams.add_argument("--origin-jitter-ms", type=float, default=0.0)
+    upstreams.add_argument("--origin-error-rate", type=float, default=0.0)
+    upstreams.add_argument("--gradio-url", help="use this Gradio server instead of starting the mock")
+    upstreams.add_argument("--gradio-port", type=int, default=7860)
+    upstreams.add_argument("--gradio-latency-ms", type=float, default=3000.0)
+    upstreams.add_argument("--gradio-jitter-ms", type=float, default=500.0)
+    upstreams.add_argument("--gradio-error-rate", type=float, default=0.0)
+    upstreams.add_argument("--gradio-concurrency", type=int, default=1)
+    args = parser.parse_args()
+
+    target = TARGETS[args.target]
+    names = args.endpoints.split(",") if args.endpoints else list(target["endpoints"])
+    unknown = [name for name in names if name not in target["endpoints"]]
+    if unknown:
+        parser.error(f"unknown endpoints for {args.target}: {', '.join(unknown)}")
+
+    if args.audio:
+        with open(args.audio, "rb") as f:
+            upload = f.read()
+    else:
+        upload = synth_track(args.track_seconds)
+
+    run_dir = tempfile.mkdtemp(prefix="loadtest-")
+    processes: List[subprocess.Popen] = []
+    python = sys.executable
+    audio_url = f"http://127.0.0.1:{args.origin_port}/audio/track.wav"
+
+    try:
+        env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join([target["dir"], LOADTEST_DIR, os.environ.get("PYTHONPATH", "")]),
+            STORAGE_ROOT=os.path.join(run_dir, "storage"),
+            FAKE_SEPARATOR_SECONDS_PER_MINUTE=str(args.separator_seconds_per_minute),
+            FAKE_SEPARATOR_MODE=args.separator_mode,
+            # Every request uploads the same track; without this all but the
+            # first would be answered from the fingerprint cache
+            FINGERPRINT_DISABLED="0" if args.dedup else "1",
+        )
+        os.makedirs(env["STORAGE_ROOT"])
+
+        if args.target == "analysis":
+            origin = start_process("origin", [
+                python, os.path.join(LOADTEST_DIR, "audio_origin.py"),
+                "--port", str(args.origin_port),
+                "--latency-ms", str(args.origin_latency_ms),
+                "--jitter-ms", str(args.origin_jitter_ms),
+                "--error-rate", str(args.origin_error_rate),
+                "--track-seconds", str(args.track_seconds),
+            ], LOADTEST_DIR, env, run_dir)
+            processes.append(origin)
+            wait_ready(f"http://127.0.0.1:{args.origin_port}/stats", origin)
+
+            if args.gradio_url:
+                env["MANSUBA_SPACE"] = args.gradio_url
+            else:
+                gradio = start_process("gradio", [
+                    python, os.path.join(LOADTEST_DIR, "mock_gradio.py"),
+                    "--port", str(args.gradio_port),
+                    "--latency-ms", str(args.gradio_latency_ms),
+                    "--jitter-ms", str(args.gradio_jitter_ms),
+                    "--error-rate", str(args.gradio_error_rate),
+                    "--concurrency", str(args.gradio_concurrency),
+                ], LOADTEST_DIR, env, run_dir)
+                processes.append(gradio)
+                env["MANSUBA_SPACE"] = f"http://127.0.0.1:{args.gradio_port}/"
+                wait_ready(env["MANSUBA_SPACE"], gradio)
+
+        if not args.real_separators:
+            env["SEPARATOR_CLASS"] = "fake_separators:FakeSpleeterSeparator"
+            env["AUDIO_ADAPTER_CLASS"] = "fake_separators:FakeAudioAdapter"
+            env["SEPARATION_ENTRYPOINT"] = os.path.join(LOADTEST_DIR, "fake_separators.py")
+
+        pid = args.pid
+        worker_process = None
+        if args.url:
+            base_url = args.url.rstrip("/")
+        else:
+            port = args.port or target["port"]
+            base_url = f"http://127.0.0.1:{port}"
+            worker_process = start_process(args.target, [
+                python, "-m", "uvicorn", target["app"],
+                "--host", "127.0.0.1", "--port", str(port),
+                "--workers", str(args.workers), "--log-level", "warning",
+            ], target["dir"], env, run_dir)
+            processes.append(worker_process)
+            pid = worker_process.pid
+        wait_ready(base_url + target["health"], worker_process, timeout=300)
+
+        kind, levels = args.profile
+        rows = []
+        for name in names:
+            path, body_kind, cleanup = target["endpoints"][name]
+            endpoint = Endpoint(name, path, body_kind, cleanup, upload, audio_url, args.query)
+            for level in levels:
+                print(f"[LOADTEST] {name}: {kind}={level:g} for {args.duration:.0f}s")
+                row = run_stage(base_url, endpoint, kind, level, args.duration, args.requests, args.arrival, args.timeout, pid)
+                rows.append(row)
+                print(
+                    f"[LOADTEST]   {row['ok']}/{row['requests']} ok, {row['throughput_rps']:.2f} req/s, "
+                    f"p95 {row['p95_ms'] or 0:.0f} ms"
+                )
+
+        print_report(rows)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"target": args.target, "stages": rows}, f, indent=2)
+            print(f"\nResults written to {args.json}")
+
+    finally:
+        for process in reversed(processes):
+            stop_process(process)
+        shutil.rmtree(os.path.join(run_dir, "storage"), ignore_errors=True)
+        print(f"[LOADTEST] Logs kept in {run_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Separation Profile Benchmark
+Measures quality (SDR) and speed of each Demucs profile on a synthetic mixture
+
+The mixture is built from four known sources (drums, bass, other, vocals), so
+the separated stems can be scored against ground truth without a dataset.
+
+`--untrained` builds the same architectures with random weights instead of
+downloading the pretrained ones. Inference costs the same, so the timings
+hold, but SDR is meaningless and not reported.
+
+Usage:
+    python bench_profiles.py --duration 30 --profiles fast,balanced,best
+    python bench_profiles.py --duration 30 --untrained
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from separation import (
+    SEPARATION_PROFILES,
+    configure_threads,
+    load_model,
+    prepare_model,
+    resolve_threads,
+    separate_tensor,
+)
+
+SAMPLE_RATE = 44100
+
+# Architecture of the released htdemucs (demucs/grids/mmi.py: depth 4,
+# dconv_mode 3, 5 transformer layers, no bottom channels, 7.8 s segments);
+# htdemucs_ft is a bag of four of them
+HTDEMUCS_SOURCES = ["drums", "bass", "other", "vocals"]
+HTDEMUCS_ARCH = {"dconv_mode": 3, "depth": 4, "t_layers": 5, "bottom_channels": 0, "segment": 7.8}
+BAG_SIZES = {"htdemucs": 1, "htdemucs_ft": 4}
+
+
+def synth_sources(duration: float, seed: int = 0) -> dict:
+    """Four stereo sources with the spectral character Demucs expects"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * SAMPLE_RATE)) / SAMPLE_RATE
+    beat = 60.0 / 120.0
+
+    # Drums: decaying noise bursts on every beat, kick thump on the downbeat
+    drums = np.zeros_like(t)
+    for onset in np.arange(0, duration, beat):
+        idx = int(onset * SAMPLE_RATE)
+        n = min(len(t) - idx, int(0.2 * SAMPLE_RATE))
+        env = np.exp(-np.arange(n) / (0.03 * SAMPLE_RATE))
+        drums[idx:idx + n] += 0.5 * rng.standard_normal(n) * env
+        drums[idx:idx + n] += 0.8 * np.sin(2 * np.pi * 55 * np.arange(n) / SAMPLE_RATE) * env
+
+    # Bass: root notes changing every bar
+    roots = [55.0, 41.2, 49.0, 36.7]
+    bar = np.floor(t / (4 * beat)).astype(int) % len(roots)
+    bass = 0.4 * np.sin(2 * np.pi * np.take(roots, bar) * t)
+
+    # Other: sustained triad pad
+    other = sum(0.12 * np.sin(2 * np.pi * f * t) for f in (261.6, 329.6, 392.0))
+
+    # Vocals: harmonic voice with vibrato and a phrase envelope
+    f0 = 220.0 * (1 + 0.01 * np.sin(2 * np.pi * 5.5 * t))
+    phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+    vocals = sum(0.2 / k * np.sin(k * phase) for k in range(1, 8))
+    vocals *= (np.sin(2 * np.pi * t / (2 * beat)) > -0.3)
+
+    def stereo(x, pan):
+        return np.stack([x * (1 - pan), x * (1 + pan)]).astype(np.float32)
+
+    return {
+        "drums": stereo(drums, 0.0),
+        "bass": stereo(bass, 0.0),
+        "other": stereo(other, -0.3),
+        "vocals": stereo(vocals, 0.1),
+    }
+
+
+def sdr(reference: np.ndarray, estimate: np.ndarray) -> float:
+    n = min(reference.shape[-1], estimate.shape[-1])
+    reference, estimate = reference[..., :n], estimate[..., :n]
+    noise = np.sum((reference - estimate) ** 2) + 1e-10
+    return float(10 * np.log10(np.sum(reference ** 2) / noise + 1e-10))
+
+
+def untrained_model(profile_name: str):
+    """The profile's model architecture with random weights (timing only)"""
+    import torch
+    from demucs.apply import BagOfModels
+    from demucs.htdemucs import HTDemucs
+
+    torch.manual_seed(0)
+    models = [
+        HTDemucs(HTDEMUCS_SOURCES, **HTDEMUCS_ARCH)
+        for _ in range(BAG_SIZES[SEPARATION_PROFILES[profile_name]["model"]])
+    ]
+    model = models[0] if len(models) == 1 else BagOfModels(models)
+    return prepare_model(model, profile_name)
+
+
+def bench_profile(profile_name: str, sources: dict, duration: float, untrained: bool = False) -> dict:
+    import torch
+
+    configure_threads(profile_name)
+    model = untrained_model(profile_name) if untrained else load_model(profile_name)
+    mix = torch.from_numpy(sum(sources.values()))
+
+    started = time.perf_counter()
+    estimates = separate_tensor(model, mix, profile_name)
+    elapsed = time.perf_counter() - started
+
+    scores = {} if untrained else {
+        name: sdr(sources[name], estimates[name].numpy())
+        for name in sources if name in estimates
+    }
+    return {
+        "profile": profile_name,
+        "threads": resolve_threads(profile_name)[0],
+        "seconds": elapsed,
+        "realtime_factor": duration / elapsed,
+        "sdr": scores,
+        "mean_sdr": float(np.mean(list(scores.values()))) if scores else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Demucs separation profiles")
+    parser.add_argument("--duration", type=float, default=30.0, help="mixture length in seconds")
+    parser.add_argument("--profiles", default=",".join(SEPARATION_PROFILES))
+    parser.add_argument("--untrained", action="store_true", help="random weights: timings only, no download")
+    args = parser.parse_args()
+
+    sources = synth_sources(args.duration)
+    results = [
+        bench_profile(name, sources, args.duration, args.untrained)
+        for name in args.profiles.split(",")
+    ]
+
+    baseline = next((r for r in results if r["profile"] == "balanced"), results[0])
+    print(f"{'profile':<10}{'threads':>8}{'seconds':>10}{'x realtime':>12}{'SDR dB':>9}{'vs ' + baseline['profile']:>16}")
+    for r in results:
+        speedup = baseline["seconds"] / r["seconds"]
+        if r["mean_sdr"] is None:
+            print(
+                f"{r['profile']:<10}{r['threads']:>8}{r['seconds']:>10.1f}{r['realtime_factor']:>12.2f}"
+                f"{'n/a':>9}{'':>11} {speedup:>4.1f}x"
+            )
+            continue
+        delta_sdr = r["mean_sdr"] - baseline["mean_sdr"]
+        print(
+            f"{r['profile']:<10}{r['threads']:>8}{r['seconds']:>10.1f}{r['realtime_factor']:>12.2f}"
+            f"{r['mean_sdr']:>9.2f}{delta_sdr:>+8.2f} dB {speedup:>4.1f}x"
+        )
+        print("          " + "  ".join(f"{k} {v:.2f}" for k, v in r["sdr"].items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+"""
+Acoustic Fingerprint Index
+Recognizes the same recording across re-encodes (MP3/OGG/WAV bounce), sample
+rates, gain changes and trims. Earlier analysis and stems are reused only for
+a copy of the same master with the same start and length; trims and other
+versions of the song are recognized but analyzed afresh
+
+Fingerprint: one 32-bit code per 100 ms frame of the decoded mono signal.
+- 12 bits: which chroma bins rose since the previous frame
+- 12 bits: which chroma bins are louder than their neighbour (harmony shape)
+- 8 bits: onset pattern, whether each band's energy rose more than the band
+  above it
+Codes are compared at the best alignment by bit error rate, so trimmed and
+lossy copies still score well above unrelated tracks.
+
+Lookup: MinHash over pairs of harmony patterns half a second apart, split into
+LSH bands stored in an indexed SQLite table. A lookup reads a bounded number
+of rows per band (the newest tracks in each bucket) whatever the index size,
+then verifies the top candidates.
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import scipy.fft
+
+HOP_SECONDS = 0.1
+WINDOW_SECONDS = 0.2
+CHROMA_RANGE_HZ = (80.0, 5000.0)
+ONSET_BAND_EDGES_HZ = np.geomspace(60.0, 5500.0, 10)  # 9 bands -> 8 bits
+PAIR_GAP_FRAMES = 5
+FRAMES_PER_CHUNK = 256
+
+# Every feature above sits below 5.5 kHz, so an upload decoded only to be
+# identified is decoded at this rate; its codes match a native-rate
+# fingerprint of the same file (similarity 1.0 on a 44.1 kHz track)
+FINGERPRINT_SAMPLE_RATE = 22050
+
+# MinHash LSH: 20 bands of 3 rows. A pair set with Jaccard 0.5 (a lossy,
+# trimmed copy) lands in at least one shared bucket ~93% of the time; one at
+# 0.1 (an unrelated track in the same key) ~2%.
+LSH_BANDS = 20
+LSH_ROWS = 3
+# Tracks read per bucket, newest first; a crowded bucket drops its oldest
+# entries, and a real match still shares most of the other bands
+ROWS_PER_BUCKET = 64
+MAX_CANDIDATES = 3
+
+# Similarity is 1 - 2 * bit error rate at the best alignment: identical
+# copies score ~1.0, lossy and trimmed copies 0.7-0.99, unrelated tracks <0.1
+DEFAULT_THRESHOLD = float(os.environ.get("FINGERPRINT_THRESHOLD", "0.4"))
+
+# The aligned overlap must cover this share of the longer recording for a
+# lookup to report a match at all
+MIN_OVERLAP = 0.5
+
+# Analysis and stems are only reused when the upload lines up with the stored
+# recording end to end; a trimmed clip has its own duration, loudness and
+# stems, so it is analyzed afresh
+REUSE_ALIGNMENT_SECONDS = 1.0
+
+# ...and only for a copy of the same master. A 64 kbps mono MP3 still scores
+# ~0.9 (lower bitrates fall under and are processed afresh), while a mix
+# against its own instrumental or a cappella scores 0.3-0.55, often over
+# DEFAULT_THRESHOLD; such versions never inherit the mix's results
+REUSE_THRESHOLD = float(os.environ.get("FINGERPRINT_REUSE_THRESHOLD", "0.8"))
+
+_rng = np.random.default_rng(0x5EED)
+_HASH_A = (_rng.integers(1, 2 ** 63, size=(LSH_BANDS * LSH_ROWS, 1), dtype=np.uint64) << np.uint64(1)) | np.uint64(1)
+_HASH_B = _rng.integers(0, 2 ** 63, size=(LSH_BANDS * LSH_ROWS, 1), dtype=np.uint64)
+_BAND_MIX = _rng.integers(1, 2 ** 63, size=LSH_ROWS + 1, dtype=np.uint64) | np.uint64(1)
+
+_filter_cache: Dict[Tuple[int, int], Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+
+
+def _filters(sample_rate: int, n_fft: int):
+    """Chroma and onset-band weights for an rfft of n_fft samples (cached)"""
+    key = (sample_rate, n_fft)
+    if key not in _filter_cache:
+        import librosa
+
+        freqs = np.fft.rfftfreq(n_fft, 1.0 / sample_rate)
+        chroma = librosa.filters.chroma(sr=sample_rate, n_fft=n_fft).astype(np.float32)
+        chroma[:, (freqs < CHROMA_RANGE_HZ[0]) | (freqs > CHROMA_RANGE_HZ[1])] = 0.0
+
+        bands = np.zeros((len(ONSET_BAND_EDGES_HZ) - 1, len(freqs)), dtype=np.float32)
+        for b in range(len(bands)):
+            bands[b, (freqs >= ONSET_BAND_EDGES_HZ[b]) & (freqs < ONSET_BAND_EDGES_HZ[b + 1])] = 1.0
+
+        _filter_cache[key] = (chroma.T.copy(), bands.T.copy(), np.hanning(n_fft).astype(np.float32))
+    return _filter_cache[key]
+
+
+@dataclass
+class Fingerprint:
+    codes: np.ndarray   # uint32 per frame
+    active: np.ndarray  # bool per frame, False for near-silence
+    duration: float
+
+    def pair_keys(self, active_only: bool = False) -> np.ndarray:
+        """Harmony pattern at t and t + 0.5 s packed into one 24-bit key"""
+        harmony = ((self.codes >> np.uint32(12)) & np.uint32(0xFFF)).astype(np.uint64)
+        keys = (harmony[:-PAIR_GAP_FRAMES] << np.uint64(12)) | harmony[PAIR_GAP_FRAMES:]
+        if active_only:
+            keys = keys[self.active[:-PAIR_GAP_FRAMES] & self.active[PAIR_GAP_FRAMES:]]
+        return keys
+
+    def band_keys(self) -> List[int]:
+        """LSH bucket ids (signed 63-bit, for SQLite) from a MinHash signature"""
+        keys = np.unique(self.pair_keys(active_only=True))
+        if len(keys) == 0:
+            return []
+        with np.errstate(over="ignore"):
+            signature = ((_HASH_A * keys[None, :] + _HASH_B) >> np.uint64(32)).min(axis=1)
+            rows = signature.reshape(LSH_BANDS, LSH_ROWS)
+            mixed = (rows * _BAND_MIX[:LSH_ROWS]).sum(axis=1) + np.arange(LSH_BANDS, dtype=np.uint64) * _BAND_MIX[-1]
+        return [int(key >> np.uint64(1)) for key in mixed]
+
+
+def compute_fingerprint(y: np.ndarray, sr: int) -> Fingerprint:
+    """Fingerprint a decoded mono signal at its native sample rate"""
+    n_fft = int(round(WINDOW_SECONDS * sr))
+    hop = int(round(HOP_SECONDS * sr))
+    chroma_fb, band_fb, window = _filters(sr, n_fft)
+
+    y = np.asarray(y, dtype=np.float32)
+    duration = len(y) / sr
+    if len(y) < n_fft + hop:
+        y = np.pad(y, (0, n_fft + hop - len(y)))
+    frames = np.lib.stride_tricks.sliding_window_view(y, n_fft)[::hop]
+
+    chroma, bands = [], []
+    for start in range(0, len(frames), FRAMES_PER_CHUNK):
+        power = np.abs(scipy.fft.rfft(frames[start:start + FRAMES_PER_CHUNK] * window, axis=1)) ** 2
+        chroma.append(power @ chroma_fb)
+        bands.append(power @ band_fb)
+    chroma = np.vstack(chroma)
+    bands = np.vstack(bands)
+
+    chroma /= chroma.max(axis=1, keepdims=True) + 1e-12
+    flux = np.diff(np.log(bands + 1e-10), axis=0)
+    bits = np.hstack([
+        chroma[1:] > chroma[:-1],
+        chroma[1:] > np.roll(chroma[1:], -1, axis=1),
+        flux[:, :-1] > flux[:, 1:],
+    ]).astype(np.uint32)
+    codes = (bits << np.arange(32, dtype=np.uint32)).sum(axis=1, dtype=np.uint32)
+
+    energy = bands.sum(axis=1)[1:]
+    active = energy > energy.max() * 1e-6 if len(energy) else np.zeros(0, dtype=bool)
+    return Fingerprint(codes=codes, active=active, duration=duration)
+
+
+def _bit_error_rate(a: np.ndarray, b: np.ndarray, offset: int) -> Tuple[float, int]:
+    """BER of a[i] against b[i + offset] over their overlap, and its length"""
+    if offset >= 0:
+        a, b = a, b[offset:]
+    else:
+        a, b = a[-offset:], b
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0.5, 0
+    return float(np.unpackbits((a[:n] ^ b[:n]).view(np.uint8)).mean()), n
+
+
+def compare(query: Fingerprint, candidate_codes: np.ndarray) -> Tuple[float, int, int]:
+    """
+    Best alignment of two fingerprints
+
+    Offsets are voted on by shared pair keys, then the top few are scored by
+    bit error rate.
+
+    Returns:
+        (similarity, offset in frames of the query within the candidate, overlap frames)
+    """
+    candidate = Fingerprint(candidate_codes, np.ones(len(candidate_codes), dtype=bool), 0.0)
+    positions: Dict[int, List[int]] = {}
+    for position, key in enumerate(candidate.pair_keys().tolist()):
+        slots = positions.setdefault(key, [])
+        if len(slots) < 8:
+            slots.append(position)
+
+    votes = Counter()
+    for position, key in enumerate(query.pair_keys().tolist()):
+        for match in positions.get(key, ()):
+            votes[match - position] += 1
+    offsets = {0}
+    for offset, _ in votes.most_common(3):
+        offsets.update((offset - 1, offset, offset + 1))
+
+    best = (0.0, 0, 0)
+    for offset in offsets:
+        ber, overlap = _bit_error_rate(query.codes, candidate_codes, offset)
+        similarity = max(0.0, 1.0 - 2.0 * ber)
+        if overlap and similarity > best[0]:
+            best = (similarity, offset, overlap)
+    return best
+
+
+@dataclass
+class Match:
+    track_id: int
+    similarity: float
+    offset_seconds: float
+    duration: float
+    analysis: Optional[Dict[str, Any]]
+
+    def aligned_with(self, fingerprint: Fingerprint) -> bool:
+        """Same start and length as the stored recording"""
+        return (
+            abs(self.offset_seconds) <= REUSE_ALIGNMENT_SECONDS
+            and abs(self.duration - fingerprint.duration) <= REUSE_ALIGNMENT_SECONDS
+        )
+
+    def reusable(self, fingerprint: Fingerprint) -> bool:
+        """Same master, start and length as the stored recording (so its analysis and stems stand in)"""
+        return self.similarity >= REUSE_THRESHOLD and self.aligned_with(fingerprint)
+
+    def describe(self, analysis: bool = False, stems: bool = False) -> Dict[str, Any]:
+        """Response flag for reused results"""
+        return {
+            "reused": analysis or stems,
+            "reusedAnalysis": analysis,
+            "reusedStems": stems,
+            "trackId": self.track_id,
+            "similarity": round(self.similarity, 3),
+            "offsetSeconds": round(self.offset_seconds, 2),
+            "sourceDuration": round(self.duration, 2),
+        }
+
+
+class FingerprintIndex:
+    """
+    SQLite-backed fingerprint store with cached analysis and stems
+
+    - tracks: codes, duration and the analysis result of each recording
+    - bands: LSH bucket -> track, the only table a lookup scans (indexed)
+    - stems: stem files per track and variant (profile/format), hard-linked
+      into a cache directory so they outlive the job that produced them;
+      least recently used variants are evicted past the cache budget
+    """
+
+    def __init__(
+        self,
+        root: Optional[str] = None,
+        threshold: float = DEFAULT_THRESHOLD,
+        stem_cache_bytes: Optional[int] = None,
+    ):
+        env = os.environ.get
+        self.root = root or env("FINGERPRINT_DIR") or os.path.join(
+            env("STORAGE_ROOT") or tempfile.gettempdir(), "fingerprints"
+        )
+        self.threshold = threshold
+        self.stem_cache_bytes = stem_cache_bytes or int(float(env("FINGERPRINT_STEM_CACHE_GB", "10")) * 1024 ** 3)
+        self.stems_root = os.path.join(self.root, "stems")
+        os.makedirs(self.stems_root, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.root, "index.sqlite3"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                id INTEGER PRIMARY KEY,
+                duration REAL NOT NULL,
+                codes BLOB NOT NULL,
+                analysis TEXT,
+                created_at REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS bands (
+                key INTEGER NOT NULL,
+                track_id INTEGER NOT NULL
+            );
+            DROP INDEX IF EXISTS bands_key;
+            CREATE INDEX IF NOT EXISTS bands_key_track ON bands (key, track_id);
+            CREATE TABLE IF NOT EXISTS stems (
+                track_id INTEGER NOT NULL,
+                variant TEXT NOT NULL,
+                result TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (track_id, variant)
+            );
+        """)
+        self._counters = {"lookups": 0, "hits": 0, "stem_hits": 0, "added": 0, "stems_evicted": 0}
+
+    # ------------------------------------------------------------------
+    # Lookup
+
+    def lookup(self, fingerprint: Fingerprint) -> Optional[Match]:
+        """Best stored recording above the similarity threshold, if any"""
+        band_keys = fingerprint.band_keys()
+        with self._lock:
+            self._counters["lookups"] += 1
+            hits = Counter()
+            for key in band_keys:
+                for (track_id,) in self._db.execute(
+                    "SELECT track_id FROM bands WHERE key = ? ORDER BY track_id DESC LIMIT ?",
+                    (key, ROWS_PER_BUCKET),
+                ):
+                    hits[track_id] += 1
+
+            best: Optional[Match] = None
+            for track_id, _ in hits.most_common(MAX_CANDIDATES):
+                row = self._db.execute(
+                    "SELECT codes, duration, analysis FROM tracks WHERE id = ?", (track_id,)
+                ).fetchone()
+                if row is None:
+                    continue
+                codes = np.frombuffer(row[0], dtype="<u4").astype(np.uint32)
+                similarity, offset, overlap = compare(fingerprint, codes)
+                if similarity < self.threshold:
+                    continue
+                if overlap < MIN_OVERLAP * max(len(codes), len(fingerprint.codes)):
+                    continue
+                if best is None or similarity > best.similarity:
+                    best = Match(
+                        track_id=track_id,
+                        similarity=similarity,
+                        offset_seconds=offset * HOP_SECONDS,
+                        duration=row[1],
+                        analysis=json.loads(row[2]) if row[2] else None,
+                    )
+
+            if best is not None:
+                self._counters["hits"] += 1
+                self._db.execute("UPDATE tracks SET hits = hits + 1 WHERE id = ?", (best.track_id,))
+                self._db.commit()
+            return best
+
+    # ------------------------------------------------------------------
+    # Recording results
+
+    def add(self, fingerprint: Fingerprint, analysis: Optional[Dict[str, Any]] = None) -> int:
+        """Store a new recording and return its track id"""
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO tracks (duration, codes, analysis, created_at) VALUES (?, ?, ?, ?)",
+                (
+                    fingerprint.duration,
+                    fingerprint.codes.astype("<u4").tobytes(),
+                    json.dumps(analysis) if analysis is not None else None,
+                    time.time(),
+                ),
+            )
+            track_id = cursor.lastrowid
+            self._db.executemany(
+                "INSERT INTO bands (key, track_id) VALUES (?, ?)",
+                [(key, track_id) for key in fingerprint.band_keys()],
+            )
+            self._db.commit()
+            self._counters["added"] += 1
+            return track_id
+
+    def set_analysis(self, track_id: int, analysis: Dict[str, Any]):
+        with self._lock:
+            self._db.execute("UPDATE tracks SET analysis = ? WHERE id = ?", (json.dumps(analysis), track_id))
+            self._db.commit()
+
+    # ------------------------------------------------------------------
+    # Stems
+
+    def _variant_dir(self, track_id: int, variant: str) -> str:
+        return os.path.join(self.stems_root, str(track_id), variant.replace("/", "-"))
+
+    def put_stems(self, track_id: int, variant: str, stems: Dict[str, Dict[str, Any]]):
+        """
+        Keep a separation's stem files and descriptions for later reuse
+
+        `stems` is the response's stem map; each entry's "path" is linked
+        into the cache and stored relative to it.
+        """
+        cache_dir = self._variant_dir(track_id, variant)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir)
+
+        stored, size = {}, 0
+        for name, stem in stems.items():
+            target = os.path.join(cache_dir, os.path.basename(stem["path"]))
+            _link_or_copy(stem["path"], target)
+            size += os.path.getsize(target)
+            stored[name] = {**stem, "path": os.path.basename(target)}
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO stems (track_id, variant, result, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (track_id, variant, json.dumps(stored), size, time.time()),
+            )
+            self._db.commit()
+        self._evict_stems()
+
+    def get_stems(self, track_id: int, variant: str, target_dir: str) -> Optional[Dict[str, Dict[str, Any]]]:
+        """
+        Link a cached variant's stems into `target_dir`
+
+        Returns the stem map with paths inside target_dir, or None if the
+        variant is not cached (or its files have gone).
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result FROM stems WHERE track_id = ? AND variant = ?", (track_id, variant)
+            ).fetchone()
+        if row is None:
+            return None
+
+        cache_dir = self._variant_dir(track_id, variant)
+        stems = json.loads(row[0])
+        os.makedirs(target_dir, exist_ok=True)
+        try:
+            for stem in stems.values():
+                target = os.path.join(target_dir, stem["path"])
+                _link_or_copy(os.path.join(cache_dir, stem["path"]), target)
+                stem["path"] = target
+        except FileNotFoundError:
+            with self._lock:
+                self._db.execute("DELETE FROM stems WHERE track_id = ? AND variant = ?", (track_id, variant))
+                self._db.commit()
+            return None
+
+        with self._lock:
+            self._counters["stem_hits"] += 1
+            self._db.execute(
+                "UPDATE stems SET last_used = ? WHERE track_id = ? AND variant = ?",
+                (time.time(), track_id, variant),
+            )
+            self._db.commit()
+        return stems
+
+    def _evict_stems(self):
+        with self._lock:
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM stems").fetchone()[0]
+            evicted = []
+            for track_id, variant, size in self._db.execute(
+                "SELECT track_id, variant, size FROM stems ORDER BY last_used"
+            ).fetchall():
+                if total <= self.stem_cache_bytes:
+                    break
+                evicted.append((track_id, variant))
+                total -= size
+            self._db.executemany("DELETE FROM stems WHERE track_id = ? AND variant = ?", evicted)
+            self._db.commit()
+            self._counters["stems_evicted"] += len(evicted)
+        for track_id, variant in evicted:
+            shutil.rmtree(self._variant_dir(track_id, variant), ignore_errors=True)
+
+    # ------------------------------------------------------------------
+    # Metrics
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            tracks = self._db.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+            variants, stem_bytes = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM stems"
+            ).fetchone()
+            return {
+                "root": self.root,
+                "tracks": tracks,
+                "stem_variants": variants,
+                "stem_cache_bytes": stem_bytes,
+                "stem_cache_budget_bytes": self.stem_cache_bytes,
+                "threshold": self.threshold,
+                "reuse_threshold": REUSE_THRESHOLD,
+                **self._counters,
+            }
+
+
+def _link_or_copy(source: str, target: str):
+    """Hard link when source and target share a filesystem, else copy"""
+    if os.path.exists(target):
+        os.unlink(target)
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if isinstance(e, FileNotFoundError):
+            raise
+        shutil.copy2(source, target)
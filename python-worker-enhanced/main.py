@@ -1,13 +1,50 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 import librosa
 import numpy as np
 import soundfile as sf
 import tempfile
 import os
-from typing import Dict, List, Any
+import asyncio
+import time
+from typing import Dict, Any, AsyncIterator, Iterator, Optional, Tuple
 import json
 
+from stem_delivery import STEM_FORMATS, encode_stems, encoder_available, iter_zip, list_stem_files
+from storage import StorageFull, StorageManager, estimate_separation_bytes
+from scheduling import (
+    CancelToken,
+    ClientDisconnected,
+    DeadlineExpired,
+    DeadlineScheduler,
+    request_deadline,
+    run_cancellable,
+)
+from loudness import measure_loudness
+from feature_export import (
+    FRAME_DTYPES,
+    FRAME_FORMATS,
+    FRAME_HOP_LENGTH,
+    MAX_SUMMARY_POINTS,
+    summarize_frames,
+    write_npz,
+)
+from fingerprint import FINGERPRINT_SAMPLE_RATE, Fingerprint, FingerprintIndex, Match, compute_fingerprint
+from admission import MB, MemoryBusy, MemoryGuard, MemoryTooLarge, PipelineCost, probe_audio
+from separation import (
+    DEFAULT_PROFILE,
+    SEPARATION_PROFILES,
+    SeparationFailed,
+    SeparationTimeout,
+    demucs_available,
+    run_profile,
+    stems_dir_for,
+    thread_budget,
+)
+
 app = FastAPI(title="NoCulture Enhanced Audio Analysis")
 
 # Enable CORS
@@ -19,6 +56,148 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Separation output directories are tracked and evicted after their TTL
+storage = StorageManager(prefix="demucs-")
+
+@app.on_event("startup")
+async def start_storage_janitor():
+    storage.start()
+
+@app.on_event("shutdown")
+async def stop_storage_janitor():
+    await storage.stop()
+
+# Default request deadlines in seconds; clients can tighten them with
+# X-Request-Timeout or X-Request-Deadline
+DEADLINES = {
+    "analyze": 120,
+    "separate": 330,
+    "analyze_separate": 420,
+}
+
+# Progressive analysis: the first estimate comes from a short excerpt
+EXCERPT_SECONDS = 10
+EXCERPT_SAMPLE_RATE = 22050
+
+# Analysis runs one job per core; separation has its own thread budget
+analysis_scheduler = DeadlineScheduler(os.cpu_count() or 4, name="analysis")
+
+# Acoustic fingerprints of past uploads; a re-encoded or resampled copy of the
+# same master, with the same start and length, reuses its analysis and stems
+fingerprints = FingerprintIndex()
+
+# FINGERPRINT_DISABLED=1 skips identification, so every upload is processed
+# afresh (load tests that send the same track over and over)
+FINGERPRINT_DISABLED = os.environ.get("FINGERPRINT_DISABLED", "0") == "1"
+
+NOT_REUSED = {"reused": False, "reusedAnalysis": False, "reusedStems": False}
+
+# Decoded audio and its working set are budgeted per request and in total
+# (MEMORY_BUDGET_MB, MEMORY_REQUEST_BUDGET_MB); uploads are sized from their
+# header before anything is decoded
+memory = MemoryGuard("enhanced", log_prefix="[WORKER]")
+
+# Traced peak of run_analysis on 2 and 6 minute 44.1 kHz tracks: ~48 MB plus
+# ~120 bytes per frame (STFTs, chroma, HPSS), plus the decoded channels
+ANALYSIS_COST = PipelineCost(fixed_bytes=48 * MB, frame_bytes=120, channel_frame_bytes=4)
+
+# Rates analysis drops to, in order, when a file is too long for the budget
+ANALYSIS_RATES = (22050, 16000)
+
+# Demucs child process: torch and weights, four stereo float32 sources plus
+# the overlap-add buffers per frame, and the input with its normalized copy.
+# Estimated from tensor shapes, not measured
+DEMUCS_COST = PipelineCost(fixed_bytes=640 * MB, frame_bytes=64, channel_frame_bytes=8)
+
+# /separate/stems: Demucs next to the mono decode used for fingerprinting
+SEPARATE_COST = PipelineCost(
+    fixed_bytes=DEMUCS_COST.fixed_bytes,
+    frame_bytes=DEMUCS_COST.frame_bytes + 4,
+    channel_frame_bytes=DEMUCS_COST.channel_frame_bytes,
+)
+
+# /analyze/separate: Demucs and the mix analysis, then the four stems decoded
+# and analyzed at once (~110 bytes per frame each, measured)
+ANALYZE_SEPARATE_COST = PipelineCost(
+    fixed_bytes=DEMUCS_COST.fixed_bytes + ANALYSIS_COST.fixed_bytes,
+    frame_bytes=4 * (110 + 12),
+    channel_frame_bytes=DEMUCS_COST.channel_frame_bytes + ANALYSIS_COST.channel_frame_bytes,
+)
+
+def identify(y: np.ndarray, sr: int) -> Tuple[Optional[Fingerprint], Optional[Match]]:
+    """Fingerprint a decoded mono signal and look it up in the index"""
+    if FINGERPRINT_DISABLED:
+        return None, None
+    try:
+        fingerprint = compute_fingerprint(y, sr)
+        match = fingerprints.lookup(fingerprint)
+    except Exception as e:
+        print(f"[WORKER] Fingerprint lookup failed: {e}")
+        return None, None
+    if match:
+        print(f"[WORKER] Matches track {match.track_id} (similarity {match.similarity:.2f})")
+    return fingerprint, match
+
+def remember(
+    fingerprint: Optional[Fingerprint],
+    match: Optional[Match],
+    analysis: Optional[Dict[str, Any]] = None
+) -> Optional[int]:
+    """Index a new recording, or attach fresh analysis to a copy of a stored one"""
+    if fingerprint is None:
+        return None
+    try:
+        if match is None or not match.reusable(fingerprint):
+            # A trimmed clip or another version of the song (an instrumental)
+            # has results of its own, so it is indexed as a recording of its own
+            return fingerprints.add(fingerprint, analysis)
+        if analysis is not None and match.analysis is None:
+            fingerprints.set_analysis(match.track_id, analysis)
+        return match.track_id
+    except Exception as e:
+        print(f"[WORKER] Fingerprint index update failed: {e}")
+        return None
+
+def check_format(format: str):
+    """400 for an unknown stem format, 503 when its encoder is not installed"""
+    if format not in STEM_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"format must be one of: {', '.join(STEM_FORMATS)}"
+        )
+    if not encoder_available(format):
+        raise HTTPException(
+            status_code=503,
+            detail=f"format={format} needs ffmpeg, which is not installed on this worker; use format=wav"
+        )
+
+def abandoned_response(e: Exception) -> HTTPException:
+    """HTTP error for work dropped because of a disconnect or deadline"""
+    if isinstance(e, ClientDisconnected):
+        return HTTPException(status_code=499, detail="Client closed request")
+    return HTTPException(status_code=504, detail=str(e))
+
+def memory_response(e: Exception) -> HTTPException:
+    """HTTP error for an upload the memory budget cannot take"""
+    if isinstance(e, MemoryBusy):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    return HTTPException(status_code=413, detail=str(e))
+
+def admission_info(plan, sr: int) -> Dict[str, Any]:
+    return {
+        "action": plan.action,
+        "sampleRate": int(sr),
+        "sourceSampleRate": plan.header.sample_rate,
+        "estimatedMb": round(plan.estimate_bytes / MB),
+    }
+
+def request_owner(request: Request) -> str:
+    """Who a work directory belongs to (caller-supplied id, else client IP)"""
+    owner = request.headers.get("x-owner-id")
+    if owner:
+        return owner
+    return request.client.host if request.client else "anonymous"
+
 # Load models (lazy loading for faster startup)
 genre_classifier = None
 quality_analyzer = None
@@ -52,7 +231,7 @@ async def root():
     return {
         "service": "NoCulture Enhanced Audio Analysis",
         "version": "1.0.0",
-        "endpoints": ["/health", "/analyze/enhanced", "/separate/stems"]
+        "endpoints": ["/health", "/analyze/enhanced", "/analyze/enhanced/stream", "/analyze/separate", "/separate/stems", "/separate/stems/{job_id}/archive", "/cleanup/{job_id}", "/storage", "/scheduler", "/fingerprints", "/memory"]
     }
 
 @app.get("/health")
@@ -64,7 +243,13 @@ async def health_check():
     }
 
 @app.post("/analyze/enhanced")
-async def analyze_enhanced(file: UploadFile = File(...)):
+async def analyze_enhanced(
+    request: Request,
+    file: UploadFile = File(...),
+    frames: Optional[str] = None,
+    frame_dtype: str = "float16",
+    summary_points: int = 0
+):
     """
     Comprehensive audio analysis including:
     - Audio features (tempo, key, energy, etc.)
@@ -72,7 +257,34 @@ async def analyze_enhanced(file: UploadFile = File(...)):
     - Instrument detection
     - Quality analysis
     - Virality prediction
+
+    `frames=npz` returns the frame-level series (RMS, spectral centroid,
+    rolloff, bandwidth, zero crossings, chroma, MFCC, beat times) as an NPZ
+    of `frame_dtype` arrays instead, with the JSON response inside it (see
+    feature_export). `summary_points` adds a `frameSummary` decimated to
+    that many points for waveform views.
+
+    Work stops if the client disconnects or the request deadline passes.
     """
+    if frames is not None and frames not in FRAME_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"frames must be one of: {', '.join(FRAME_FORMATS)}"
+        )
+    
+    if frame_dtype not in FRAME_DTYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"frame_dtype must be one of: {', '.join(FRAME_DTYPES)}"
+        )
+    
+    if not 0 <= summary_points <= MAX_SUMMARY_POINTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"summary_points must be between 0 and {MAX_SUMMARY_POINTS}"
+        )
+    
+    deadline = request_deadline(request, DEADLINES["analyze"])
     temp_path = None
     try:
         print(f"[WORKER] Received file: {file.filename}")
@@ -85,42 +297,75 @@ async def analyze_enhanced(file: UploadFile = File(...)):
         
         print(f"[WORKER] Saved to temp file: {temp_path}")
         
-        # Load audio with librosa
-        print("[WORKER] Loading audio with librosa...")
-        y, sr = librosa.load(temp_path, sr=None)
-        print(f"[WORKER] Audio loaded: {len(y)} samples at {sr} Hz")
-        
-        # Extract audio features
-        print("[WORKER] Extracting audio features...")
-        audio_features = extract_audio_features(y, sr)
-        
-        # Classify genre
-        print("[WORKER] Classifying genre...")
-        genre = classify_genre(y, sr, audio_features)
-        
-        # Detect instruments
-        print("[WORKER] Detecting instruments...")
-        instruments = detect_instruments(y, sr)
-        
-        # Analyze quality
-        print("[WORKER] Analyzing quality...")
-        quality = analyze_quality(y, sr)
-        
-        # Predict virality
-        print("[WORKER] Predicting virality...")
-        virality = predict_virality(audio_features, quality, genre)
+        # Long files are analyzed at a lower rate rather than exhausting memory
+        header = await run_in_threadpool(probe_audio, temp_path)
+        plan = memory.plan(header, ANALYSIS_COST, downsample_rates=ANALYSIS_RATES)
         
-        print("[WORKER] Analysis complete!")
+        async def analyze(token: CancelToken):
+            async with analysis_scheduler.slot(1, deadline), memory.reserve(plan):
+                with memory.track(f"analyze {file.filename}", plan):
+                    # Load audio with librosa
+                    print("[WORKER] Loading audio with librosa...")
+                    y_multi, sr = await run_in_threadpool(librosa.load, temp_path, sr=plan.sample_rate, mono=False)
+                    y = librosa.to_mono(y_multi)
+                    print(f"[WORKER] Audio loaded: {len(y)} samples at {sr} Hz")
+                    
+                    # Frame series are extracted once and shared with the analysis
+                    series = None
+                    if frames or summary_points:
+                        series = await run_in_threadpool(extract_frame_series, y, sr)
+                    
+                    fingerprint, match = await run_in_threadpool(identify, y, sr)
+                    if match and match.analysis and match.reusable(fingerprint):
+                        analysis = {**match.analysis, "dedup": match.describe(analysis=True)}
+                    else:
+                        analysis = await run_in_threadpool(run_analysis, y, sr, token, y_multi, series)
+                        await run_in_threadpool(remember, fingerprint, match, analysis)
+                        analysis = {**analysis, "dedup": NOT_REUSED}
+                    
+                    if summary_points:
+                        analysis["frameSummary"] = await run_in_threadpool(
+                            summarize_frames, y, sr, series, summary_points
+                        )
+                    return analysis, series, sr
         
-        return {
+        analysis, series, sr = await run_cancellable(request, analyze, deadline)
+        result = {
             "success": True,
-            "audioFeatures": audio_features,
-            "genre": genre,
-            "instruments": instruments,
-            "quality": quality,
-            "virality": virality
+            **analysis,
+            "admission": admission_info(plan, sr)
         }
         
+        if frames:
+            # Long tracks export tens of MB; written to disk and streamed from
+            # there rather than held in memory next to the series
+            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{frames}") as export_file:
+                export_path = export_file.name
+                try:
+                    await run_in_threadpool(
+                        write_npz, export_file, series, sr, FRAME_HOP_LENGTH, frame_dtype, {"analysis": result}
+                    )
+                except BaseException:
+                    os.unlink(export_path)
+                    raise
+            print(f"[WORKER] Exported frame features: {os.path.getsize(export_path)} bytes ({frame_dtype})")
+            return FileResponse(
+                export_path,
+                media_type=FRAME_FORMATS[frames],
+                filename=f"frames.{frames}",
+                background=BackgroundTask(os.unlink, export_path)
+            )
+        
+        return result
+    
+    except (ClientDisconnected, DeadlineExpired) as e:
+        print(f"[WORKER] Analysis abandoned: {str(e)}")
+        raise abandoned_response(e)
+    
+    except (MemoryTooLarge, MemoryBusy) as e:
+        print(f"[WORKER] Analysis not admitted: {str(e)}")
+        raise memory_response(e)
+        
     except Exception as e:
         print(f"[WORKER] Error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -134,28 +379,250 @@ async def analyze_enhanced(file: UploadFile = File(...)):
             except:
                 pass
 
-def extract_audio_features(y: np.ndarray, sr: int) -> Dict[str, Any]:
-    """Extract comprehensive audio features using librosa"""
+@app.post("/analyze/enhanced/stream")
+async def analyze_enhanced_stream(request: Request, file: UploadFile = File(...)):
+    """
+    Progressive version of /analyze/enhanced over server-sent events
+
+    Emits one event per section as soon as it is ready:
+    - audioFeatures (estimate: true) from a short excerpt, within a second
+    - audioFeatures, genre, instruments, quality, virality for the full track
+    - done, or error if the analysis fails or the deadline passes
+
+    Each event's data holds the section under its own key, matching the
+    /analyze/enhanced response, plus `estimate` and `elapsedMs`. Sections
+    replayed from a fingerprint match carry `reused: true`. Uploads too long
+    for the memory budget even downsampled get a 413 before streaming starts,
+    and uploads that cannot be probed a 500; the upload is removed either way.
+
+    The excerpt estimate is sent before the full analysis queues for a CPU
+    slot and its memory reservation, so it is not held up by other jobs. Any
+    later failure, including memory staying busy past MEMORY_QUEUE_TIMEOUT,
+    arrives after the 200 as an `error` event. Its data carries `status`
+    (503 for busy memory, 504 for a passed deadline, 500 otherwise) and, for
+    503, `retryAfter` in seconds.
+    """
+    deadline = request_deadline(request, DEADLINES["analyze"])
+    temp_path = None
+    streaming = False
+    try:
+        print(f"[WORKER] Received file for streaming analysis: {file.filename}")
+        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename or "")[1] or '.wav') as temp_file:
+            temp_file.write(await file.read())
+            temp_path = temp_file.name
+        
+        header = await run_in_threadpool(probe_audio, temp_path)
+        plan = memory.plan(header, ANALYSIS_COST, downsample_rates=ANALYSIS_RATES)
+        
+        # From here the stream owns the temp file and removes it when it ends
+        response = StreamingResponse(
+            stream_analysis(temp_path, file.filename, plan, deadline),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+        streaming = True
+        return response
+    
+    except (MemoryTooLarge, MemoryBusy) as e:
+        print(f"[WORKER] Streaming analysis not admitted: {str(e)}")
+        raise memory_response(e)
     
-    # Tempo and beat tracking
-    tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
+    except Exception as e:
+        print(f"[WORKER] Streaming analysis error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
     
-    # Spectral features
-    spectral_centroids = librosa.feature.spectral_centroid(y=y, sr=sr)[0]
-    spectral_rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr)[0]
-    spectral_bandwidth = librosa.feature.spectral_bandwidth(y=y, sr=sr)[0]
+    finally:
+        if not streaming and temp_path and os.path.exists(temp_path):
+            try:
+                os.unlink(temp_path)
+                print("[WORKER] Cleaned up temp file")
+            except:
+                pass
+
+async def stream_analysis(temp_path: str, filename: Optional[str], plan, deadline: float) -> AsyncIterator[str]:
+    """SSE events of /analyze/enhanced/stream; removes the upload when done"""
+    token = CancelToken()
+    started = time.monotonic()
     
-    # Chroma features (for key detection)
-    chroma = librosa.feature.chroma_stft(y=y, sr=sr)
+    def elapsed_ms() -> int:
+        return int((time.monotonic() - started) * 1000)
     
-    # MFCC (Mel-frequency cepstral coefficients)
-    mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
+    try:
+        # A small excerpt only; sent before queueing behind full analyses
+        estimate = await run_in_threadpool(quick_estimate, temp_path)
+        yield sse_event("audioFeatures", {"estimate": True, "elapsedMs": elapsed_ms(), **estimate})
+        
+        async with analysis_scheduler.slot(1, deadline), memory.reserve(plan):
+            with memory.track(f"stream {filename}", plan):
+                y_multi, sr = await run_in_threadpool(librosa.load, temp_path, sr=plan.sample_rate, mono=False)
+                y = librosa.to_mono(y_multi)
+                
+                fingerprint, match = await run_in_threadpool(identify, y, sr)
+                if match and match.analysis and match.reusable(fingerprint):
+                    for section, result in match.analysis.items():
+                        yield sse_event(section, {"estimate": False, "reused": True, "elapsedMs": elapsed_ms(), section: result})
+                    dedup = match.describe(analysis=True)
+                else:
+                    analysis = {}
+                    async for section, result in iterate_in_threadpool(iter_analysis(y, sr, token, y_multi)):
+                        analysis[section] = result
+                        yield sse_event(section, {"estimate": False, "elapsedMs": elapsed_ms(), section: result})
+                        if time.monotonic() >= deadline:
+                            raise DeadlineExpired("Request deadline exceeded")
+                    await run_in_threadpool(remember, fingerprint, match, analysis)
+                    dedup = NOT_REUSED
+        
+        yield sse_event("done", {
+            "success": True,
+            "elapsedMs": elapsed_ms(),
+            "dedup": dedup,
+            "admission": admission_info(plan, sr),
+        })
     
-    # Zero crossing rate
-    zcr = librosa.feature.zero_crossing_rate(y)[0]
+    except Exception as e:
+        print(f"[WORKER] Streaming analysis error: {str(e)}")
+        error = {"detail": str(e), "elapsedMs": elapsed_ms(), "status": 500}
+        if isinstance(e, MemoryBusy):
+            error.update(status=503, retryAfter=e.retry_after)
+        elif isinstance(e, DeadlineExpired):
+            error["status"] = 504
+        yield sse_event("error", error)
+    
+    finally:
+        # Runs on completion and when the client disconnects mid-stream
+        token.cancel()
+        if os.path.exists(temp_path):
+            try:
+                os.unlink(temp_path)
+            except:
+                pass
+
+def iter_analysis(
+    y: np.ndarray,
+    sr: int,
+    token: Optional[CancelToken] = None,
+    y_multi: Optional[np.ndarray] = None,
+    series: Optional[Dict[str, np.ndarray]] = None
+) -> Iterator[Tuple[str, Any]]:
+    """
+    Run the five analysis stages over a decoded mono signal, yielding
+    (section, result) as each one finishes
+
+    `y_multi`, the (channels, samples) signal, is only used for loudness
+    metering. `series` reuses frame features already extracted for export.
+    A cancelled token stops the pipeline between stages.
+    """
+    token = token or CancelToken()
+    
+    # Extract audio features
+    print("[WORKER] Extracting audio features...")
+    audio_features = extract_audio_features(y, sr, series)
+    yield "audioFeatures", audio_features
+    token.check()
+    
+    # Classify genre
+    print("[WORKER] Classifying genre...")
+    genre = classify_genre(y, sr, audio_features)
+    yield "genre", genre
+    
+    # Detect instruments
+    print("[WORKER] Detecting instruments...")
+    instruments = detect_instruments(y, sr)
+    yield "instruments", instruments
+    token.check()
+    
+    # Analyze quality
+    print("[WORKER] Analyzing quality...")
+    quality = analyze_quality(y, sr, y_multi)
+    yield "quality", quality
+    token.check()
+    
+    # Predict virality
+    print("[WORKER] Predicting virality...")
+    virality = predict_virality(audio_features, quality, genre)
+    yield "virality", virality
+    
+    print("[WORKER] Analysis complete!")
+
+def run_analysis(
+    y: np.ndarray,
+    sr: int,
+    token: Optional[CancelToken] = None,
+    y_multi: Optional[np.ndarray] = None,
+    series: Optional[Dict[str, np.ndarray]] = None
+) -> Dict[str, Any]:
+    """Run every analysis stage and collect the sections into one result"""
+    return dict(iter_analysis(y, sr, token, y_multi, series))
+
+def quick_estimate(path: str) -> Dict[str, Any]:
+    """
+    Audio features from a short, downsampled excerpt of the track
+
+    Only EXCERPT_SECONDS are decoded (from a third of the way in, past most
+    intros), so this lands well before the full-track analysis.
+    """
+    try:
+        info = sf.info(path)
+        total_duration, sample_rate = float(info.duration), int(info.samplerate)
+    except Exception:
+        total_duration, sample_rate = float(librosa.get_duration(path=path)), None
     
-    # RMS energy
-    rms = librosa.feature.rms(y=y)[0]
+    offset = max(0.0, min(total_duration / 3, total_duration - EXCERPT_SECONDS))
+    y, sr = librosa.load(path, sr=EXCERPT_SAMPLE_RATE, offset=offset, duration=EXCERPT_SECONDS)
+    
+    features = extract_audio_features(y, sr)
+    features["duration"] = total_duration
+    if sample_rate:
+        features["sampleRate"] = sample_rate
+    
+    return {
+        "audioFeatures": features,
+        "excerpt": {"offset": offset, "duration": float(len(y) / sr)}
+    }
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def extract_frame_series(y: np.ndarray, sr: int) -> Dict[str, np.ndarray]:
+    """Frame-level features behind the audio feature means (see feature_export)"""
+    # Tempo and beat tracking
+    tempo, beats = librosa.beat.beat_track(y=y, sr=sr, hop_length=FRAME_HOP_LENGTH)
+    
+    return {
+        "tempo": np.asarray(tempo, dtype=np.float64).reshape(()),
+        "beatTimes": librosa.frames_to_time(beats, sr=sr, hop_length=FRAME_HOP_LENGTH),
+        # Spectral features
+        "spectralCentroid": librosa.feature.spectral_centroid(y=y, sr=sr, hop_length=FRAME_HOP_LENGTH)[0],
+        "spectralRolloff": librosa.feature.spectral_rolloff(y=y, sr=sr, hop_length=FRAME_HOP_LENGTH)[0],
+        "spectralBandwidth": librosa.feature.spectral_bandwidth(y=y, sr=sr, hop_length=FRAME_HOP_LENGTH)[0],
+        # Chroma features (for key detection)
+        "chroma": librosa.feature.chroma_stft(y=y, sr=sr, hop_length=FRAME_HOP_LENGTH),
+        # MFCC (Mel-frequency cepstral coefficients)
+        "mfcc": librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13, hop_length=FRAME_HOP_LENGTH),
+        # Zero crossing rate
+        "zeroCrossingRate": librosa.feature.zero_crossing_rate(y, hop_length=FRAME_HOP_LENGTH)[0],
+        # RMS energy
+        "rms": librosa.feature.rms(y=y, hop_length=FRAME_HOP_LENGTH)[0],
+    }
+
+def extract_audio_features(
+    y: np.ndarray,
+    sr: int,
+    series: Optional[Dict[str, np.ndarray]] = None
+) -> Dict[str, Any]:
+    """Extract comprehensive audio features using librosa"""
+    if series is None:
+        series = extract_frame_series(y, sr)
+    
+    tempo = float(series["tempo"])
+    beats = series["beatTimes"]
+    spectral_centroids = series["spectralCentroid"]
+    spectral_rolloff = series["spectralRolloff"]
+    spectral_bandwidth = series["spectralBandwidth"]
+    chroma = series["chroma"]
+    mfccs = series["mfcc"]
+    zcr = series["zeroCrossingRate"]
+    rms = series["rms"]
     
     # Estimate key
     key = estimate_key(chroma)
@@ -164,8 +631,7 @@ def extract_audio_features(y: np.ndarray, sr: int) -> Dict[str, Any]:
     energy = float(np.mean(rms))
     
     # Danceability (based on tempo and beat strength)
-    beat_strength = librosa.beat.beat_track(y=y, sr=sr, units='frames')[1]
-    danceability = min(1.0, (tempo / 180.0) * (len(beat_strength) / (len(y) / sr)))
+    danceability = min(1.0, (tempo / 180.0) * (len(beats) / (len(y) / sr)))
     
     # Valence (positivity) - simplified based on spectral features
     valence = float(np.mean(spectral_centroids) / 4000.0)  # Normalize
@@ -317,52 +783,67 @@ def detect_instruments(y: np.ndarray, sr: int) -> Dict[str, Any]:
         "leadInstrument": lead
     }
 
-def analyze_quality(y: np.ndarray, sr: int) -> Dict[str, Any]:
-    """Analyze audio quality and mixing"""
-    
-    # Calculate technical metrics
-    rms = librosa.feature.rms(y=y)[0]
-    peak = np.max(np.abs(y))
-    mean_rms = np.mean(rms)
+def analyze_quality(y: np.ndarray, sr: int, y_multi: Optional[np.ndarray] = None) -> Dict[str, Any]:
+    """
+    Analyze audio quality and mixing
+
+    Loudness is metered per ITU-R BS.1770 / EBU R128 in one streaming pass:
+    K-weighted integrated loudness (LUFS), loudness range (LU), 4x-oversampled
+    true peak (dBTP) and momentary/short-term loudness over time. Pass the
+    decoded multichannel signal as `y_multi` so channels are weighted before
+    summing, as the standard (and streaming platforms) do.
+    """
     
-    # Dynamic range
-    dynamic_range = float(20 * np.log10(peak / (mean_rms + 1e-10)))
+    loudness = measure_loudness(y_multi if y_multi is not None else y, sr)
     
-    # Peak level (dBFS)
-    peak_level = float(20 * np.log10(peak + 1e-10))
+    integrated = loudness["integratedLufs"]
+    loudness_range = loudness["loudnessRange"]
+    true_peak = loudness["truePeakDbtp"]
     
-    # RMS level (dBFS)
-    rms_level = float(20 * np.log10(mean_rms + 1e-10))
+    # Peak and RMS level (dBFS) of the unweighted signal
+    peak_level = loudness["samplePeakDbfs"] if loudness["samplePeakDbfs"] is not None else -200.0
+    rms_level = loudness["rmsDbfs"] if loudness["rmsDbfs"] is not None else -200.0
     
-    # Crest factor
-    crest_factor = float(peak / (mean_rms + 1e-10))
+    # Dynamic range (peak to RMS, dB) and crest factor
+    dynamic_range = float(peak_level - rms_level)
+    crest_factor = float(10 ** (dynamic_range / 20))
     
     # Calculate quality score (0-100)
     score = 50.0  # Base score
     
     feedback = []
     
-    # Good dynamic range (8-14 dB)
-    if 8 <= dynamic_range <= 14:
+    # Integrated loudness against streaming normalization (about -14 LUFS)
+    if integrated is None:
+        feedback.append("Track is silent")
+    elif -16 <= integrated <= -9:
         score += 15
-        feedback.append("Good dynamic range")
-    elif dynamic_range < 8:
-        feedback.append("Limited dynamic range - may sound compressed")
+        feedback.append(f"Good loudness for streaming ({integrated:.1f} LUFS)")
+    elif integrated > -9:
+        feedback.append(
+            f"Very loud master ({integrated:.1f} LUFS) - streaming platforms "
+            f"will turn it down about {integrated + 14:.0f} dB"
+        )
     else:
-        feedback.append("Very wide dynamic range - check levels")
+        feedback.append(f"Quiet master ({integrated:.1f} LUFS) - may lose impact next to other tracks")
     
-    # Peak level check (should be below 0 dBFS)
-    if -1 > peak_level > -6:
+    # True peak check (should stay below -1 dBTP for lossy encoding)
+    if true_peak is not None and -6 < true_peak <= -1:
         score += 15
-        feedback.append("Good peak levels")
-    elif peak_level > -1:
+        feedback.append("Good true-peak headroom")
+    elif true_peak is not None and true_peak > -1:
         score -= 10
-        feedback.append("Peaks too high - risk of clipping")
-    
-    # RMS level check (should be around -14 to -20 dBFS)
-    if -20 <= rms_level <= -14:
-        score += 15
-        feedback.append("Good loudness level")
+        feedback.append("True peak above -1 dBTP - risk of clipping after encoding")
+    
+    # Loudness range (4-12 LU suits most popular music)
+    if loudness_range is not None:
+        if 4 <= loudness_range <= 12:
+            score += 15
+            feedback.append("Good loudness range")
+        elif loudness_range < 4:
+            feedback.append("Limited loudness range - may sound compressed")
+        else:
+            feedback.append("Very wide loudness range - quiet passages may get lost")
     
     # Crest factor (should be 4-10 for good mix)
     if 4 <= crest_factor <= 10:
@@ -370,8 +851,8 @@ def analyze_quality(y: np.ndarray, sr: int) -> Dict[str, Any]:
         feedback.append("Good crest factor")
     
     # Mix quality estimates (simplified)
-    balance = min(1.0, dynamic_range / 14.0)
-    clarity = min(1.0, abs(peak_level) / 6.0)
+    balance = min(1.0, (loudness_range or 0.0) / 12.0)
+    clarity = min(1.0, abs(true_peak if true_peak is not None else peak_level) / 6.0)
     depth = min(1.0, crest_factor / 10.0)
     
     return {
@@ -381,7 +862,17 @@ def analyze_quality(y: np.ndarray, sr: int) -> Dict[str, Any]:
             "dynamicRange": dynamic_range,
             "peakLevel": peak_level,
             "rmsLevel": rms_level,
-            "crestFactor": crest_factor
+            "crestFactor": crest_factor,
+            "integratedLoudness": integrated,
+            "loudnessRange": loudness_range,
+            "truePeak": true_peak,
+            "momentaryMax": loudness["momentaryMaxLufs"],
+            "shortTermMax": loudness["shortTermMaxLufs"]
+        },
+        "loudness": {
+            "interval": loudness["seriesInterval"],
+            "momentary": loudness["momentary"],
+            "shortTerm": loudness["shortTerm"]
         },
         "mixQuality": {
             "balance": float(balance),
@@ -482,110 +973,161 @@ def predict_virality(
         "recommendations": recommendations
     }
 
+STEM_TYPES = ["vocals", "drums", "bass", "other"]
+
+def load_stems(stems_dir: str) -> Dict[str, Any]:
+    """Read each separated WAV once into memory as (mono samples, sr, path)"""
+    stem_audio = {}
+    for stem_type in STEM_TYPES:
+        stem_path = os.path.join(stems_dir, f"{stem_type}.wav")
+        if os.path.exists(stem_path):
+            y, sr = sf.read(stem_path, dtype="float32", always_2d=True)
+            stem_audio[stem_type] = (y.mean(axis=1), sr, stem_path)
+    return stem_audio
+
+def stem_info(y: np.ndarray, sr: int, stem_path: str) -> Dict[str, Any]:
+    """Basic stem description returned by every separation endpoint"""
+    return {
+        "duration": len(y) / sr,
+        "sample_rate": sr,
+        "energy": float(np.sqrt(np.mean(y**2))),
+        "path": stem_path,  # For upload to cloud storage
+        "size_samples": len(y)
+    }
+
+def analyze_stem(y: np.ndarray, sr: int) -> Dict[str, Any]:
+    """Feature and quality summary for a single separated stem"""
+    if not np.any(y):
+        # Silent stem (e.g. no vocals in an instrumental)
+        return {"silent": True}
+    
+    features = extract_audio_features(y, sr)
+    quality = analyze_quality(y, sr)
+    return {
+        "silent": False,
+        "tempo": features["tempo"],
+        "key": features["key"],
+        "energy": features["energy"],
+        "loudness": features["loudness"],
+        "spectralCentroid": features["spectralCentroid"],
+        "quality": {
+            "score": quality["score"],
+            "technicalQuality": quality["technicalQuality"]
+        }
+    }
+
 @app.post("/separate/stems")
-async def separate_stems(file: UploadFile = File(...)):
+async def separate_stems(
+    request: Request,
+    file: UploadFile = File(...),
+    format: str = "wav",
+    profile: str = DEFAULT_PROFILE
+):
     """
     Separate audio into stems using Demucs:
     - vocals
     - drums
     - bass
     - other (melody/instruments)
+
+    Stems are returned as wav, flac or opus depending on `format`.
+    `profile` picks the speed/quality trade-off (fast, balanced, best).
+    The job directory is kept until /cleanup/{job_id} or its TTL expires.
+    A client disconnect or passed deadline kills the Demucs process.
+    Uploads too long for the memory budget get 413; 503 while it is in use.
     """
+    deadline = request_deadline(request, DEADLINES["separate"])
     temp_path = None
-    output_dir = None
+    
+    check_format(format)
+    
+    if profile not in SEPARATION_PROFILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"profile must be one of: {', '.join(SEPARATION_PROFILES)}"
+        )
+    
+    # Create tracked output directory
+    output_dir = storage.create_workdir(owner=request_owner(request))
     
     try:
         print(f"[WORKER] Separating stems for: {file.filename}")
+        content = await file.read()
+        temp_path = os.path.join(output_dir, "upload.wav")
         
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
-            content = await file.read()
-            temp_file.write(content)
-            temp_path = temp_file.name
-        
-        # Create output directory
-        output_dir = tempfile.mkdtemp()
-        
-        # Run Demucs separation
-        print("[WORKER] Running Demucs stem separation...")
-        try:
-            import subprocess
-            
-            # Use Demucs CLI for separation
-            # Model: htdemucs (hybrid transformer demucs - best quality)
-            result = subprocess.run(
-                [
-                    "demucs",
-                    "--two-stems=vocals",  # First pass: vocals vs instrumental
-                    "-o", output_dir,
-                    temp_path
-                ],
-                capture_output=True,
-                text=True,
-                timeout=300  # 5 minute timeout
-            )
-            
-            if result.returncode != 0:
-                print(f"[WORKER] Demucs error: {result.stderr}")
-                raise Exception(f"Stem separation failed: {result.stderr}")
-            
-            # Run full separation on instrumental
-            result = subprocess.run(
-                [
-                    "demucs",
-                    "-o", output_dir,
-                    temp_path
-                ],
-                capture_output=True,
-                text=True,
-                timeout=300
-            )
-            
-            print("[WORKER] Stem separation complete!")
-            
-            # Find output files
-            # Demucs creates: output_dir/htdemucs/filename/vocals.wav, drums.wav, bass.wav, other.wav
-            base_name = os.path.splitext(os.path.basename(temp_path))[0]
-            stems_dir = os.path.join(output_dir, "htdemucs", base_name)
-            
-            stems = {}
-            stem_types = ["vocals", "drums", "bass", "other"]
-            
-            for stem_type in stem_types:
-                stem_path = os.path.join(stems_dir, f"{stem_type}.wav")
-                if os.path.exists(stem_path):
-                    # Read stem file
-                    y, sr = librosa.load(stem_path, sr=None)
-                    
-                    # Get stem info
-                    duration = len(y) / sr
-                    rms_energy = float(np.sqrt(np.mean(y**2)))
-                    
-                    stems[stem_type] = {
-                        "duration": duration,
-                        "sample_rate": sr,
-                        "energy": rms_energy,
-                        "path": stem_path,  # For upload to cloud storage
-                        "size_samples": len(y)
-                    }
-            
-            return {
-                "success": True,
-                "stems": stems,
-                "model": "htdemucs",
-                "output_dir": stems_dir,
-                "message": f"Successfully separated {len(stems)} stems"
-            }
-            
-        except subprocess.TimeoutExpired:
-            raise HTTPException(status_code=408, detail="Stem separation timed out (>5 minutes)")
-        except FileNotFoundError:
-            raise HTTPException(
-                status_code=500,
-                detail="Demucs not installed. Run: pip install demucs"
-            )
+        async def separate(token: CancelToken):
+            async with storage.reserve(
+                estimate_separation_bytes(len(content), 4, file.filename),
+                workdir=output_dir
+            ):
+                # Save uploaded file into the job directory
+                with open(temp_path, "wb") as temp_file:
+                    temp_file.write(content)
+                
+                header = await run_in_threadpool(probe_audio, temp_path)
+                plan = memory.plan(header, SEPARATE_COST)
+                
+                async with memory.reserve(plan):
+                    with memory.track(f"separate {file.filename}", plan):
+                        # Demucs decodes the upload itself; this mono decode only
+                        # identifies it, so it stays at the fingerprint rate
+                        y, sr = await run_in_threadpool(librosa.load, temp_path, sr=FINGERPRINT_SAMPLE_RATE)
+                        fingerprint, match = await run_in_threadpool(identify, y, sr)
+                        del y
+                        
+                        variant = f"{profile}/{format}"
+                        stems_dir = stems_dir_for(output_dir, temp_path, profile)
+                        if match and match.reusable(fingerprint):
+                            stems = await run_in_threadpool(
+                                fingerprints.get_stems, match.track_id, variant, stems_dir
+                            )
+                            if stems:
+                                return {
+                                    "success": True,
+                                    "stems": {
+                                        name: {k: v for k, v in stem.items() if k != "analysis"}
+                                        for name, stem in stems.items()
+                                    },
+                                    "model": SEPARATION_PROFILES[profile]["model"],
+                                    "profile": profile,
+                                    "format": format,
+                                    "job_id": os.path.basename(output_dir),
+                                    "output_dir": stems_dir,
+                                    "message": f"Reused {len(stems)} stems from an earlier separation",
+                                    "dedup": match.describe(stems=True)
+                                }
+                        
+                        result = await run_separation(output_dir, temp_path, format, profile, deadline)
+                        await run_in_threadpool(remember_stems, fingerprint, match, variant, result["stems"])
+                        return {**result, "dedup": NOT_REUSED}
         
+        return await run_cancellable(request, separate, deadline)
+    
+    except (ClientDisconnected, DeadlineExpired) as e:
+        storage.release(output_dir)
+        print(f"[WORKER] Stem separation abandoned: {str(e)}")
+        raise abandoned_response(e)
+    
+    except (MemoryTooLarge, MemoryBusy) as e:
+        storage.release(output_dir)
+        print(f"[WORKER] Stem separation not admitted: {str(e)}")
+        raise memory_response(e)
+    
+    except StorageFull as e:
+        storage.release(output_dir)
+        print(f"[WORKER] Stem separation rejected: {str(e)}")
+        raise HTTPException(
+            status_code=507,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    
+    except HTTPException:
+        storage.release(output_dir)
+        raise
+    
     except Exception as e:
+        storage.release(output_dir)
         print(f"[WORKER] Stem separation error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Stem separation failed: {str(e)}")
     
@@ -597,6 +1139,362 @@ async def separate_stems(file: UploadFile = File(...)):
             except:
                 pass
 
+def remember_stems(
+    fingerprint: Optional[Fingerprint],
+    match: Optional[Match],
+    variant: str,
+    stems: Dict[str, Dict[str, Any]],
+    track_id: Optional[int] = None
+):
+    """Cache fresh stems under the recording they came from"""
+    if fingerprint is None:
+        return
+    try:
+        if track_id is None:
+            # remember() indexes a trimmed copy or another version of the song
+            # as a recording of its own, so these stems never replace its source's
+            track_id = remember(fingerprint, match)
+        if track_id is not None:
+            fingerprints.put_stems(track_id, variant, stems)
+    except Exception as e:
+        print(f"[WORKER] Stem cache update failed: {e}")
+
+async def describe_stems(
+    stems_dir: str,
+    format: str,
+    token: CancelToken,
+    deadline: Optional[float] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Analyze every separated stem from memory, then encode them
+
+    Each stem takes its own analysis slot, so the stems run side by side only
+    while the analysis CPU budget has room for them.
+    """
+    print("[WORKER] Analyzing stems...")
+    token.check()
+    stem_audio = await run_in_threadpool(load_stems, stems_dir)
+    stem_names = list(stem_audio)
+    
+    async def analyze(y: np.ndarray, sr: int) -> Dict[str, Any]:
+        async with analysis_scheduler.slot(1, deadline):
+            token.check()
+            return await run_in_threadpool(analyze_stem, y, sr)
+    
+    stem_analysis = await asyncio.gather(*[
+        analyze(stem_audio[name][0], stem_audio[name][1])
+        for name in stem_names
+    ])
+    
+    stems = {}
+    for name, features in zip(stem_names, stem_analysis):
+        stem_y, stem_sr, stem_path = stem_audio[name]
+        stems[name] = {**stem_info(stem_y, stem_sr, stem_path), "analysis": features}
+    
+    stem_files = {name: stem_audio[name][2] for name in stem_names}
+    del stem_audio
+    
+    # Encode all stems in parallel (no-op for wav)
+    token.check()
+    stem_files = await run_in_threadpool(encode_stems, stem_files, format)
+    for name, stem_path in stem_files.items():
+        stems[name]["path"] = stem_path
+        stems[name]["format"] = format
+        stems[name]["size"] = os.path.getsize(stem_path)
+    return stems
+
+async def run_separation(
+    output_dir: str,
+    temp_path: str,
+    format: str,
+    profile: str,
+    deadline: Optional[float] = None
+) -> Dict[str, Any]:
+    """Run Demucs on an uploaded file and describe the resulting stems"""
+    # Run Demucs separation
+    print(f"[WORKER] Running Demucs stem separation ({profile} profile)...")
+    if not demucs_available():
+        raise HTTPException(
+            status_code=500,
+            detail="Demucs not installed. Run: pip install demucs"
+        )
+    
+    try:
+        # One full 4-stem pass; vocals come out of it directly
+        stems_dir = await run_profile(temp_path, output_dir, profile, timeout=300, deadline=deadline)
+    except SeparationTimeout:
+        raise HTTPException(status_code=408, detail="Stem separation timed out (>5 minutes)")
+    except SeparationFailed as e:
+        print(f"[WORKER] Demucs error: {str(e)}")
+        raise Exception(f"Stem separation failed: {str(e)}")
+    
+    print("[WORKER] Stem separation complete!")
+    
+    stems = {}
+    stem_files = {}
+    stem_audio = await run_in_threadpool(load_stems, stems_dir)
+    
+    for stem_type, (y, sr, stem_path) in stem_audio.items():
+        stems[stem_type] = stem_info(y, sr, stem_path)
+        stem_files[stem_type] = stem_path
+    
+    # Encode all stems in parallel (no-op for wav)
+    if format != "wav":
+        print(f"[WORKER] Encoding {len(stem_files)} stems to {format}...")
+    stem_files = await run_in_threadpool(encode_stems, stem_files, format)
+    for stem_type, stem_path in stem_files.items():
+        stems[stem_type]["path"] = stem_path
+        stems[stem_type]["format"] = format
+        stems[stem_type]["size"] = os.path.getsize(stem_path)
+    
+    return {
+        "success": True,
+        "stems": stems,
+        "model": SEPARATION_PROFILES[profile]["model"],
+        "profile": profile,
+        "format": format,
+        "job_id": os.path.basename(output_dir),
+        "output_dir": stems_dir,
+        "message": f"Successfully separated {len(stems)} stems"
+    }
+
+@app.post("/analyze/separate")
+async def analyze_and_separate(
+    request: Request,
+    file: UploadFile = File(...),
+    format: str = "wav",
+    profile: str = DEFAULT_PROFILE
+):
+    """
+    Analyze a mix and separate it into stems from a single upload
+
+    The file is decoded once. Mix analysis and Demucs separation run
+    concurrently, then every stem is analyzed (tempo, key, energy, loudness,
+    quality) from memory, so clients no longer need to upload the track to
+    /analyze/enhanced and /separate/stems separately. Uploads too long for
+    the memory budget get 413; 503 while it is in use.
+    """
+    check_format(format)
+    
+    if profile not in SEPARATION_PROFILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"profile must be one of: {', '.join(SEPARATION_PROFILES)}"
+        )
+    
+    if not demucs_available():
+        raise HTTPException(
+            status_code=500,
+            detail="Demucs not installed. Run: pip install demucs"
+        )
+    
+    deadline = request_deadline(request, DEADLINES["analyze_separate"])
+    output_dir = storage.create_workdir(owner=request_owner(request))
+    upload_path = os.path.join(output_dir, "upload" + os.path.splitext(file.filename or "")[1])
+    mix_path = os.path.join(output_dir, "mix.wav")
+    
+    try:
+        print(f"[WORKER] Analyzing and separating: {file.filename}")
+        content = await file.read()
+        
+        async def analyze_mix(y: np.ndarray, y_multi: np.ndarray, sr: int, token: CancelToken):
+            async with analysis_scheduler.slot(1, deadline):
+                return await run_in_threadpool(run_analysis, y, sr, token, y_multi)
+        
+        async def pipeline(token: CancelToken):
+            # Upload + float32 decoded mix (about two stems' worth) + 4 stems
+            async with storage.reserve(
+                estimate_separation_bytes(len(content), 6, file.filename),
+                workdir=output_dir
+            ):
+                with open(upload_path, "wb") as upload_file:
+                    upload_file.write(content)
+                
+                # Four stems are analyzed at once at the end, so this is the
+                # heaviest route; it runs at full rate or not at all
+                header = await run_in_threadpool(probe_audio, upload_path)
+                plan = memory.plan(header, ANALYZE_SEPARATE_COST)
+                
+                async with memory.reserve(plan):
+                    with memory.track(f"analyze/separate {file.filename}", plan):
+                        # Decode once; Demucs gets the PCM so it never touches the codec
+                        print("[WORKER] Decoding audio...")
+                        y_multi, sr = await run_in_threadpool(librosa.load, upload_path, sr=None, mono=False)
+                        y = librosa.to_mono(y_multi)
+                        print(f"[WORKER] Audio decoded: {len(y)} samples at {sr} Hz")
+                        
+                        # Reuse whatever an earlier upload of this recording left behind
+                        fingerprint, match = await run_in_threadpool(identify, y, sr)
+                        variant = f"{profile}/{format}"
+                        analysis = None
+                        stems = None
+                        if match and match.reusable(fingerprint):
+                            analysis = match.analysis
+                            stems = await run_in_threadpool(
+                                fingerprints.get_stems, match.track_id, variant,
+                                stems_dir_for(output_dir, mix_path, profile)
+                            )
+                            # Stems cached by /separate/stems carry no per-stem analysis
+                            if stems and not all("analysis" in stem for stem in stems.values()):
+                                stems = None
+                        
+                        pending = {}
+                        if analysis is None:
+                            pending["analysis"] = asyncio.ensure_future(analyze_mix(y, y_multi, sr, token))
+                        if stems is None:
+                            await run_in_threadpool(sf.write, mix_path, np.atleast_2d(y_multi).T, sr, subtype="FLOAT")
+                            pending["stems_dir"] = asyncio.ensure_future(
+                                run_profile(mix_path, output_dir, profile, timeout=300, deadline=deadline)
+                            )
+                        try:
+                            results = dict(zip(pending, await asyncio.gather(*pending.values())))
+                        except BaseException:
+                            # One half failed or we were cancelled; stop the other
+                            for task in pending.values():
+                                task.cancel()
+                            await asyncio.gather(*pending.values(), return_exceptions=True)
+                            raise
+                        del y, y_multi
+                        
+                        track_id = match.track_id if match else None
+                        if "analysis" in results:
+                            analysis = results["analysis"]
+                            track_id = await run_in_threadpool(remember, fingerprint, match, analysis)
+                        if "stems_dir" in results:
+                            stems = await describe_stems(results["stems_dir"], format, token, deadline)
+                            await run_in_threadpool(remember_stems, fingerprint, match, variant, stems, track_id)
+                        
+                        dedup = match.describe(
+                            analysis="analysis" not in pending, stems="stems_dir" not in pending
+                        ) if match else NOT_REUSED
+                        
+                        print("[WORKER] Analysis and separation complete!")
+                        
+                        return {
+                            "success": True,
+                            **analysis,
+                            "stems": stems,
+                            "model": SEPARATION_PROFILES[profile]["model"],
+                            "profile": profile,
+                            "format": format,
+                            "job_id": os.path.basename(output_dir),
+                            "message": f"Analyzed mix and {len(stems)} stems",
+                            "dedup": dedup
+                        }
+        
+        return await run_cancellable(request, pipeline, deadline)
+    
+    except (ClientDisconnected, DeadlineExpired) as e:
+        storage.release(output_dir)
+        print(f"[WORKER] Analyze/separate abandoned: {str(e)}")
+        raise abandoned_response(e)
+    
+    except (MemoryTooLarge, MemoryBusy) as e:
+        storage.release(output_dir)
+        print(f"[WORKER] Analyze/separate not admitted: {str(e)}")
+        raise memory_response(e)
+    
+    except StorageFull as e:
+        storage.release(output_dir)
+        print(f"[WORKER] Analyze/separate rejected: {str(e)}")
+        raise HTTPException(
+            status_code=507,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    
+    except SeparationTimeout:
+        storage.release(output_dir)
+        raise HTTPException(status_code=408, detail="Stem separation timed out (>5 minutes)")
+    
+    except Exception as e:
+        storage.release(output_dir)
+        print(f"[WORKER] Analyze/separate error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Analyze/separate failed: {str(e)}")
+    
+    finally:
+        # Stems stay for download; the upload and decoded mix do not
+        for path in (upload_path, mix_path):
+            if os.path.exists(path):
+                try:
+                    os.unlink(path)
+                except:
+                    pass
+
+@app.get("/separate/stems/{job_id}/archive")
+async def download_stems_archive(job_id: str):
+    """
+    Stream every stem of a separation job as a single zip
+
+    The archive is built while it is being sent, so nothing is staged on disk.
+    """
+    job_dir = storage.path_for(job_id)
+    if not job_dir:
+        raise HTTPException(status_code=400, detail="Invalid job id")
+    
+    # Stems live under job_dir/<model>/<track>/
+    stem_paths = []
+    for model_dir in sorted(os.listdir(job_dir)) if os.path.isdir(job_dir) else []:
+        model_path = os.path.join(job_dir, model_dir)
+        if not os.path.isdir(model_path):
+            continue
+        for track in sorted(os.listdir(model_path)):
+            stem_paths.extend(list_stem_files(os.path.join(model_path, track)))
+    
+    if not stem_paths:
+        raise HTTPException(status_code=404, detail="No stems found")
+    
+    storage.touch(job_dir)
+    entries = [(os.path.basename(path), path) for path in stem_paths]
+    
+    return StreamingResponse(
+        iter_zip(entries),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{job_id}_stems.zip"'}
+    )
+
+@app.post("/cleanup/{job_id}")
+async def cleanup(job_id: str):
+    """
+    Remove a separation job's files once the client has fetched them
+    """
+    job_dir = storage.path_for(job_id)
+    if job_dir and storage.release(job_dir):
+        if storage.owns(job_dir):
+            # Still being written; it goes when the job finishes
+            return {"success": True, "message": "Cleanup scheduled for when the job finishes"}
+        return {"success": True, "message": "Cleanup complete"}
+    return {"success": False, "message": "Job not found"}
+
+@app.get("/storage")
+async def storage_stats():
+    """
+    Disk usage, quota headroom, eviction and admission counters
+    """
+    return storage.stats()
+
+@app.get("/scheduler")
+async def scheduler_stats():
+    """
+    Capacity, queue depth and deadline drops for analysis and separation
+    """
+    return {
+        "analysis": analysis_scheduler.stats(),
+        "separation": thread_budget.stats()
+    }
+
+@app.get("/memory")
+async def memory_stats():
+    """Memory budget, admission decisions and measured per-request peaks"""
+    return memory.stats()
+
+@app.get("/fingerprints")
+async def fingerprint_stats():
+    """
+    Indexed recordings, lookup hit rate and stem cache usage
+    """
+    return {**await run_in_threadpool(fingerprints.stats), "disabled": FINGERPRINT_DISABLED}
+
 if __name__ == "__main__":
     import uvicorn
     print("Starting NoCulture Enhanced Audio Analysis Worker...")
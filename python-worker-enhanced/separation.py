@@ -0,0 +1,268 @@
+"""
+Demucs Separation Profiles
+CPU-tuned separation presets. Each job runs Demucs in a child process so its
+thread settings and (optionally) int8-quantized weights stay isolated from the
+API worker and from other jobs.
+
+Profiles:
+- fast:     htdemucs, no shift trick, 10% overlap, 2 intra-op threads. For
+            previews. SEPARATION_QUANTIZE_FAST=1 adds dynamic int8 Linear
+            and LSTM layers; that is off by default until its SDR cost is
+            measured.
+- balanced: htdemucs with the Demucs CLI defaults (1 shift, 25% overlap),
+            4 intra-op threads. Same quality as the old CLI path.
+- best:     htdemucs_ft (bag of 4 fine-tuned models), 2 shifts, 25%
+            overlap, every core. Demucs documents the fine-tuned bag as
+            a little better than htdemucs.
+
+Measured with `bench_profiles.py --duration 30 --untrained` (30 s mixture)
+on 1 vCPU (Intel Xeon, 5 GB RAM), torch 2.14.1, demucs 4.1.0. RTF is
+processing time over audio length:
+
+    profile           seconds   RTF    vs balanced
+    fast                 34.6   1.15   1.1x faster
+    fast (int8)          31.0   1.03   1.2x faster
+    balanced             37.0   1.23   -
+    best                282.1   9.40   7.5x slower
+
+fast and balanced were timed in one run. The int8 and best rows come from
+an earlier run, where balanced took 37.4 s. With a single core every
+profile ran on one thread, so this only shows the model, shift, overlap and
+int8 differences. The thread counts add to them on bigger nodes.
+
+SDR is not recorded yet. The pretrained weights could not be downloaded
+on that machine, so the timings come from the same architectures with
+random weights (same compute, meaningless output). Run bench_profiles.py
+without --untrained where the weights are reachable to score each profile
+against the synthetic mixture's sources, with and without
+SEPARATION_QUANTIZE_FAST=1.
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import os
+import sys
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from scheduling import DeadlineScheduler, remaining
+
+# Dynamic int8 Linear/LSTM layers for the fast profile. Their SDR cost has not
+# been measured with pretrained weights, so they stay off unless enabled
+QUANTIZE_FAST = os.environ.get("SEPARATION_QUANTIZE_FAST", "0") == "1"
+
+SEPARATION_PROFILES: Dict[str, Dict[str, Any]] = {
+    "fast": {
+        "model": "htdemucs",
+        "shifts": 0,
+        "overlap": 0.1,
+        "quantize": QUANTIZE_FAST,
+        "intra_op_threads": 2,
+        "inter_op_threads": 1,
+    },
+    "balanced": {
+        "model": "htdemucs",
+        "shifts": 1,
+        "overlap": 0.25,
+        "quantize": False,
+        "intra_op_threads": 4,
+        "inter_op_threads": 1,
+    },
+    "best": {
+        "model": "htdemucs_ft",
+        "shifts": 2,
+        "overlap": 0.25,
+        "quantize": False,
+        "intra_op_threads": None,  # every core in the budget
+        "inter_op_threads": 1,
+    },
+}
+
+DEFAULT_PROFILE = "balanced"
+
+# Cores the separation jobs may use between them
+CPU_BUDGET = int(os.environ.get("SEPARATION_CPU_BUDGET", os.cpu_count() or 4))
+
+
+# Script the child process runs; load tests swap in a stand-in that takes the
+# same arguments (see loadtest/fake_separators.py)
+SEPARATION_ENTRYPOINT = os.environ.get("SEPARATION_ENTRYPOINT") or os.path.abspath(__file__)
+
+
+class SeparationTimeout(Exception):
+    pass
+
+
+class SeparationFailed(Exception):
+    pass
+
+
+def resolve_threads(profile_name: str) -> Tuple[int, int]:
+    """(intra-op, inter-op) thread counts for a profile, capped to the budget"""
+    profile = SEPARATION_PROFILES[profile_name]
+    intra = profile["intra_op_threads"] or CPU_BUDGET
+    return max(1, min(intra, CPU_BUDGET)), profile["inter_op_threads"]
+
+
+# CPU threads shared by all separation jobs; a job holds as many as it runs,
+# and queued jobs are granted earliest-deadline-first
+thread_budget = DeadlineScheduler(CPU_BUDGET, name="separation")
+
+
+def demucs_available() -> bool:
+    if SEPARATION_ENTRYPOINT != os.path.abspath(__file__):
+        return True
+    return importlib.util.find_spec("demucs") is not None
+
+
+def stems_dir_for(output_dir: str, input_path: str, profile_name: str) -> str:
+    """Where a job's stems end up: output_dir/<model>/<input name>/<stem>.wav"""
+    base_name = os.path.splitext(os.path.basename(input_path))[0]
+    return os.path.join(output_dir, SEPARATION_PROFILES[profile_name]["model"], base_name)
+
+
+async def run_profile(
+    input_path: str,
+    output_dir: str,
+    profile_name: str,
+    timeout: float,
+    deadline: Optional[float] = None,
+) -> str:
+    """
+    Separate `input_path` with a profile in a child process
+
+    Waits for the profile's threads in the CPU budget first (dropped with
+    DeadlineExpired if the deadline passes in the queue). Cancelling the
+    calling task kills the child process.
+
+    Returns:
+        Directory holding one WAV per stem
+    """
+    intra, _ = resolve_threads(profile_name)
+    async with thread_budget.slot(intra, deadline):
+        if deadline is not None:
+            timeout = min(timeout, remaining(deadline))
+        env = dict(
+            os.environ,
+            OMP_NUM_THREADS=str(intra),
+            MKL_NUM_THREADS=str(intra),
+        )
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, SEPARATION_ENTRYPOINT,
+            "--input", input_path,
+            "--output", output_dir,
+            "--profile", profile_name,
+            env=env,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise SeparationTimeout(f"Stem separation timed out (>{int(timeout)} seconds)")
+        except asyncio.CancelledError:
+            # Client went away or the deadline passed; stop burning CPU
+            process.kill()
+            await process.wait()
+            print(f"[SEPARATION] Cancelled {profile_name} job for {os.path.basename(input_path)}", file=sys.stderr)
+            raise
+
+        if process.returncode != 0:
+            raise SeparationFailed(stderr.decode(errors="replace").strip()[-2000:])
+
+    return stems_dir_for(output_dir, input_path, profile_name)
+
+
+# ----------------------------------------------------------------------
+# Child process side
+
+
+def configure_threads(profile_name: str):
+    import torch
+
+    intra, inter = resolve_threads(profile_name)
+    torch.set_num_threads(intra)
+    try:
+        torch.set_num_interop_threads(inter)
+    except RuntimeError:
+        # Can only be set once per process, before any parallel work
+        pass
+
+
+def load_model(profile_name: str):
+    from demucs.pretrained import get_model
+
+    return prepare_model(get_model(SEPARATION_PROFILES[profile_name]["model"]), profile_name)
+
+
+def prepare_model(model, profile_name: str):
+    """Put a loaded model in inference mode, quantized if the profile asks"""
+    import torch
+
+    profile = SEPARATION_PROFILES[profile_name]
+    model.eval()
+    if profile["quantize"]:
+        # Only Linear/LSTM weights are dynamically quantizable; the conv
+        # encoder/decoder stays in float32
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8
+        )
+    return model
+
+
+def separate_tensor(model, wav, profile_name: str) -> Dict[str, Any]:
+    """
+    Run a loaded model over a (channels, samples) tensor
+
+    Returns:
+        stem name -> (channels, samples) tensor at model.samplerate
+    """
+    import torch
+    from demucs.apply import apply_model
+
+    profile = SEPARATION_PROFILES[profile_name]
+    ref = wav.mean(0)
+    wav = (wav - ref.mean()) / (ref.std() + 1e-8)
+    with torch.inference_mode():
+        sources = apply_model(
+            model,
+            wav[None],
+            shifts=profile["shifts"],
+            split=True,
+            overlap=profile["overlap"],
+            progress=False,
+            num_workers=0,
+        )[0]
+    sources = sources * ref.std() + ref.mean()
+    return dict(zip(model.sources, sources))
+
+
+def separate_file(input_path: str, output_dir: str, profile_name: str) -> str:
+    from demucs.audio import AudioFile, save_audio
+
+    configure_threads(profile_name)
+    started = time.perf_counter()
+    model = load_model(profile_name)
+    wav = AudioFile(input_path).read(
+        streams=0, samplerate=model.samplerate, channels=model.audio_channels
+    )
+
+    stems_dir = stems_dir_for(output_dir, input_path, profile_name)
+    os.makedirs(stems_dir, exist_ok=True)
+    for name, source in separate_tensor(model, wav, profile_name).items():
+        save_audio(source, os.path.join(stems_dir, f"{name}.wav"), samplerate=model.samplerate)
+
+    print(f"[SEPARATION] {profile_name}: {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return stems_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run one Demucs separation job")
+    parser.add_argument("--input", required=True)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--profile", choices=list(SEPARATION_PROFILES), default=DEFAULT_PROFILE)
+    args = parser.parse_args()
+    separate_file(args.input, args.output, args.profile)
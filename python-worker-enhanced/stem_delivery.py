@@ -0,0 +1,223 @@
+"""
+Stem Delivery Helpers
+Encode separated stems to compressed formats, serve them with HTTP range
+support and stream them back as a zip
+
+Shared by python-worker and python-worker-enhanced; keep both copies in sync
+(scripts/check_shared_modules.py fails when they drift).
+"""
+
+import os
+import shutil
+import subprocess
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+
+# Output formats a client can ask for. Separators always write WAV, anything
+# else is produced by re-encoding the WAV with the ffmpeg CLI.
+STEM_FORMATS = {
+    "wav": {"ext": ".wav", "media_type": "audio/wav", "codec": None, "args": []},
+    "flac": {
+        "ext": ".flac",
+        "media_type": "audio/flac",
+        "codec": "flac",
+        "args": ["-compression_level", "5"],
+    },
+    "opus": {
+        "ext": ".opus",
+        "media_type": "audio/ogg",
+        "codec": "libopus",
+        # Opus only runs at 48 kHz; ffmpeg resamples for us
+        "args": ["-b:a", "160k", "-vbr", "on", "-ar", "48000"],
+    },
+}
+
+# Order in which an already-encoded stem is looked up on disk
+STEM_EXTENSIONS = [spec["ext"] for name, spec in STEM_FORMATS.items() if name != "wav"] + [".wav"]
+
+ZIP_CHUNK_SIZE = 256 * 1024
+
+# ffmpeg runs out of process, so threads are enough to keep every core busy
+_encode_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("STEM_ENCODE_WORKERS", os.cpu_count() or 4)),
+    thread_name_prefix="stem-encode",
+)
+
+
+def encoder_available(fmt: str) -> bool:
+    """Whether this host can produce `fmt` (compressed formats need ffmpeg)"""
+    return STEM_FORMATS[fmt]["codec"] is None or shutil.which("ffmpeg") is not None
+
+
+def encode_stem(wav_path: str, fmt: str, keep_source: bool = False) -> str:
+    """Encode a single WAV stem, returning the path of the encoded file"""
+    spec = STEM_FORMATS[fmt]
+    if spec["codec"] is None:
+        return wav_path
+
+    out_path = os.path.splitext(wav_path)[0] + spec["ext"]
+    result = subprocess.run(
+        [
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+            "-i", wav_path,
+            "-c:a", spec["codec"],
+            *spec["args"],
+            out_path,
+        ],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg failed to encode {os.path.basename(wav_path)}: {result.stderr.strip()}")
+
+    if not keep_source:
+        os.unlink(wav_path)
+    return out_path
+
+
+def encode_stems(stem_paths: Dict[str, str], fmt: str, keep_source: bool = False) -> Dict[str, str]:
+    """
+    Encode every stem in parallel on the shared encode pool
+
+    Args:
+        stem_paths: stem name -> WAV path
+        fmt: one of STEM_FORMATS
+        keep_source: keep the WAV next to the encoded file
+
+    Returns:
+        stem name -> encoded file path
+    """
+    if STEM_FORMATS[fmt]["codec"] is None:
+        return dict(stem_paths)
+
+    futures = {
+        name: _encode_pool.submit(encode_stem, path, fmt, keep_source)
+        for name, path in stem_paths.items()
+    }
+    return {name: future.result() for name, future in futures.items()}
+
+
+def find_stem_file(stem_dir: str, stem_name: str) -> Optional[str]:
+    """Locate a stem on disk regardless of which format it was encoded to"""
+    for ext in STEM_EXTENSIONS:
+        path = os.path.join(stem_dir, f"{stem_name}{ext}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def list_stem_files(stem_dir: str) -> List[str]:
+    """All stem files in a separator output directory, sorted by name"""
+    if not os.path.isdir(stem_dir):
+        return []
+    return sorted(
+        os.path.join(stem_dir, name)
+        for name in os.listdir(stem_dir)
+        if os.path.splitext(name)[1] in STEM_EXTENSIONS
+    )
+
+
+def format_for_path(path: str) -> str:
+    ext = os.path.splitext(path)[1]
+    for name, spec in STEM_FORMATS.items():
+        if spec["ext"] == ext:
+            return name
+    return "wav"
+
+
+class _ChunkSink:
+    """Write-only file object that collects whatever zipfile emits"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(entries: List[Tuple[str, str]]) -> Iterator[bytes]:
+    """
+    Build a zip archive on the fly and yield it chunk by chunk
+
+    The sink is not seekable, so zipfile falls back to data descriptors and
+    nothing is ever staged on disk. Stems are already compressed (or are PCM
+    that barely deflates), so entries are stored as-is.
+
+    Args:
+        entries: (name inside the archive, path on disk)
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for arcname, path in entries:
+            with open(path, "rb") as src, archive.open(arcname, mode="w", force_zip64=True) as dst:
+                while True:
+                    chunk = src.read(ZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def _not_modified(request_headers: Headers, response_headers: Headers) -> bool:
+    """Whether If-None-Match / If-Modified-Since say the client's copy is current"""
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or response_headers["etag"] in tags
+
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return (
+                parsedate_to_datetime(response_headers["last-modified"])
+                <= parsedate_to_datetime(if_modified_since)
+            )
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def stem_file_response(
+    path: str,
+    request_headers: Headers,
+    media_type: str,
+    filename: Optional[str] = None,
+) -> Response:
+    """
+    Serve a stem file, or 304 when the client's cached copy is current
+
+    Starlette's FileResponse handles HEAD, Range and If-Range (206/416) and
+    hands the file to the server with http.response.pathsend where the server
+    offers it, so the server can send it zero-copy. Servers without pathsend
+    (uvicorn) get the body in chunks read by Starlette. FileResponse leaves
+    conditional GET to the app, which is the check done here.
+    """
+    response = FileResponse(path, media_type=media_type, filename=filename, stat_result=os.stat(path))
+    if _not_modified(request_headers, response.headers):
+        return Response(
+            status_code=304,
+            headers={name: response.headers[name] for name in ("etag", "last-modified")},
+        )
+    return response
@@ -0,0 +1,178 @@
+"""
+Fingerprint Reuse Tests
+Analysis and stems may only be reused for a copy of the same master: a lossy
+re-encode qualifies, a trimmed clip or another version of the song
+(instrumental, a cappella) does not, even though it scores above the lookup
+threshold.
+
+Usage:
+    cd python-worker-enhanced && python -m pytest -q test_fingerprint.py
+"""
+
+import io
+
+import numpy as np
+import pytest
+import soundfile as sf
+from fastapi.testclient import TestClient
+
+from fingerprint import (
+    DEFAULT_THRESHOLD,
+    HOP_SECONDS,
+    REUSE_THRESHOLD,
+    FingerprintIndex,
+    Match,
+    compare,
+    compute_fingerprint,
+)
+
+SR = 22050
+SECONDS = 30
+
+
+def tone(freq: float, n: int) -> np.ndarray:
+    t = np.arange(n) / SR
+    return sum(level * np.sin(2 * np.pi * freq * (k + 1) * t) for k, level in enumerate((1.0, 0.5, 0.25)))
+
+
+def song(seed: int):
+    """(instrumental, vocal) of a synthetic song: chords, kick and hats, and a melody"""
+    rng = np.random.default_rng(seed)
+    n = SECONDS * SR
+    instrumental, vocal = np.zeros(n), np.zeros(n)
+
+    for i, root in enumerate(rng.choice([48, 50, 52, 53, 55, 57, 59], size=SECONDS // 2)):
+        start, end = i * 2 * SR, min(n, (i + 1) * 2 * SR)
+        for interval in (0, 4, 7):
+            instrumental[start:end] += 0.12 * tone(440 * 2 ** ((root + interval - 69) / 12), end - start)
+
+    for start in range(0, n, SR // 2):
+        end = min(n, start + SR // 2)
+        t = np.arange(end - start) / SR
+        instrumental[start:end] += 0.5 * np.sin(2 * np.pi * 55 * t) * np.exp(-t * 12)
+        instrumental[start:end] += 0.08 * rng.standard_normal(end - start) * np.exp(-t * 40)
+
+    start = 0
+    while start < n:
+        end = min(n, start + int(SR * rng.choice([0.25, 0.5, 0.75])))
+        pitch = rng.choice([60, 62, 64, 65, 67, 69, 71, 72])
+        t = np.arange(end - start) / SR
+        vocal[start:end] += 0.3 * tone(440 * 2 ** ((pitch - 69) / 12), end - start) * np.minimum(1.0, t * 20)
+        start = end
+
+    return instrumental, vocal
+
+
+@pytest.fixture
+def index(tmp_path):
+    return FingerprintIndex(root=str(tmp_path))
+
+
+@pytest.fixture
+def mix_track(index):
+    instrumental, vocal = song(1)
+    mix = compute_fingerprint(0.5 * (instrumental + vocal), SR)
+    return index.add(mix), mix, instrumental, vocal
+
+
+@pytest.mark.parametrize("version", ["instrumental", "a cappella"])
+def test_other_version_does_not_reuse_stems(index, mix_track, version):
+    track_id, _, instrumental, vocal = mix_track
+    upload = compute_fingerprint(0.5 * (instrumental if version == "instrumental" else vocal), SR)
+
+    match = index.lookup(upload)
+
+    # Same length and start, so only the similarity tells them apart
+    if match is not None:
+        assert match.track_id == track_id
+        assert match.aligned_with(upload)
+        assert match.similarity < REUSE_THRESHOLD
+        assert not match.reusable(upload)
+
+
+def test_near_duplicate_over_lookup_threshold_is_another_recording(mix_track):
+    # Scored directly, past the LSH buckets: the a cappella clears the lookup
+    # threshold, as a mix and its instrumental did at 0.496
+    track_id, mix, _, vocal = mix_track
+    upload = compute_fingerprint(0.5 * vocal, SR)
+    similarity, offset, _ = compare(upload, mix.codes)
+    match = Match(track_id, similarity, offset * HOP_SECONDS, mix.duration, None)
+
+    assert similarity >= DEFAULT_THRESHOLD
+    assert match.aligned_with(upload)
+    assert not match.reusable(upload)
+
+
+def test_lossy_copy_reuses_stems(index, mix_track, tmp_path):
+    if "MP3" not in sf.available_formats():
+        pytest.skip("libsndfile without MP3 support")
+    track_id, _, instrumental, vocal = mix_track
+    path = str(tmp_path / "copy.mp3")
+    # ~64 kbps at this rate
+    sf.write(path, 0.5 * (instrumental + vocal), SR, format="MP3", subtype="MPEG_LAYER_III", compression_level=0.0)
+    decoded, sr = sf.read(path, dtype="float32")
+
+    upload = compute_fingerprint(decoded[:SECONDS * SR], sr)
+    match = index.lookup(upload)
+
+    assert match is not None and match.track_id == track_id
+    assert match.reusable(upload)
+
+
+def test_unrelated_song_is_not_matched(index, mix_track):
+    instrumental, vocal = song(101)
+    assert index.lookup(compute_fingerprint(0.5 * (instrumental + vocal), SR)) is None
+
+
+@pytest.fixture
+def client(index, monkeypatch):
+    import main
+
+    def fake_analysis(y, sr, token=None, y_multi=None, series=None):
+        return {"audioFeatures": {"duration": round(len(y) / sr, 1)}}
+
+    # Only the reuse decision is under test, not the analysis itself
+    monkeypatch.setattr(main, "fingerprints", index)
+    monkeypatch.setattr(main, "run_analysis", fake_analysis)
+    return TestClient(main.app)
+
+
+def analyze(client, y: np.ndarray) -> dict:
+    upload = io.BytesIO()
+    sf.write(upload, y, SR, format="WAV")
+    response = client.post("/analyze/enhanced", files={"file": ("upload.wav", upload.getvalue())})
+    assert response.status_code == 200
+    return response.json()
+
+
+@pytest.mark.parametrize("version", ["trimmed clip", "instrumental"])
+def test_other_recording_gets_fresh_analysis(client, index, monkeypatch, version):
+    # Seed with an instrumental over the lookup threshold (0.455)
+    instrumental, vocal = song(24)
+    mix = 0.5 * (instrumental + vocal)
+    assert not analyze(client, mix)["dedup"]["reused"]
+    mix_fp = compute_fingerprint(mix, SR)
+    lookup = index.lookup
+
+    def lookup_or_score(fingerprint):
+        # LSH misses synthetic versions of a song, where real ones can land in
+        # a shared bucket (an instrumental at 0.496), so score against the mix
+        match = lookup(fingerprint)
+        if match is None:
+            similarity, offset, _ = compare(fingerprint, mix_fp.codes)
+            stored = lookup(mix_fp)
+            if similarity >= DEFAULT_THRESHOLD:
+                match = Match(stored.track_id, similarity, offset * HOP_SECONDS, stored.duration, stored.analysis)
+        return match
+
+    monkeypatch.setattr(index, "lookup", lookup_or_score)
+
+    upload = mix[:18 * SR] if version == "trimmed clip" else 0.5 * instrumental
+    assert index.lookup(compute_fingerprint(upload, SR)) is not None
+    result = analyze(client, upload)
+
+    assert not result["dedup"]["reusedAnalysis"]
+    assert result["audioFeatures"]["duration"] == round(len(upload) / SR, 1)
+    # Indexed as a recording of its own, which a re-upload then reuses
+    assert analyze(client, upload)["dedup"]["reusedAnalysis"]
+    assert analyze(client, mix)["audioFeatures"]["duration"] == SECONDS
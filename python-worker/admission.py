@@ -0,0 +1,431 @@
+"""
+Memory Admission Guard
+Estimates what a request will hold in memory from its upload's header
+(duration, sample rate, channels) before anything is decoded, then runs it
+as is, downsampled or in segments, or rejects it, against a memory budget;
+afterwards logs and records what the request actually peaked at
+
+Shared by python-worker and python-worker-enhanced; keep both copies in sync
+(scripts/check_shared_modules.py fails when they drift).
+"""
+
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+try:
+    import soundfile as sf
+except ImportError:  # python-worker decodes through Spleeter's ffmpeg only
+    sf = None
+
+MB = 1024 ** 2
+
+# Formats neither libsndfile nor ffprobe can read are sized from the upload
+# at this bitrate; a low guess makes the duration (and estimate) err long
+FALLBACK_BITRATE = 96_000
+
+RSS_SAMPLE_SECONDS = 0.05
+
+
+class MemoryTooLarge(Exception):
+    """The request would not fit the per-request budget in any mode"""
+
+    def __init__(self, message: str, estimate_bytes: int, budget_bytes: int):
+        super().__init__(message)
+        self.estimate_bytes = estimate_bytes
+        self.budget_bytes = budget_bytes
+
+
+class MemoryBusy(Exception):
+    """Requests in flight hold the memory this one needs"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class AudioHeader:
+    duration: float
+    sample_rate: int
+    channels: int
+    source: str  # soundfile, ffprobe or size (a guess from the byte count)
+
+
+def probe_audio(path: str) -> AudioHeader:
+    """Duration, rate and channels from the container header, without decoding"""
+    if sf is not None:
+        try:
+            info = sf.info(path)
+            if info.frames > 0:
+                return AudioHeader(info.duration, info.samplerate, info.channels, "soundfile")
+        except Exception:
+            pass
+
+    if shutil.which("ffprobe"):
+        try:
+            result = subprocess.run(
+                [
+                    "ffprobe", "-v", "error", "-select_streams", "a:0",
+                    "-show_entries", "stream=sample_rate,channels,duration:format=duration",
+                    "-of", "json", path,
+                ],
+                capture_output=True, timeout=10, check=True,
+            )
+            data = json.loads(result.stdout)
+            stream = data["streams"][0]
+            duration = stream.get("duration") or data["format"]["duration"]
+            return AudioHeader(float(duration), int(stream["sample_rate"]), int(stream["channels"]), "ffprobe")
+        except (subprocess.SubprocessError, ValueError, KeyError, IndexError):
+            pass
+
+    return AudioHeader(os.path.getsize(path) * 8 / FALLBACK_BITRATE, 44100, 2, "size")
+
+
+@dataclass
+class PipelineCost:
+    """
+    Working set of one pipeline as fixed + frames * (frame + channel * channels)
+
+    `sample_rate` and `max_seconds` are for pipelines that always decode at
+    one rate (Spleeter: 44.1 kHz) or stop after a fixed length.
+    """
+
+    fixed_bytes: int
+    frame_bytes: float
+    channel_frame_bytes: float = 0.0
+    sample_rate: Optional[int] = None
+    max_seconds: Optional[float] = None
+
+    def estimate(self, header: AudioHeader, sample_rate: Optional[int] = None, seconds: Optional[float] = None) -> int:
+        rate = sample_rate or self.sample_rate or header.sample_rate
+        duration = header.duration
+        for limit in (seconds, self.max_seconds):
+            if limit is not None:
+                duration = min(duration, limit)
+        per_frame = self.frame_bytes + self.channel_frame_bytes * header.channels
+        return int(self.fixed_bytes + duration * rate * per_frame)
+
+
+@dataclass
+class AdmissionPlan:
+    action: str  # run, downsample or stream
+    estimate_bytes: int
+    header: AudioHeader
+    sample_rate: Optional[int] = None  # decode rate; None keeps the file's
+    segment_seconds: Optional[float] = None  # set when action is stream
+
+
+def memory_limit_bytes() -> Optional[int]:
+    """Physical memory, or the container's cgroup limit if lower"""
+    limits = []
+    try:
+        limits.append(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"))
+    except (ValueError, OSError, AttributeError):
+        pass
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            if value.isdigit() and int(value) < 1 << 60:
+                limits.append(int(value))
+        except OSError:
+            pass
+    return min(limits) if limits else None
+
+
+def process_tree_rss(pid: int) -> Optional[int]:
+    """Resident bytes of a process and its descendants (Linux /proc), else None"""
+    total, pending, seen = 0, [pid], set()
+    while pending:
+        current = pending.pop()
+        if current in seen:
+            continue
+        seen.add(current)
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            if current == pid:
+                return None
+    return total
+
+
+class RequestMemory:
+    """What one request used; filled in by MemoryGuard.track()"""
+
+    def __init__(self, label: str, plan: Optional[AdmissionPlan]):
+        self.label = label
+        self.plan = plan
+        self.started = time.monotonic()
+        self.seconds = 0.0
+        self.rss_start: Optional[int] = None
+        self.rss_peak: Optional[int] = None
+        self.traced_peak: Optional[int] = None
+
+    @property
+    def rss_growth(self) -> Optional[int]:
+        if self.rss_start is None or self.rss_peak is None:
+            return None
+        return max(0, self.rss_peak - self.rss_start)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "label": self.label,
+            "action": self.plan.action if self.plan else None,
+            "estimate_bytes": self.plan.estimate_bytes if self.plan else None,
+            "rss_peak_bytes": self.rss_peak,
+            "rss_growth_bytes": self.rss_growth,
+            "traced_peak_bytes": self.traced_peak,
+            "seconds": round(self.seconds, 3),
+        }
+
+
+class MemoryGuard:
+    """
+    Memory budget for decoded audio and its working set
+
+    - plan() picks how to run an upload from its header: as is, at a lower
+      sample rate, or in segments, and raises MemoryTooLarge if none fits
+      the per-request budget
+    - reserve() holds the plan's estimate while it runs; requests that would
+      push the total past the budget wait (up to queue_timeout), then get
+      MemoryBusy. acquire() and release() do the same for a reservation that
+      outlives one block (the Spleeter batcher holds one from decode to write)
+    - track() samples the process tree's RSS (and, with MEMORY_TRACEMALLOC=1,
+      the traced Python/NumPy heap) and logs the request's peak next to its
+      estimate. Both are process-wide, so with requests overlapping a peak
+      includes its neighbours' memory.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        budget_bytes: Optional[int] = None,
+        request_budget_bytes: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+        log_prefix: str = "[MEMORY]",
+    ):
+        env = os.environ.get
+        self.name = name
+        self.log_prefix = log_prefix
+        limit = memory_limit_bytes() or 4096 * MB
+        self.budget_bytes = budget_bytes or int(float(env("MEMORY_BUDGET_MB", "0")) * MB) or int(limit * 0.6)
+        self.request_budget_bytes = (
+            request_budget_bytes
+            or int(float(env("MEMORY_REQUEST_BUDGET_MB", "0")) * MB)
+            or self.budget_bytes
+        )
+        self.queue_timeout = queue_timeout if queue_timeout is not None else float(env("MEMORY_QUEUE_TIMEOUT", "30"))
+        self.trace = env("MEMORY_TRACEMALLOC", "0") == "1"
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._waiting = 0
+        self._active: List[RequestMemory] = []
+        self._sampler: Optional[threading.Thread] = None
+        self._recent: deque = deque(maxlen=20)
+        self._counters: Dict[str, Any] = {
+            "run": 0,
+            "downsample": 0,
+            "stream": 0,
+            "rejected": 0,
+            "busy": 0,
+            "queued": 0,
+            "queue_wait_seconds": 0.0,
+            "measured": 0,
+            "max_rss_bytes": 0,
+            "max_rss_growth_bytes": 0,
+            "max_traced_peak_bytes": 0,
+            "max_growth_to_estimate": 0.0,
+        }
+
+    # ------------------------------------------------------------------
+    # Admission
+
+    def plan(
+        self,
+        header: AudioHeader,
+        cost: PipelineCost,
+        downsample_rates: Sequence[int] = (),
+        segment_seconds: Optional[float] = None,
+    ) -> AdmissionPlan:
+        estimate = cost.estimate(header)
+        plan = None
+        if estimate <= self.request_budget_bytes:
+            plan = AdmissionPlan("run", estimate, header)
+        else:
+            for rate in sorted(downsample_rates, reverse=True):
+                reduced = cost.estimate(header, sample_rate=rate)
+                if rate < header.sample_rate and reduced <= self.request_budget_bytes:
+                    plan = AdmissionPlan("downsample", reduced, header, sample_rate=rate)
+                    break
+        if plan is None and segment_seconds:
+            segment = cost.estimate(header, seconds=segment_seconds)
+            if segment <= self.request_budget_bytes:
+                plan = AdmissionPlan("stream", segment, header, segment_seconds=segment_seconds)
+
+        with self._lock:
+            self._counters[plan.action if plan else "rejected"] += 1
+        if plan is None:
+            raise MemoryTooLarge(
+                f"{header.duration / 60:.1f} min of audio needs ~{estimate // MB} MB to process, "
+                f"over the {self.request_budget_bytes // MB} MB per-request budget",
+                estimate, self.request_budget_bytes,
+            )
+        return plan
+
+    def _fits(self, nbytes: int) -> bool:
+        with self._lock:
+            # A lone request always runs; plan() already held it to the budget
+            return self._reserved == 0 or self._reserved + nbytes <= self.budget_bytes
+
+    @asynccontextmanager
+    async def reserve(self, plan: AdmissionPlan):
+        await self.acquire(plan)
+        try:
+            yield
+        finally:
+            self.release(plan)
+
+    async def acquire(self, plan: AdmissionPlan, queue_timeout: Optional[float] = None):
+        """
+        Take the plan's estimate out of the budget, waiting for room
+
+        `queue_timeout` overrides the guard's; math.inf waits until memory
+        frees. Every acquire() needs exactly one release().
+        """
+        nbytes = plan.estimate_bytes
+        timeout = self.queue_timeout if queue_timeout is None else queue_timeout
+        if not self._fits(nbytes):
+            started = time.monotonic()
+            with self._lock:
+                self._waiting += 1
+                self._counters["queued"] += 1
+            try:
+                while not self._fits(nbytes):
+                    waited = time.monotonic() - started
+                    if waited >= timeout:
+                        with self._lock:
+                            self._counters["busy"] += 1
+                        raise MemoryBusy(
+                            f"Not enough memory free for this job (needs ~{nbytes // MB} MB)",
+                            retry_after=max(1, int(timeout)),
+                        )
+                    await asyncio.sleep(min(0.25, timeout - waited))
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+                    self._counters["queue_wait_seconds"] += time.monotonic() - started
+
+        with self._lock:
+            self._reserved += nbytes
+
+    def release(self, plan: AdmissionPlan):
+        with self._lock:
+            self._reserved -= plan.estimate_bytes
+
+    # ------------------------------------------------------------------
+    # Measurement
+
+    def _sample(self):
+        pid = os.getpid()
+        while True:
+            rss = process_tree_rss(pid)
+            with self._lock:
+                if not self._active:
+                    self._sampler = None
+                    return
+                for usage in self._active:
+                    if rss is not None and (usage.rss_peak is None or rss > usage.rss_peak):
+                        usage.rss_peak = rss
+            time.sleep(RSS_SAMPLE_SECONDS)
+
+    @contextmanager
+    def track(self, label: str, plan: Optional[AdmissionPlan] = None) -> Iterator[RequestMemory]:
+        usage = RequestMemory(label, plan)
+        usage.rss_start = usage.rss_peak = process_tree_rss(os.getpid())
+        traced_start = 0
+        if self.trace:
+            traced_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        with self._lock:
+            self._active.append(usage)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name=f"{self.name}-rss", daemon=True)
+                self._sampler.start()
+        try:
+            yield usage
+        finally:
+            rss = process_tree_rss(os.getpid())
+            if rss is not None and (usage.rss_peak is None or rss > usage.rss_peak):
+                usage.rss_peak = rss
+            if self.trace:
+                usage.traced_peak = max(0, tracemalloc.get_traced_memory()[1] - traced_start)
+            usage.seconds = time.monotonic() - usage.started
+            with self._lock:
+                self._active.remove(usage)
+            self._record(usage)
+
+    def _record(self, usage: RequestMemory):
+        growth = usage.rss_growth
+        with self._lock:
+            counters = self._counters
+            counters["measured"] += 1
+            counters["max_rss_bytes"] = max(counters["max_rss_bytes"], usage.rss_peak or 0)
+            counters["max_rss_growth_bytes"] = max(counters["max_rss_growth_bytes"], growth or 0)
+            counters["max_traced_peak_bytes"] = max(counters["max_traced_peak_bytes"], usage.traced_peak or 0)
+            if usage.plan and growth is not None:
+                ratio = growth / max(1, usage.plan.estimate_bytes)
+                counters["max_growth_to_estimate"] = max(counters["max_growth_to_estimate"], ratio)
+            self._recent.append(usage.as_dict())
+
+        parts = []
+        if growth is not None:
+            parts.append(f"RSS peak {usage.rss_peak // MB} MB (+{growth // MB} MB)")
+        if usage.traced_peak is not None:
+            parts.append(f"traced peak {usage.traced_peak // MB} MB")
+        if usage.plan:
+            parts.append(f"estimate {usage.plan.estimate_bytes // MB} MB ({usage.plan.action})")
+        print(f"{self.log_prefix} Memory for {usage.label}: {', '.join(parts) or 'not measured'}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            return {
+                "budget_bytes": self.budget_bytes,
+                "request_budget_bytes": self.request_budget_bytes,
+                "reserved_bytes": self._reserved,
+                "queued_now": self._waiting,
+                "active_requests": len(self._active),
+                "process_rss_bytes": process_tree_rss(os.getpid()),
+                "tracemalloc": self.trace,
+                "admission": {
+                    key: counters.pop(key)
+                    for key in ("run", "downsample", "stream", "rejected", "busy", "queued")
+                },
+                "queue_wait_seconds": round(counters.pop("queue_wait_seconds"), 2),
+                "measured": {
+                    **counters,
+                    "max_growth_to_estimate": round(counters["max_growth_to_estimate"], 2),
+                    "recent": list(self._recent),
+                },
+            }
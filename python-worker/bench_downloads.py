@@ -0,0 +1,127 @@
+"""
+Stem Download Benchmark
+Measures concurrent stem-download throughput against a running split service
+
+Seeds a fake separation as a work directory under the service's
+STORAGE_ROOT (so it must run on the same host, with the same STORAGE_ROOT),
+then hammers /download with full-file and random-range requests.
+
+Usage:
+    uvicorn split_service:app --port 8001 --workers 1
+    python bench_downloads.py --url http://localhost:8001 --concurrency 16
+"""
+
+import argparse
+import http.client
+import os
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from storage import StorageManager
+
+
+def seed_stem(storage: StorageManager, size_mb: int) -> tuple:
+    """Create <work dir>/output/bench/vocals.wav filled with random bytes"""
+    temp_dir = storage.create_workdir(owner="bench")
+    stem_dir = os.path.join(temp_dir, "output", "bench")
+    os.makedirs(stem_dir)
+    stem_path = os.path.join(stem_dir, "vocals.wav")
+    with open(stem_path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(1024 * 1024))
+    return temp_dir, os.path.getsize(stem_path)
+
+
+def run_client(url, path, size, mode, requests_per_client, latencies, lock):
+    parsed = urlparse(url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=60)
+    transferred = 0
+    try:
+        for _ in range(requests_per_client):
+            headers = {}
+            if mode == "range":
+                # Player seek: a 256 KB window somewhere in the file
+                start = random.randrange(0, max(1, size - 256 * 1024))
+                headers["Range"] = f"bytes={start}-{start + 256 * 1024 - 1}"
+
+            started = time.perf_counter()
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+            body_bytes = 0
+            while True:
+                chunk = response.read(1024 * 1024)
+                if not chunk:
+                    break
+                body_bytes += len(chunk)
+            elapsed = time.perf_counter() - started
+
+            expected = 206 if mode == "range" else 200
+            if response.status != expected:
+                raise RuntimeError(f"Unexpected status {response.status} for {mode} request")
+
+            transferred += body_bytes
+            with lock:
+                latencies.append(elapsed)
+    finally:
+        conn.close()
+    return transferred
+
+
+def run(url, path, size, mode, concurrency, requests_per_client):
+    latencies = []
+    lock = threading.Lock()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [
+            pool.submit(run_client, url, path, size, mode, requests_per_client, latencies, lock)
+            for _ in range(concurrency)
+        ]
+        transferred = sum(f.result() for f in futures)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "req_per_s": len(latencies) / elapsed,
+        "mb_per_s": transferred / elapsed / (1024 * 1024),
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark concurrent stem downloads")
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=20, help="requests per client")
+    parser.add_argument("--size-mb", type=int, default=50, help="size of the seeded stem")
+    parser.add_argument("--modes", default="full,range")
+    parser.add_argument("--storage-root", help="the service's STORAGE_ROOT (default: same env var, else the temp dir)")
+    args = parser.parse_args()
+
+    # Same prefix as split_service's StorageManager, so /download resolves it
+    storage = StorageManager(prefix="spleeter-", root=args.storage_root)
+    temp_dir, size = seed_stem(storage, args.size_mb)
+    path = f"/download/{os.path.basename(temp_dir)}/bench/vocals"
+    print(f"Seeded {size / (1024 * 1024):.0f} MB stem at {temp_dir}")
+
+    try:
+        for mode in args.modes.split(","):
+            result = run(args.url, path, size, mode, args.concurrency, args.requests)
+            print(
+                f"{result['mode']:>5}: {result['requests']} requests in {result['seconds']:.2f}s | "
+                f"{result['req_per_s']:.1f} req/s | {result['mb_per_s']:.1f} MB/s | "
+                f"p50 {result['p50_ms']:.1f} ms | p95 {result['p95_ms']:.1f} ms"
+            )
+    finally:
+        storage.release(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
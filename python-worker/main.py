@@ -27,6 +27,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Hugging Face Space (or URL of any Gradio server with the same API) that runs
+# the analysis; load tests point this at loadtest/mock_gradio.py
+MANSUBA_SPACE = os.environ.get("MANSUBA_SPACE", "Mansuba/AI-Powered-Music-Analysis")
+
 class AnalysisRequest(BaseModel):
     audioUrl: str
     assetId: str
@@ -89,7 +93,7 @@ async def analyze_audio(request: AnalysisRequest):
         # Step 2: Initialize Mansuba client
         logger.info("Initializing Mansuba AI client...")
         try:
-            client = Client("Mansuba/AI-Powered-Music-Analysis")
+            client = Client(MANSUBA_SPACE)
             logger.info("Mansuba client initialized successfully")
         except Exception as e:
             logger.error(f"Failed to initialize Mansuba client: {str(e)}")
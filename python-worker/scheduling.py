@@ -0,0 +1,216 @@
+"""
+Deadline-Aware Scheduling
+Request deadlines, client-disconnect cancellation and an earliest-deadline-
+first admission queue that drops jobs which can no longer finish in time
+
+Shared by python-worker and python-worker-enhanced; keep both copies in sync
+(scripts/check_shared_modules.py fails when they drift).
+"""
+
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from starlette.requests import Request
+
+DISCONNECT_POLL_SECONDS = 0.5
+
+
+class DeadlineExpired(Exception):
+    """The request's deadline passed before its work could finish"""
+
+
+class ClientDisconnected(Exception):
+    """The client went away while its request was queued or running"""
+
+
+class Cancelled(Exception):
+    """Raised inside worker threads once their request has been abandoned"""
+
+
+class CancelToken:
+    """Thread-safe flag that blocking stages check between steps"""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise Cancelled("Request was cancelled")
+
+
+def request_deadline(request: Request, default_seconds: float) -> float:
+    """
+    Deadline for a request on the time.monotonic() clock
+
+    Clients may send either `X-Request-Timeout: <seconds>` or
+    `X-Request-Deadline: <unix epoch seconds>`; the tighter of the client's
+    deadline and the endpoint default wins.
+    """
+    now = time.monotonic()
+    deadline = now + default_seconds
+
+    timeout = request.headers.get("x-request-timeout")
+    if timeout:
+        try:
+            deadline = min(deadline, now + float(timeout))
+        except ValueError:
+            pass
+
+    absolute = request.headers.get("x-request-deadline")
+    if absolute:
+        try:
+            deadline = min(deadline, now + (float(absolute) - time.time()))
+        except ValueError:
+            pass
+
+    return deadline
+
+
+def remaining(deadline: Optional[float]) -> Optional[float]:
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+async def run_cancellable(
+    request: Request,
+    work: Callable[[CancelToken], Awaitable[Any]],
+    deadline: Optional[float] = None,
+) -> Any:
+    """
+    Run `work(token)` until it finishes, the client disconnects or the
+    deadline passes
+
+    On disconnect or deadline the work task is cancelled (its finally blocks
+    and subprocess handlers run) and the token is set so threads stop at
+    their next check. Raises ClientDisconnected or DeadlineExpired.
+    """
+    token = CancelToken()
+    task = asyncio.ensure_future(work(token))
+    reason: Optional[Exception] = None
+
+    try:
+        while reason is None:
+            timeout = DISCONNECT_POLL_SECONDS
+            if deadline is not None:
+                timeout = min(timeout, remaining(deadline))
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                reason = ClientDisconnected("Client disconnected")
+            elif deadline is not None and time.monotonic() >= deadline:
+                reason = DeadlineExpired("Request deadline exceeded")
+    finally:
+        if not task.done():
+            token.cancel()
+            task.cancel()
+            try:
+                await task
+            except BaseException:
+                pass
+
+    raise reason
+
+
+class DeadlineScheduler:
+    """
+    Weighted admission queue ordered by deadline (EDF)
+
+    Each job takes `weight` units of capacity (e.g. CPU threads). Waiting jobs
+    are granted in deadline order; a job whose deadline passes while queued is
+    dropped with DeadlineExpired so the capacity goes to work that can still
+    succeed.
+    """
+
+    def __init__(self, capacity: int, name: str):
+        self.capacity = max(1, capacity)
+        self.name = name
+        self.in_use = 0
+        self._waiters: List[list] = []
+        self._seq = itertools.count()
+        self._counters: Dict[str, int] = {
+            "admitted": 0,
+            "completed": 0,
+            "dropped_expired": 0,
+            "cancelled_queued": 0,
+        }
+
+    def _grant(self):
+        now = time.monotonic()
+        while self._waiters:
+            deadline, _, weight, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if deadline <= now:
+                heapq.heappop(self._waiters)
+                self._counters["dropped_expired"] += 1
+                future.set_exception(DeadlineExpired(f"Deadline passed while queued for {self.name}"))
+                continue
+            if self.in_use + weight > self.capacity:
+                break
+            heapq.heappop(self._waiters)
+            self.in_use += weight
+            future.set_result(True)
+
+    @asynccontextmanager
+    async def slot(self, weight: int = 1, deadline: Optional[float] = None):
+        weight = min(max(1, weight), self.capacity)
+
+        if deadline is not None and deadline <= time.monotonic():
+            self._counters["dropped_expired"] += 1
+            raise DeadlineExpired(f"Deadline passed before {self.name} started")
+
+        if not self._waiters and self.in_use + weight <= self.capacity:
+            self.in_use += weight
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(
+                self._waiters,
+                [deadline if deadline is not None else float("inf"), next(self._seq), weight, future],
+            )
+            try:
+                done, _ = await asyncio.wait({future}, timeout=remaining(deadline))
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    # Granted in the same tick we were cancelled; hand it back
+                    self.in_use -= weight
+                    self._grant()
+                else:
+                    future.cancel()
+                    self._counters["cancelled_queued"] += 1
+                raise
+            if not done:
+                future.cancel()
+                self._counters["dropped_expired"] += 1
+                raise DeadlineExpired(f"Deadline passed while queued for {self.name}")
+            future.result()
+
+        self._counters["admitted"] += 1
+        try:
+            yield
+        finally:
+            self.in_use -= weight
+            self._counters["completed"] += 1
+            self._grant()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "in_use": self.in_use,
+            "queued": sum(1 for waiter in self._waiters if not waiter[3].done()),
+            **self._counters,
+        }
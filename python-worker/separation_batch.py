@@ -0,0 +1,408 @@
+"""
+Spleeter Separation Batcher
+Collects separation jobs for a short window and runs them through the loaded
+separators as a pipeline: upcoming tracks decode while one is in the model,
+and finished ones are written and encoded while the next is inferred
+
+Spleeter infers one waveform per call, so a batch is not one big tensor;
+the gain is that the separators stay warm and decode, inference and write
+overlap instead of running back to back for every request.
+
+Jobs with `segment_seconds` set (files too long to hold decoded in memory)
+are decoded, separated and written one segment at a time, and the part
+files joined into whole stems before encoding. Segments meet at STFT frame
+edges, so a joint can carry a faint seam; the memory admission guard only
+picks this path when a file would not fit otherwise.
+
+Memory is reserved per job when its decode is about to start and released
+once its stems are written, so jobs waiting their turn in a batch hold
+none. Jobs are admitted in pipeline order and wait without a timeout:
+whatever holds memory is ahead of them and will finish.
+"""
+
+import asyncio
+import math
+import os
+import shutil
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from admission import AdmissionPlan, MemoryGuard
+from scheduling import CancelToken, DeadlineScheduler
+from stem_delivery import encode_stems
+
+# Spleeter models run at 44.1 kHz and separate_to_file() stops at 10 minutes
+SAMPLE_RATE = 44100
+MAX_DURATION = 600.0
+
+
+@dataclass
+class BatchJob:
+    input_path: str
+    output_dir: str
+    stems: int
+    format: str
+    token: CancelToken
+    deadline: Optional[float]
+    future: asyncio.Future
+    segment_seconds: Optional[float] = None
+    duration: Optional[float] = None
+    plan: Optional[AdmissionPlan] = None
+    reserved: bool = False
+
+    @property
+    def stem_dir(self) -> str:
+        # Same layout as separate_to_file(): <output_dir>/<file stem>/<stem>.wav
+        return os.path.join(self.output_dir, Path(self.input_path).stem)
+
+
+class SeparationBatcher:
+    """
+    Micro-batching front end for Spleeter
+
+    - submit() queues a job and resolves to its {stem: path} map once the
+      stems are written and encoded; cancelling the awaiting task drops it
+    - jobs arriving within `window` seconds of each other (up to `max_batch`)
+      form a batch, run grouped by model and in deadline order
+    - `decode_ahead` tracks are decoded ahead of the model; inference runs on
+      a single thread and still takes its turn from `scheduler`
+    - with `memory`, each job's plan is reserved from decode to write
+    """
+
+    def __init__(
+        self,
+        separators: Dict[int, Any],
+        audio_adapter: Any,
+        scheduler: DeadlineScheduler,
+        window: Optional[float] = None,
+        max_batch: Optional[int] = None,
+        decode_ahead: Optional[int] = None,
+        write_workers: Optional[int] = None,
+        memory: Optional[MemoryGuard] = None,
+    ):
+        env = os.environ.get
+        self.separators = separators
+        self.audio_adapter = audio_adapter
+        self.scheduler = scheduler
+        self.memory = memory
+        self.window = window if window is not None else float(env("SPLIT_BATCH_WINDOW_MS", "50")) / 1000
+        self.max_batch = max_batch or int(env("SPLIT_BATCH_MAX", "8"))
+        self.decode_ahead = decode_ahead or int(env("SPLIT_DECODE_AHEAD", "2"))
+        write_workers = write_workers or int(env("SPLIT_WRITE_WORKERS", "2"))
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._writes: set = set()
+        self._decode_pool = ThreadPoolExecutor(self.decode_ahead, thread_name_prefix="split-decode")
+        self._infer_pool = ThreadPoolExecutor(1, thread_name_prefix="split-infer")
+        self._write_pool = ThreadPoolExecutor(write_workers, thread_name_prefix="split-write")
+        self._counters: Dict[str, Any] = {
+            "batches": 0,
+            "jobs": 0,
+            "segments": 0,
+            "completed": 0,
+            "failed": 0,
+            "dropped": 0,
+            "largest_batch": 0,
+            "decode_seconds": 0.0,
+            "inference_seconds": 0.0,
+            "write_seconds": 0.0,
+        }
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Queue and runner belong to one event loop; rebuild them if the
+            # app is served from a new one (e.g. after a test client restart)
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._runner = None
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+    async def submit(
+        self,
+        input_path: str,
+        output_dir: str,
+        stems: int,
+        format: str,
+        token: CancelToken,
+        deadline: Optional[float] = None,
+        segment_seconds: Optional[float] = None,
+        duration: Optional[float] = None,
+        plan: Optional[AdmissionPlan] = None,
+    ) -> Dict[str, str]:
+        """
+        Separate one file; returns {stem name: encoded stem path}
+
+        With `segment_seconds`, the file (`duration` seconds long, from its
+        header) is processed in segments instead of decoded whole. `plan` is
+        the memory reserved for the job while it is decoded, separated and
+        written.
+        """
+        self.start()
+        job = BatchJob(
+            input_path=input_path,
+            output_dir=output_dir,
+            stems=stems,
+            format=format,
+            token=token,
+            deadline=deadline,
+            future=asyncio.get_running_loop().create_future(),
+            segment_seconds=segment_seconds,
+            duration=duration,
+            plan=plan,
+        )
+        self._counters["jobs"] += 1
+        self._queue.put_nowait(job)
+        return await job.future
+
+    # ------------------------------------------------------------------
+    # Pipeline
+
+    async def _collect(self) -> List[BatchJob]:
+        batch = [await self._queue.get()]
+        closes = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = closes - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        while len(batch) < self.max_batch and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            self._counters["batches"] += 1
+            self._counters["largest_batch"] = max(self._counters["largest_batch"], len(batch))
+            # One model after another, earliest deadline first within each
+            batch.sort(key=lambda job: (job.stems, job.deadline if job.deadline is not None else float("inf")))
+            await self._run_batch(batch)
+
+    async def _run_batch(self, batch: List[BatchJob]):
+        loop = asyncio.get_running_loop()
+        prepared: Dict[int, asyncio.Future] = {}
+        admitted: Optional[asyncio.Future] = None
+
+        def prepare_next(index: int):
+            nonlocal admitted
+            if index < len(batch) and not batch[index].future.done():
+                admitted = asyncio.ensure_future(self._admit(batch[index], admitted))
+                prepared[index] = asyncio.ensure_future(self._prepare(batch[index], admitted))
+
+        for index in range(self.decode_ahead):
+            prepare_next(index)
+
+        for index, job in enumerate(batch):
+            prepare_next(index + self.decode_ahead)
+            preparing = prepared.pop(index, None)
+            if preparing is None:
+                self._counters["dropped"] += 1
+                continue
+            try:
+                waveform = await preparing
+                if job.future.done():
+                    self._drop(job)
+                    continue
+                if job.segment_seconds:
+                    await self._run_segmented(job)
+                    continue
+                async with self.scheduler.slot(1, job.deadline):
+                    job.token.check()
+                    sources = await loop.run_in_executor(self._infer_pool, self._separate, job, waveform)
+                del waveform
+            except Exception as e:
+                self._fail(job, e)
+                continue
+
+            self._start_write(job, self._save, sources)
+
+    async def _admit(self, job: BatchJob, previous: Optional[asyncio.Future]):
+        """
+        Reserve the job's memory once every job before it holds its own
+
+        Taking memory in pipeline order means a job only waits on jobs ahead
+        of it, which run and release regardless, so it waits as long as that
+        takes. A request that goes away while waiting takes nothing.
+        """
+        if previous is not None:
+            await asyncio.wait([previous])
+        if self.memory is None or job.plan is None or job.future.done():
+            return
+        waiting = asyncio.ensure_future(self.memory.acquire(job.plan, queue_timeout=math.inf))
+        await asyncio.wait([waiting, job.future], return_when=asyncio.FIRST_COMPLETED)
+        if not waiting.done():
+            waiting.cancel()
+            return
+        waiting.result()
+        job.reserved = True
+
+    async def _prepare(self, job: BatchJob, admitted: asyncio.Future):
+        """Decode a job once its memory is reserved (segmented jobs decode their own)"""
+        await admitted
+        if job.future.done() or job.segment_seconds:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(self._decode_pool, self._decode, job)
+
+    async def _run_segmented(self, job: BatchJob):
+        loop = asyncio.get_running_loop()
+        duration = min(job.duration or MAX_DURATION, MAX_DURATION)
+        parts: Dict[str, List[str]] = {}
+        offset, number = 0.0, 0
+        try:
+            while offset < duration:
+                length = min(job.segment_seconds, duration - offset)
+                waveform = await loop.run_in_executor(self._decode_pool, self._decode, job, offset, length)
+                if job.future.done():
+                    self._drop(job)
+                    return
+                if len(waveform) == 0:
+                    break
+                async with self.scheduler.slot(1, job.deadline):
+                    job.token.check()
+                    sources = await loop.run_in_executor(self._infer_pool, self._separate, job, waveform)
+                del waveform
+                written = await loop.run_in_executor(self._write_pool, self._save_part, job, number, sources)
+                del sources
+                for name, path in written.items():
+                    parts.setdefault(name, []).append(path)
+                self._counters["segments"] += 1
+                offset += length
+                number += 1
+        except Exception as e:
+            self._fail(job, e)
+            return
+        self._start_write(job, self._join, parts)
+
+    def _decode(self, job: BatchJob, offset: float = 0.0, duration: float = MAX_DURATION):
+        job.token.check()
+        start = time.monotonic()
+        waveform, _ = self.audio_adapter.load(
+            job.input_path, offset=offset, duration=duration, sample_rate=SAMPLE_RATE
+        )
+        self._counters["decode_seconds"] += time.monotonic() - start
+        return waveform
+
+    def _separate(self, job: BatchJob, waveform) -> Dict[str, Any]:
+        start = time.monotonic()
+        sources = self.separators[job.stems].separate(waveform, job.input_path)
+        self._counters["inference_seconds"] += time.monotonic() - start
+        return sources
+
+    def _save(self, job: BatchJob, sources: Dict[str, Any]) -> Dict[str, str]:
+        job.token.check()
+        start = time.monotonic()
+        wav_files = {}
+        for name, data in sources.items():
+            path = os.path.join(job.stem_dir, f"{name}.wav")
+            self.audio_adapter.save(path, data, SAMPLE_RATE, "wav", "128k")
+            wav_files[name] = path
+        stem_files = encode_stems(wav_files, job.format)
+        self._counters["write_seconds"] += time.monotonic() - start
+        return stem_files
+
+    def _save_part(self, job: BatchJob, number: int, sources: Dict[str, Any]) -> Dict[str, str]:
+        job.token.check()
+        start = time.monotonic()
+        parts = {}
+        for name, data in sources.items():
+            path = os.path.join(job.stem_dir, "parts", f"{name}.{number:04d}.wav")
+            self.audio_adapter.save(path, data, SAMPLE_RATE, "wav", "128k")
+            parts[name] = path
+        self._counters["write_seconds"] += time.monotonic() - start
+        return parts
+
+    def _join(self, job: BatchJob, parts: Dict[str, List[str]]) -> Dict[str, str]:
+        job.token.check()
+        start = time.monotonic()
+        wav_files = {}
+        for name, paths in parts.items():
+            path = os.path.join(job.stem_dir, f"{name}.wav")
+            with wave.open(path, "wb") as joined:
+                for index, part_path in enumerate(paths):
+                    with wave.open(part_path, "rb") as part:
+                        if index == 0:
+                            joined.setparams(part.getparams())
+                        # Copy in blocks so a stem never sits in memory whole
+                        while True:
+                            frames = part.readframes(SAMPLE_RATE * 10)
+                            if not frames:
+                                break
+                            joined.writeframesraw(frames)
+            wav_files[name] = path
+        shutil.rmtree(os.path.join(job.stem_dir, "parts"), ignore_errors=True)
+        stem_files = encode_stems(wav_files, job.format)
+        self._counters["write_seconds"] += time.monotonic() - start
+        return stem_files
+
+    def _start_write(self, job: BatchJob, save, payload):
+        write = asyncio.ensure_future(self._write(job, save, payload))
+        self._writes.add(write)
+        write.add_done_callback(self._writes.discard)
+
+    async def _write(self, job: BatchJob, save, payload):
+        try:
+            stem_files = await asyncio.get_running_loop().run_in_executor(
+                self._write_pool, save, job, payload
+            )
+        except Exception as e:
+            self._fail(job, e)
+            return
+        self._release(job)
+        if not job.future.done():
+            self._counters["completed"] += 1
+            job.future.set_result(stem_files)
+
+    def _fail(self, job: BatchJob, error: Exception):
+        if job.future.done():
+            self._drop(job)
+            return
+        self._release(job)
+        self._counters["failed"] += 1
+        job.future.set_exception(error)
+
+    def _drop(self, job: BatchJob):
+        self._release(job)
+        self._counters["dropped"] += 1
+
+    def _release(self, job: BatchJob):
+        if job.reserved:
+            job.reserved = False
+            self.memory.release(job.plan)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_ms": round(self.window * 1000),
+            "max_batch": self.max_batch,
+            "decode_ahead": self.decode_ahead,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "writing": len(self._writes),
+            **{
+                key: round(value, 3) if isinstance(value, float) else value
+                for key, value in self._counters.items()
+            },
+        }
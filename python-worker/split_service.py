@@ -3,15 +3,37 @@ Spleeter Stem Separation Service
 Fast, free, open-source stem separation using Deezer's Spleeter
 """
 
+import asyncio
+import importlib
 import os
-import tempfile
-from pathlib import Path
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import time
+from typing import Any, Dict, List
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from spleeter.separator import Separator
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 import uvicorn
-import shutil
+
+from stem_delivery import (
+    STEM_FORMATS,
+    encoder_available,
+    find_stem_file,
+    format_for_path,
+    iter_zip,
+    list_stem_files,
+    stem_file_response,
+)
+from storage import StorageFull, StorageManager, estimate_separation_bytes
+from separation_batch import MAX_DURATION, SAMPLE_RATE, SeparationBatcher
+from admission import MB, MemoryGuard, MemoryTooLarge, PipelineCost, probe_audio
+from scheduling import (
+    CancelToken,
+    ClientDisconnected,
+    DeadlineExpired,
+    DeadlineScheduler,
+    request_deadline,
+    run_cancellable,
+)
 
 app = FastAPI(title="Spleeter Stem Separation Service")
 
@@ -24,6 +46,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Separator and audio I/O implementations as "module:Class"; load tests swap
+# in stand-ins with the same interface (see loadtest/fake_separators.py)
+SEPARATOR_CLASS = os.environ.get("SEPARATOR_CLASS", "spleeter.separator:Separator")
+AUDIO_ADAPTER_CLASS = os.environ.get("AUDIO_ADAPTER_CLASS", "spleeter.audio.adapter:AudioAdapter")
+
+def load_class(spec: str):
+    module_name, _, class_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+def load_separator_class():
+    return load_class(SEPARATOR_CLASS)
+
+Separator = load_separator_class()
+
 # Initialize Spleeter separators
 # 2stems: vocals + accompaniment
 # 4stems: vocals, drums, bass, other
@@ -32,19 +68,133 @@ separator_2stems = Separator('spleeter:2stems')
 separator_4stems = Separator('spleeter:4stems')
 separator_5stems = Separator('spleeter:5stems')
 
+# Every separation gets a work directory with an owner and a TTL; the janitor
+# evicts it if the client never calls /cleanup
+storage = StorageManager(prefix="spleeter-")
+
+@app.on_event("startup")
+async def start_storage_janitor():
+    storage.start()
+
+@app.on_event("shutdown")
+async def stop_storage_janitor():
+    await storage.stop()
+    await batcher.stop()
+
+# Default deadline for a split in seconds; clients can tighten it with
+# X-Request-Timeout or X-Request-Deadline
+SPLIT_DEADLINE = 330
+
+# The separators share one TensorFlow runtime, so jobs run one at a time and
+# queue earliest-deadline-first
+separation_scheduler = DeadlineScheduler(1, name="spleeter")
+
+# Decoded audio and Spleeter's working set are budgeted per request and in
+# total (MEMORY_BUDGET_MB, MEMORY_REQUEST_BUDGET_MB); uploads are sized from
+# their header before anything is decoded
+memory = MemoryGuard("spleeter", log_prefix="[SPLEETER]")
+
+# Every split goes through the batcher: concurrent requests arriving within
+# a short window share a pipeline that decodes and writes around inference.
+# It holds each job's memory from decode to write, so queued jobs hold none
+batcher = SeparationBatcher(
+    {2: separator_2stems, 4: separator_4stems, 5: separator_5stems},
+    load_class(AUDIO_ADAPTER_CLASS).default(),
+    separation_scheduler,
+    memory=memory,
+)
+
+# Files accepted by one /split/batch request
+MAX_BATCH_FILES = int(os.environ.get("SPLIT_BATCH_MAX_FILES", "200"))
+
+# Files over the per-request budget are separated this many seconds at a time
+SEGMENT_SECONDS = float(os.environ.get("SPLIT_SEGMENT_SECONDS", "120"))
+
+def spleeter_cost(stems: int) -> PipelineCost:
+    """
+    Spleeter's working set per frame of 44.1 kHz stereo: the waveform, its
+    STFT (complex64, ~2 bins per sample and channel), then a mask and an
+    output waveform per stem, doubled for TensorFlow's intermediates.
+    Estimated from tensor shapes, not measured
+    """
+    return PipelineCost(
+        fixed_bytes=32 * MB,
+        frame_bytes=2 * (8 + 32 + 24 * stems),
+        sample_rate=SAMPLE_RATE,
+        max_seconds=MAX_DURATION,
+    )
+
+def request_owner(request: Request) -> str:
+    """Who a work directory belongs to (caller-supplied id, else client IP)"""
+    owner = request.headers.get("x-owner-id")
+    if owner:
+        return owner
+    return request.client.host if request.client else "anonymous"
+
+def check_format(format: str):
+    """400 for an unknown stem format, 503 when its encoder is not installed"""
+    if format not in STEM_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"format must be one of: {', '.join(STEM_FORMATS)}"
+        )
+    if not encoder_available(format):
+        raise HTTPException(
+            status_code=503,
+            detail=f"format={format} needs ffmpeg, which is not installed on this worker; use format=wav"
+        )
+
+def abandoned_response(e: Exception) -> HTTPException:
+    """HTTP error for work dropped because of a disconnect or deadline"""
+    if isinstance(e, ClientDisconnected):
+        return HTTPException(status_code=499, detail="Client closed request")
+    return HTTPException(status_code=504, detail=str(e))
+
+def storage_full_response(e: StorageFull) -> HTTPException:
+    return HTTPException(
+        status_code=507,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+def memory_response(e: MemoryTooLarge) -> HTTPException:
+    return HTTPException(status_code=413, detail=str(e))
+
+def failed_result(filename: str, e: Exception) -> Dict[str, Any]:
+    """Per-file entry of a batch response for a split that did not finish"""
+    if isinstance(e, (ClientDisconnected, DeadlineExpired)):
+        error = abandoned_response(e)
+    elif isinstance(e, StorageFull):
+        error = storage_full_response(e)
+    elif isinstance(e, MemoryTooLarge):
+        error = memory_response(e)
+    elif isinstance(e, HTTPException):
+        error = e
+    else:
+        error = HTTPException(status_code=500, detail=str(e))
+    return {
+        "success": False,
+        "filename": filename,
+        "status": error.status_code,
+        "error": error.detail
+    }
+
 @app.get("/")
 async def root():
     return {
         "service": "Spleeter Stem Separation",
         "version": "1.0.0",
         "models": ["2stems", "4stems", "5stems"],
+        "formats": list(STEM_FORMATS),
         "status": "ready"
     }
 
 @app.post("/split")
 async def split_audio(
+    request: Request,
     file: UploadFile = File(...),
-    stems: int = 4  # 2, 4, or 5
+    stems: int = 4,  # 2, 4, or 5
+    format: str = "wav"  # wav, flac, or opus
 ):
     """
     Split audio file into stems
@@ -55,95 +205,247 @@ async def split_audio(
             - 2: vocals, accompaniment
             - 4: vocals, drums, bass, other
             - 5: vocals, drums, bass, piano, other
+        format: Stem file format (wav, flac, or opus)
+            - flac: lossless, roughly half the size of WAV
+            - opus: 160 kbps lossy, for previews and mobile
     
     Returns:
         URLs to download each stem
+    
+    Queued or running work is dropped if the client disconnects or the
+    request deadline passes. Files too long to separate whole within the
+    memory budget are separated in segments.
     """
+    deadline = request_deadline(request, SPLIT_DEADLINE)
     
     if stems not in [2, 4, 5]:
         raise HTTPException(status_code=400, detail="stems must be 2, 4, or 5")
     
-    # Create temp directory for this separation
-    temp_dir = tempfile.mkdtemp()
+    check_format(format)
+    
+    # Create tracked work directory for this separation
+    temp_dir = storage.create_workdir(owner=request_owner(request))
     
     try:
-        # Save uploaded file
-        input_path = os.path.join(temp_dir, file.filename)
-        with open(input_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
-        
-        print(f"[SPLEETER] Processing: {file.filename}")
-        print(f"[SPLEETER] Using {stems}-stem model")
-        
-        # Select separator
-        if stems == 2:
-            separator = separator_2stems
-            stem_names = ['vocals', 'accompaniment']
-        elif stems == 4:
-            separator = separator_4stems
-            stem_names = ['vocals', 'drums', 'bass', 'other']
-        else:  # 5 stems
-            separator = separator_5stems
-            stem_names = ['vocals', 'drums', 'bass', 'piano', 'other']
-        
-        # Separate
-        output_dir = os.path.join(temp_dir, "output")
-        separator.separate_to_file(input_path, output_dir)
-        
-        # Get stem file paths
-        base_name = Path(file.filename).stem
-        stem_dir = os.path.join(output_dir, base_name)
+        content = await file.read()
         
-        # Build response with stem info
-        stems_data = {}
-        for stem_name in stem_names:
-            stem_file = os.path.join(stem_dir, f"{stem_name}.wav")
-            if os.path.exists(stem_file):
-                # Get file size
-                file_size = os.path.getsize(stem_file)
-                
-                # Store stem info
-                stems_data[stem_name] = {
-                    "path": stem_file,
-                    "size": file_size,
-                    "format": "wav",
-                    "sample_rate": 44100,
-                    # You could add duration detection here
-                    "duration": 180.0  # placeholder
-                }
-        
-        print(f"[SPLEETER] ✅ Separation complete: {len(stems_data)} stems")
-        
-        return {
-            "success": True,
-            "filename": file.filename,
-            "stems_count": len(stems_data),
-            "stems": stems_data,
-            "temp_dir": temp_dir,  # Frontend will need this to download files
-            "message": f"Successfully separated into {len(stems_data)} stems"
-        }
+        async def split(token: CancelToken):
+            # Wait for disk headroom before writing anything
+            async with storage.reserve(
+                estimate_separation_bytes(len(content), stems, file.filename),
+                workdir=temp_dir
+            ):
+                return await run_split(temp_dir, file.filename, content, stems, format, token, deadline)
         
+        return await run_cancellable(request, split, deadline)
+    
+    except (ClientDisconnected, DeadlineExpired) as e:
+        storage.release(temp_dir)
+        print(f"[SPLEETER] ⏹ Abandoned {file.filename}: {str(e)}")
+        raise abandoned_response(e)
+    
+    except StorageFull as e:
+        storage.release(temp_dir)
+        print(f"[SPLEETER] ⏳ Rejected {file.filename}: {str(e)}")
+        raise storage_full_response(e)
+    
+    except MemoryTooLarge as e:
+        storage.release(temp_dir)
+        print(f"[SPLEETER] ⏳ Not admitted {file.filename}: {str(e)}")
+        raise memory_response(e)
+    
     except Exception as e:
         # Clean up on error
-        shutil.rmtree(temp_dir, ignore_errors=True)
+        storage.release(temp_dir)
         print(f"[SPLEETER] ❌ Error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/download/{temp_dir}/{base_name}/{stem_name}")
-async def download_stem(temp_dir: str, base_name: str, stem_name: str):
+@app.post("/split/batch")
+async def split_batch(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    stems: int = 4,
+    format: str = "wav"
+):
+    """
+    Split many audio files in one request
+
+    Every file gets its own work directory (same /download, /archive and
+    /cleanup paths as /split). The files run through the batch pipeline
+    together, so one track is decoded and another written while a third is
+    in the model. Returns one result per file, in upload order; a file that
+    fails carries its status and error instead of failing the batch.
+    """
+    if stems not in [2, 4, 5]:
+        raise HTTPException(status_code=400, detail="stems must be 2, 4, or 5")
+    
+    check_format(format)
+    
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"at most {MAX_BATCH_FILES} files per batch"
+        )
+    
+    # The default deadline scales with the batch; headers still override it
+    deadline = request_deadline(request, SPLIT_DEADLINE * len(files))
+    owner = request_owner(request)
+    started = time.monotonic()
+    
+    # Bound uploads held in memory to what the pipeline can take next
+    in_flight = asyncio.Semaphore(batcher.max_batch * 2)
+    
+    async def split_one(file: UploadFile, token: CancelToken) -> Dict[str, Any]:
+        async with in_flight:
+            temp_dir = storage.create_workdir(owner=owner)
+            try:
+                content = await file.read()
+                async with storage.reserve(
+                    estimate_separation_bytes(len(content), stems, file.filename),
+                    workdir=temp_dir
+                ):
+                    return await run_split(temp_dir, file.filename, content, stems, format, token, deadline)
+            except asyncio.CancelledError:
+                storage.release(temp_dir)
+                raise
+            except Exception as e:
+                storage.release(temp_dir)
+                print(f"[SPLEETER] ❌ Batch item {file.filename} failed: {str(e)}")
+                return failed_result(file.filename, e)
+    
+    async def split_all(token: CancelToken) -> List[Dict[str, Any]]:
+        return await asyncio.gather(*[split_one(file, token) for file in files])
+    
+    print(f"[SPLEETER] Batch of {len(files)} files, {stems}-stem model")
+    try:
+        results = await run_cancellable(request, split_all, deadline)
+    except (ClientDisconnected, DeadlineExpired) as e:
+        print(f"[SPLEETER] ⏹ Abandoned batch of {len(files)}: {str(e)}")
+        raise abandoned_response(e)
+    
+    elapsed = time.monotonic() - started
+    completed = sum(1 for result in results if result["success"])
+    print(f"[SPLEETER] ✅ Batch complete: {completed}/{len(files)} in {elapsed:.1f}s")
+    
+    return {
+        "success": True,
+        "results": results,
+        "completed": completed,
+        "failed": len(results) - completed,
+        "elapsed_seconds": round(elapsed, 3),
+        "tracks_per_hour": round(completed * 3600 / elapsed, 1) if elapsed > 0 else None
+    }
+
+async def run_split(
+    temp_dir: str,
+    filename: str,
+    content: bytes,
+    stems: int,
+    format: str,
+    token: CancelToken,
+    deadline: float
+):
+    """Separate an upload inside its work directory and encode the stems"""
+    # Save uploaded file
+    input_path = os.path.join(temp_dir, filename)
+    with open(input_path, "wb") as f:
+        f.write(content)
+    
+    print(f"[SPLEETER] Processing: {filename}")
+    print(f"[SPLEETER] Using {stems}-stem model")
+    
+    # Size the job from the file header; too long to hold whole means segments
+    header = await run_in_threadpool(probe_audio, input_path)
+    plan = memory.plan(header, spleeter_cost(stems), segment_seconds=SEGMENT_SECONDS)
+    
+    # Decode, separate and write through the shared pipeline, which reserves
+    # the plan's memory when the job's decode starts (no queue timeout; the
+    # request deadline still applies)
+    output_dir = os.path.join(temp_dir, "output")
+    with memory.track(f"split {filename}", plan):
+        stem_files = await batcher.submit(
+            input_path, output_dir, stems, format, token, deadline,
+            segment_seconds=plan.segment_seconds, duration=header.duration, plan=plan
+        )
+    
+    # Build response with stem info
+    stems_data = {}
+    for stem_name, stem_file in stem_files.items():
+        # Store stem info
+        stems_data[stem_name] = {
+            "path": stem_file,
+            "size": os.path.getsize(stem_file),
+            "format": format,
+            "sample_rate": 48000 if format == "opus" else 44100,
+            "duration": round(min(header.duration, MAX_DURATION), 2)
+        }
+    
+    print(f"[SPLEETER] ✅ Separation complete: {len(stems_data)} stems")
+    
+    return {
+        "success": True,
+        "filename": filename,
+        "stems_count": len(stems_data),
+        "stems": stems_data,
+        "format": format,
+        "temp_dir": temp_dir,  # Frontend will need this to download files
+        "job_id": os.path.basename(temp_dir),  # Path segment for /download, /archive, /cleanup
+        "admission": {
+            "action": plan.action,
+            "estimated_mb": round(plan.estimate_bytes / MB),
+            "segment_seconds": plan.segment_seconds
+        },
+        "message": f"Successfully separated into {len(stems_data)} stems"
+    }
+
+@app.api_route("/download/{temp_dir}/{base_name}/{stem_name}", methods=["GET", "HEAD"])
+async def download_stem(request: Request, temp_dir: str, base_name: str, stem_name: str):
     """
     Download a specific stem file
+
+    Supports Range / If-Range (206 partial content) so players can seek and
+    clients can resume, and ETag / Last-Modified revalidation (304).
     """
-    stem_path = f"/tmp/{temp_dir}/output/{base_name}/{stem_name}.wav"
+    work_dir = storage.path_for(temp_dir)
+    stem_path = work_dir and find_stem_file(os.path.join(work_dir, "output", base_name), stem_name)
     
-    if not os.path.exists(stem_path):
+    if not stem_path:
         raise HTTPException(status_code=404, detail="Stem file not found")
     
-    return FileResponse(
+    # Keep the directory alive while the client is still pulling stems
+    storage.touch(work_dir)
+    
+    stem_format = format_for_path(stem_path)
+    
+    return stem_file_response(
         stem_path,
-        media_type="audio/wav",
-        filename=f"{base_name}_{stem_name}.wav"
+        request.headers,
+        media_type=STEM_FORMATS[stem_format]["media_type"],
+        filename=f"{base_name}_{stem_name}{STEM_FORMATS[stem_format]['ext']}"
+    )
+
+@app.get("/archive/{temp_dir}/{base_name}")
+async def download_archive(temp_dir: str, base_name: str):
+    """
+    Download every stem of a separation as a single zip
+
+    The archive is built while it is being sent, so the first bytes go out
+    immediately and no zip file is ever written to disk.
+    """
+    work_dir = storage.path_for(temp_dir)
+    stem_paths = list_stem_files(os.path.join(work_dir, "output", base_name)) if work_dir else []
+    
+    if not stem_paths:
+        raise HTTPException(status_code=404, detail="No stems found")
+    
+    storage.touch(work_dir)
+    
+    entries = [(f"{base_name}_{os.path.basename(path)}", path) for path in stem_paths]
+    
+    return StreamingResponse(
+        iter_zip(entries),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{base_name}_stems.zip"'}
     )
 
 @app.post("/cleanup/{temp_dir}")
@@ -152,16 +454,41 @@ async def cleanup(temp_dir: str):
     Clean up temporary files after download
     """
     try:
-        full_path = f"/tmp/{temp_dir}"
-        if os.path.exists(full_path):
-            shutil.rmtree(full_path)
+        full_path = storage.path_for(temp_dir)
+        if full_path and storage.release(full_path):
+            if storage.owns(full_path):
+                # Still being written; it goes when the job finishes
+                return {"success": True, "message": "Cleanup scheduled for when the job finishes"}
             return {"success": True, "message": "Cleanup complete"}
         return {"success": False, "message": "Directory not found"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/storage")
+async def storage_stats():
+    """
+    Disk usage, quota headroom, eviction and admission counters
+    """
+    return storage.stats()
+
+@app.get("/scheduler")
+async def scheduler_stats():
+    """
+    Queue depth and deadline drops for Spleeter jobs, plus batch pipeline
+    counters and time spent in each stage
+    """
+    return {**separation_scheduler.stats(), "batching": batcher.stats()}
+
+@app.get("/memory")
+async def memory_stats():
+    """
+    Memory budget, admission decisions and measured per-request peaks
+    """
+    return memory.stats()
+
 if __name__ == "__main__":
     print("🎵 Starting Spleeter Stem Separation Service...")
     print("📍 Running on http://localhost:8001")
     print("🎼 Models: 2stems, 4stems, 5stems")
+    print("📦 Formats: wav, flac, opus")
     uvicorn.run(app, host="0.0.0.0", port=8001)
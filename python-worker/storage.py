@@ -0,0 +1,352 @@
+"""
+Temp Storage Lifecycle Manager
+Tracks separation work directories, evicts them when their TTL runs out and
+keeps new jobs from starting when the disk is about to fill up
+
+Shared by python-worker and python-worker-enhanced; keep both copies in sync
+(scripts/check_shared_modules.py fails when they drift).
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+GB = 1024 ** 3
+MB = 1024 ** 2
+
+# Rough size of decoded 44.1 kHz stereo 16-bit audio per byte of upload
+COMPRESSED_EXPANSION = 11
+LOSSLESS_EXTENSIONS = {".wav", ".aif", ".aiff", ".flac"}
+
+
+class StorageFull(Exception):
+    """Raised when a job cannot get disk space before its queue timeout"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class WorkDir:
+    path: str
+    owner: str
+    created_at: float
+    expires_at: float
+    size: int = 0
+    active: int = 0  # jobs still writing into the directory
+    released: bool = False  # remove once active drops to 0
+
+
+@dataclass
+class _Counters:
+    evicted_expired: int = 0
+    evicted_released: int = 0
+    evicted_bytes: int = 0
+    rejected: int = 0
+    queued: int = 0
+    queue_wait_seconds: float = 0.0
+    by_owner: Dict[str, int] = field(default_factory=dict)
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def estimate_separation_bytes(upload_bytes: int, stem_count: int, filename: Optional[str] = None) -> int:
+    """
+    Worst-case disk footprint of a separation: the upload plus one decoded
+    WAV per stem
+    """
+    ext = os.path.splitext(filename or "")[1].lower()
+    expansion = 1 if ext in LOSSLESS_EXTENSIONS else COMPRESSED_EXPANSION
+    return upload_bytes + upload_bytes * expansion * stem_count
+
+
+class StorageManager:
+    """
+    Owns every work directory a service creates
+
+    - create_workdir() registers a directory with an owner and a TTL
+    - reserve() is the admission gate: it holds back a job until the
+      estimated bytes fit under the quota, and gives up with StorageFull
+      once queue_timeout has passed
+    - a background janitor evicts expired directories and adopts leftovers
+      from previous runs so a restart never leaks disk
+    """
+
+    def __init__(
+        self,
+        prefix: str,
+        root: Optional[str] = None,
+        quota_bytes: Optional[int] = None,
+        default_ttl: Optional[float] = None,
+        min_free_bytes: Optional[int] = None,
+        janitor_interval: Optional[float] = None,
+        queue_timeout: Optional[float] = None,
+    ):
+        env = os.environ.get
+        self.prefix = prefix
+        self.root = root or env("STORAGE_ROOT") or tempfile.gettempdir()
+        self.quota_bytes = quota_bytes or int(float(env("STORAGE_QUOTA_GB", "20")) * GB)
+        self.default_ttl = default_ttl or float(env("STORAGE_TTL_SECONDS", "3600"))
+        self.min_free_bytes = min_free_bytes or int(float(env("STORAGE_MIN_FREE_GB", "2")) * GB)
+        self.janitor_interval = janitor_interval or float(env("STORAGE_JANITOR_INTERVAL", "60"))
+        self.queue_timeout = queue_timeout if queue_timeout is not None else float(env("STORAGE_QUEUE_TIMEOUT", "30"))
+
+        self._lock = threading.Lock()
+        self._dirs: Dict[str, WorkDir] = {}
+        self._reserved = 0
+        self._waiting = 0
+        self._counters = _Counters()
+        self._janitor: Optional[asyncio.Task] = None
+
+    # ------------------------------------------------------------------
+    # Work directories
+
+    def create_workdir(self, owner: str, ttl: Optional[float] = None) -> str:
+        os.makedirs(self.root, exist_ok=True)
+        path = tempfile.mkdtemp(prefix=self.prefix, dir=self.root)
+        now = time.time()
+        with self._lock:
+            self._dirs[path] = WorkDir(
+                path=path,
+                owner=owner,
+                created_at=now,
+                expires_at=now + (ttl or self.default_ttl),
+            )
+        return path
+
+    def path_for(self, name: str) -> Optional[str]:
+        """Resolve a work directory from the name handed out to clients"""
+        name = os.path.basename(name)
+        if not name.startswith(self.prefix):
+            return None
+        return os.path.join(self.root, name)
+
+    def touch(self, path: str, ttl: Optional[float] = None):
+        """Push back the expiry of a directory a client is still using"""
+        with self._lock:
+            workdir = self._dirs.get(path)
+            if workdir:
+                workdir.expires_at = max(workdir.expires_at, time.time() + (ttl or self.default_ttl))
+
+    def release(self, path: str) -> bool:
+        """
+        Remove a directory (client cleanup or failed job)
+
+        Like the janitor, this never deletes under a running job: a directory
+        that is still active is marked instead, and removed when its last
+        reservation ends.
+        """
+        with self._lock:
+            workdir = self._dirs.get(path)
+            if workdir and workdir.active > 0:
+                workdir.released = True
+                return True
+            self._dirs.pop(path, None)
+        return self._remove(workdir, path)
+
+    def _remove(self, workdir: Optional[WorkDir], path: str) -> bool:
+        existed = os.path.exists(path)
+        shutil.rmtree(path, ignore_errors=True)
+        if existed:
+            self._record_eviction(workdir, path, expired=False)
+        return existed
+
+    def owns(self, path: str) -> bool:
+        with self._lock:
+            return path in self._dirs
+
+    # ------------------------------------------------------------------
+    # Admission
+
+    def _used_bytes(self) -> int:
+        return sum(workdir.size for workdir in self._dirs.values())
+
+    def _fits(self, nbytes: int) -> bool:
+        with self._lock:
+            committed = self._used_bytes() + self._reserved
+        if committed + nbytes > self.quota_bytes:
+            return False
+        return shutil.disk_usage(self.root).free - self._reserved - nbytes >= self.min_free_bytes
+
+    @asynccontextmanager
+    async def reserve(self, nbytes: int, workdir: Optional[str] = None):
+        """
+        Hold `nbytes` of quota for the duration of a job
+
+        Waits (up to queue_timeout) for expired directories to be evicted
+        or other jobs to finish, then raises StorageFull. When the job is
+        done the reservation is swapped for the directory's real size, or
+        the directory is removed if it was released in the meantime.
+        """
+        if not self._fits(nbytes):
+            self._evict_expired()
+        if not self._fits(nbytes):
+            started = time.monotonic()
+            with self._lock:
+                self._waiting += 1
+                self._counters.queued += 1
+            try:
+                while not self._fits(nbytes):
+                    waited = time.monotonic() - started
+                    if waited >= self.queue_timeout:
+                        with self._lock:
+                            self._counters.rejected += 1
+                        raise StorageFull(
+                            f"Not enough disk space for this job (needs ~{nbytes // MB} MB)",
+                            retry_after=max(1, int(self.janitor_interval)),
+                        )
+                    await asyncio.sleep(min(1.0, self.queue_timeout - waited))
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+                    self._counters.queue_wait_seconds += time.monotonic() - started
+
+        with self._lock:
+            self._reserved += nbytes
+            if workdir in self._dirs:
+                self._dirs[workdir].active += 1
+        try:
+            yield
+        finally:
+            size = dir_size(workdir) if workdir and os.path.exists(workdir) else 0
+            released = None
+            with self._lock:
+                self._reserved -= nbytes
+                current = self._dirs.get(workdir)
+                if current:
+                    current.active -= 1
+                    current.size = size
+                    if current.released and current.active == 0:
+                        released = self._dirs.pop(workdir)
+            if released:
+                self._remove(released, workdir)
+
+    # ------------------------------------------------------------------
+    # Janitor
+
+    def _record_eviction(self, workdir: Optional[WorkDir], path: str, expired: bool):
+        size = workdir.size if workdir else 0
+        owner = workdir.owner if workdir else "unknown"
+        with self._lock:
+            if expired:
+                self._counters.evicted_expired += 1
+            else:
+                self._counters.evicted_released += 1
+            self._counters.evicted_bytes += size
+            self._counters.by_owner[owner] = self._counters.by_owner.get(owner, 0) + 1
+
+    def _evict_expired(self) -> List[str]:
+        now = time.time()
+        with self._lock:
+            expired = [
+                workdir for workdir in self._dirs.values()
+                if workdir.expires_at <= now and workdir.active == 0
+            ]
+            for workdir in expired:
+                del self._dirs[workdir.path]
+
+        for workdir in expired:
+            shutil.rmtree(workdir.path, ignore_errors=True)
+            self._record_eviction(workdir, workdir.path, expired=True)
+            print(f"[STORAGE] Evicted expired {workdir.path} ({workdir.size // MB} MB, owner={workdir.owner})")
+        return [workdir.path for workdir in expired]
+
+    def _adopt_orphans(self):
+        """Register directories left behind by a previous process"""
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not name.startswith(self.prefix) or not os.path.isdir(path):
+                continue
+            with self._lock:
+                if path in self._dirs:
+                    continue
+            mtime = os.path.getmtime(path)
+            workdir = WorkDir(
+                path=path,
+                owner="orphan",
+                created_at=mtime,
+                expires_at=mtime + self.default_ttl,
+                size=dir_size(path),
+            )
+            with self._lock:
+                self._dirs.setdefault(path, workdir)
+
+    def sweep(self):
+        """One janitor pass: adopt leftovers, evict expired, refresh sizes"""
+        self._adopt_orphans()
+        self._evict_expired()
+        with self._lock:
+            idle = [workdir for workdir in self._dirs.values() if workdir.active == 0]
+        for workdir in idle:
+            workdir.size = dir_size(workdir.path)
+
+    async def _janitor_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                print(f"[STORAGE] Janitor error: {e}")
+            await asyncio.sleep(self.janitor_interval)
+
+    def start(self):
+        if self._janitor is None:
+            self._janitor = asyncio.get_running_loop().create_task(self._janitor_loop())
+
+    async def stop(self):
+        if self._janitor is not None:
+            self._janitor.cancel()
+            try:
+                await self._janitor
+            except asyncio.CancelledError:
+                pass
+            self._janitor = None
+
+    # ------------------------------------------------------------------
+    # Metrics
+
+    def stats(self) -> Dict:
+        disk = shutil.disk_usage(self.root)
+        with self._lock:
+            used = self._used_bytes()
+            counters = self._counters
+            return {
+                "root": self.root,
+                "workdirs": len(self._dirs),
+                "active_jobs": sum(workdir.active for workdir in self._dirs.values()),
+                "used_bytes": used,
+                "reserved_bytes": self._reserved,
+                "quota_bytes": self.quota_bytes,
+                "quota_used_pct": round(100.0 * (used + self._reserved) / self.quota_bytes, 1),
+                "disk_free_bytes": disk.free,
+                "disk_total_bytes": disk.total,
+                "queued_now": self._waiting,
+                "evictions": {
+                    "expired": counters.evicted_expired,
+                    "released": counters.evicted_released,
+                    "bytes": counters.evicted_bytes,
+                    "by_owner": dict(counters.by_owner),
+                },
+                "admission": {
+                    "queued": counters.queued,
+                    "rejected": counters.rejected,
+                    "queue_wait_seconds": round(counters.queue_wait_seconds, 2),
+                },
+            }
@@ -0,0 +1,86 @@
+"""
+Shared Worker Module Check
+python-worker and python-worker-enhanced each deploy from their own directory,
+so modules they share (stem delivery, storage, scheduling, memory admission)
+exist as a copy in each, marked "keep both copies in sync". This fails when
+a marked module differs between the two workers or exists in only one.
+
+Usage:
+    python scripts/check_shared_modules.py
+    python scripts/check_shared_modules.py --sync-from python-worker
+"""
+
+import argparse
+import difflib
+import os
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKERS = ["python-worker", "python-worker-enhanced"]
+MARKER = "keep both copies in sync"
+
+
+def shared_modules() -> list:
+    """Every .py file in either worker that carries the marker"""
+    names = set()
+    for worker in WORKERS:
+        directory = os.path.join(ROOT, worker)
+        for name in os.listdir(directory):
+            if not name.endswith(".py"):
+                continue
+            with open(os.path.join(directory, name), encoding="utf-8") as f:
+                if MARKER in f.read():
+                    names.add(name)
+    return sorted(names)
+
+
+def read(worker: str, name: str):
+    path = os.path.join(ROOT, worker, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that shared worker modules match")
+    parser.add_argument("--sync-from", choices=WORKERS, help="copy every shared module from this worker to the other")
+    args = parser.parse_args()
+
+    names = shared_modules()
+    if args.sync_from:
+        target = next(worker for worker in WORKERS if worker != args.sync_from)
+        for name in names:
+            source = os.path.join(ROOT, args.sync_from, name)
+            if os.path.exists(source):
+                shutil.copyfile(source, os.path.join(ROOT, target, name))
+                print(f"Copied {args.sync_from}/{name} -> {target}/{name}")
+
+    drifted = 0
+    for name in names:
+        first, second = (read(worker, name) for worker in WORKERS)
+        if first == second:
+            print(f"ok       {name}")
+            continue
+        drifted += 1
+        if first is None or second is None:
+            present = WORKERS[0] if first is not None else WORKERS[1]
+            print(f"MISSING  {name}: only in {present}")
+            continue
+        print(f"DRIFTED  {name}")
+        diff = difflib.unified_diff(
+            first.splitlines(keepends=True),
+            second.splitlines(keepends=True),
+            f"{WORKERS[0]}/{name}",
+            f"{WORKERS[1]}/{name}",
+        )
+        sys.stdout.writelines(diff)
+
+    if drifted:
+        print(f"\n{drifted} shared module(s) out of sync; fix them or run with --sync-from")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()